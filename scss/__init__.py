@@ -44,6 +44,8 @@ __author__ = AUTHOR + ' <' + AUTHOR_EMAIL + '>'
 __license__ = LICENSE
 
 import os
+import bisect
+import itertools
 import logging
 log = logging.getLogger(__name__)
 
@@ -56,7 +58,9 @@ import sys
 import time
 import tempfile
 import textwrap
-from collections import deque
+import types
+from array import array
+from collections import deque, OrderedDict
 try:
     from cStringIO import StringIO
 except:
@@ -65,17 +69,41 @@ except:
 ################################################################################
 # Load C acceleration modules
 locate_blocks = None
+replace_colors = None
+preprocess = None
+postprocess = None
 Scanner = None
+speedups_stats = None
 try:
-    from _speedups import locate_blocks, Scanner, NoMoreTokens
+    from _speedups import locate_blocks, replace_colors, preprocess, postprocess, Scanner, NoMoreTokens
+    from _speedups import stats as speedups_stats
 except ImportError:
-    print >>sys.stderr, "Scanning acceleration disabled (_speedups not found)!"
-    pass
+    try:
+        # The cffi binding of the C core (i.e. for PyPy), for the block locator
+        # and the scanner only
+        from _cffi_speedups import locate_blocks, Scanner, NoMoreTokens
+        from _cffi_speedups import stats as speedups_stats
+    except ImportError:
+        print >>sys.stderr, "Scanning acceleration disabled (_speedups not found)!"
+        pass
 
 ################################################################################
 
 profiling = {}
 
+
+def stats(reset=False):
+    """
+    Counters of the work done by the scanners (and by the C block locator and
+    scanner, when the speedups are used); resets them if asked to.
+    """
+    result = speedups_stats(reset) if speedups_stats else {}
+    result['scanner_cache_hits'] = CachedScanner.cache_hits
+    result['scanner_cache_misses'] = CachedScanner.cache_misses
+    if reset:
+        CachedScanner.cache_hits = CachedScanner.cache_misses = 0
+    return result
+
 # color literals
 _colors = {
     'aliceblue': '#f0f8ff',
@@ -264,6 +292,79 @@ for t, m in _conv.items():
         _conv_factor[k] = f
 del t, m, k, f
 
+
+class _Units(object):
+    """
+    Units of a number: the weights of the units it's made of, as a sorted
+    tuple of (unit, weight), and its primary unit (the first one set, None
+    if none was). They're interned, so the unit shown is computed once for
+    them and every pair of them is merged only once.
+    """
+    __slots__ = ('weights', 'primary', 'unit', '_merged')
+
+    _interned = {}
+
+    def __init__(self, weights, primary):
+        self.weights = weights
+        self.primary = primary
+        self._merged = {}
+        units = dict(weights)
+        if primary:
+            # Give more weight to the first unit ever set
+            units[primary] = units.get(primary, 0) + _units_weights.get(primary, 1)
+        units = sorted(units, key=units.get)
+        self.unit = units[-1] if units else ''
+
+    @classmethod
+    def get(cls, weights, primary):
+        key = weights, primary
+        try:
+            return cls._interned[key]
+        except KeyError:
+            units = cls._interned[key] = cls(weights, primary)
+            return units
+
+    def __nonzero__(self):
+        return bool(self.weights) or self.primary is not None
+
+    def __repr__(self):
+        units = dict(self.weights)
+        if self.primary is not None:
+            units['_'] = self.primary
+        return repr(units)
+
+    def merge(self, other):
+        """
+        Units of the result of an operation between numbers in these units and
+        in the other units.
+        """
+        try:
+            return self._merged[other]
+        except KeyError:
+            pass
+        weights = dict(self.weights)
+        for unit, weight in other.weights:
+            weights[unit] = weights.get(unit, 0) + weight
+        unit = other.unit
+        primary = unit if _units_weights.get(self.primary, 1) <= _units_weights.get(unit, 1) else self.primary
+        units = self._merged[other] = _Units.get(tuple(sorted(weights.items())), primary)
+        return units
+
+
+_no_units = _Units.get((), None)
+_units_cache = {}
+
+
+def _units_of(unit):
+    try:
+        return _units_cache[unit]
+    except KeyError:
+        units = _units_cache[unit] = _Units.get(((unit, _units_weights.get(unit, 1)),) if unit else (), unit)
+        return units
+for unit in _units:
+    _units_of(unit)
+del unit
+
 _safe_strings = {
     '^doubleslash^': '//',
     '^bigcopen^': '/*',
@@ -279,8 +380,6 @@ _reverse_safe_strings_re = re.compile('|'.join(map(re.escape, _reverse_safe_stri
 
 _default_scss_files = {}  # Files to be compiled ({file: content, ...})
 
-_default_scss_index = {0: '<unknown>:0'}
-
 _default_scss_vars = {
     '$BUILD_INFO': BUILD_INFO,
     '$PROJECT': PROJECT,
@@ -312,13 +411,13 @@ _default_scss_opts = {
     'compress_reverse_colors': 1,  # Gets the shortest name of all for colors
     'short_colors': 0,  # Converts things like #RRGGBB to #RGB
     'reverse_colors': 0,  # Gets the shortest name of all for colors
+    'fold_constants': 0,  # Calculates constant expressions when loading files
 }
 
 _default_search_paths = ['.']
 
 SEPARATOR = '\x00'
 _nl_re = re.compile(r'[ \t\r\f\v]*\n[ \t\r\f\v]*', re.MULTILINE)
-_nl_num_re = re.compile(r'\n.+' + SEPARATOR, re.MULTILINE)
 _nl_num_nl_re = re.compile(r'\n.+' + SEPARATOR + r'[ \t\r\f\v]*\n', re.MULTILINE)
 
 _short_color_re = re.compile(r'(?<!\w)#([a-f0-9])\1([a-f0-9])\2([a-f0-9])\3\b', re.IGNORECASE)
@@ -335,8 +434,8 @@ for long_k, v in _colors.items():
     _reverse_colors[short_k] = k
     _reverse_colors[rgb_k] = k
     _reverse_colors[rgba_k] = k
-_reverse_colors_re = re.compile(r'(?<![-\w.#$])(' + '|'.join(map(re.escape, _reverse_colors)) + r')(?![-\w])', re.IGNORECASE)
-_colors_re = re.compile(r'(?<![-\w.#$])(' + '|'.join(map(re.escape, _colors)) + r')(?![-\w])', re.IGNORECASE)
+# Candidates for colors (names, hex and rgb literals), to be looked up:
+_colors_token_re = re.compile(r'(?<![-\w.#$])(rgba?\([\d, ]*\)(?![-\w])|#?[-\w]+)', re.IGNORECASE)
 
 _expr_glob_re = re.compile(r'''
     \#\{(.*?)\}                   # Global Interpolation only
@@ -356,10 +455,12 @@ _variable_re = re.compile('^\\$[-a-zA-Z0-9_]+$')
 _undefined_re = re.compile('^(?:\\$[-a-zA-Z0-9_]+|undefined)$')
 
 _strings_re = re.compile(r'([\'"]).*?\1')
-_blocks_re = re.compile(r'[{},;()\'"\n]')
+_block_chars = '{},;()\'"\n'
 
 _prop_split_re = re.compile(r'[:=]')
 _skip_word_re = re.compile(r'-?[_\w\s#.,:%]*$|[-_\w#.,:%]*$', re.MULTILINE)
+_function_call_re = re.compile(r'([-\w]+)\(')
+_function_def_re = re.compile(r'@function\s+([-\w]+)')
 _has_code_re = re.compile('''
     (?:^|(?<=[{;}]))            # the character just before it should be a '{', a ';' or a '}'
     \s*                         # ...followed by any number of spaces
@@ -441,6 +542,7 @@ INDEX = 9
 LINENO = 10
 FINAL = 11
 MEDIA = 12
+NAMESPACE = 13
 RULE_VARS = {
     'FILEID': FILEID,
     'POSITION': POSITION,
@@ -455,8 +557,34 @@ RULE_VARS = {
     'LINENO': LINENO,
     'FINAL': FINAL,
     'MEDIA': MEDIA,
+    'NAMESPACE': NAMESPACE,
 }
 
+# located blocks:
+BLOCK_LINENO = 0
+BLOCK_SELPROP = 1
+BLOCK_CHILDREN = 2
+BLOCK_CODESTR = 3
+BLOCK_START = 4
+BLOCK_END = 5
+BLOCK_KIND = 6
+
+# kinds of located blocks (classified by the block locator):
+KIND_PLAIN = 0  # properties, nested rules and nested properties
+KIND_AT_RULE = 1  # unknown (plain CSS) @ rules
+KIND_INCLUDE_SHORT = 2  # +mixin
+KIND_MIXIN_SHORT = 3  # =mixin
+KIND_DIRECTIVE = 4  # KIND_DIRECTIVE + index of the directive in DIRECTIVES
+
+# The C block locator uses the same table, keep them in sync:
+DIRECTIVES = (
+    '@warn', '@print', '@raw', '@dump_context', '@dump_options', '@debug',
+    '@option', '@content', '@import', '@extend', '@return', '@include',
+    '@mixin', '@function', '@if', '@else if', '@else', '@for', '@each',
+    '@variables', '@vars', '@media',
+)
+_directive_kinds = dict((code, KIND_DIRECTIVE + i) for i, code in enumerate(DIRECTIVES))
+
 
 def spawn_rule(rule=None, **kwargs):
     if rule is None:
@@ -468,6 +596,7 @@ def spawn_rule(rule=None, **kwargs):
         rule[INDEX] = {0: '<unknown>'}
         rule[LINENO] = 0
         rule[FINAL] = False
+        rule[NAMESPACE] = Namespace()
     else:
         rule = list(rule)
     for k, v in kwargs.items():
@@ -475,6 +604,301 @@ def spawn_rule(rule=None, **kwargs):
     return rule
 
 
+class Frame(object):
+    """
+    Evaluation frame: the located blocks of some code being evaluated for
+    a rule, the position in them, and the state they are evaluated in.
+    """
+    __slots__ = ('rule', 'blocks', 'index', 'p_selectors', 'p_parents', 'p_children', 'scope', 'media')
+
+    def __init__(self, rule, codestr, p_selectors, p_parents, p_children, scope, media):
+        # The code can be either a string or an already located block:
+        if codestr is None:
+            blocks = ()
+        elif isinstance(codestr, basestring):
+            blocks = locate_blocks(codestr)
+        else:
+            blocks = codestr[BLOCK_CHILDREN]
+        self.rule = rule
+        self.blocks = blocks
+        self.index = 0
+        self.p_selectors = p_selectors
+        self.p_parents = p_parents
+        self.p_children = p_children
+        self.scope = scope
+        self.media = media
+
+    def spawn(self, codestr, rule=None, scope=None, media=None):
+        # Frame for nested code, inheriting the state of this one
+        return Frame(
+            self.rule if rule is None else rule,
+            codestr,
+            self.p_selectors,
+            self.p_parents,
+            self.p_children,
+            self.scope if scope is None else scope,
+            self.media if media is None else media,
+        )
+
+
+class Namespace(object):
+    """
+    Mixins and functions defined in a scope. Names not defined in it are
+    looked up in the enclosing scopes, so creating a nested scope doesn't
+    copy anything. Definitions are numbered in the order they're made, and a
+    nested scope only sees the ones made in the enclosing scopes before it
+    was created.
+    """
+    __slots__ = ('parent', 'version', 'mixins', 'functions')
+
+    # Number of definitions made so far (in any scope):
+    count = 0
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.version = Namespace.count
+        self.mixins = {}
+        self.functions = {}
+
+    def define(self, code, name, mixin, min_args, max_args):
+        # Definitions with other numbers of arguments are kept as overloads
+        Namespace.count += 1
+        defined = self.functions if code == '@function' else self.mixins
+        defined.setdefault(name, []).append((Namespace.count, mixin, min_args, max_args))
+
+    def lookup(self, code, name, num_args):
+        """
+        Returns the innermost, latest, mixin (or function) with the given name
+        which accepts `num_args` positional arguments, or None.
+        """
+        namespace = self
+        version = None
+        while namespace is not None:
+            defined = namespace.functions if code == '@function' else namespace.mixins
+            for _version, mixin, min_args, max_args in reversed(defined.get(name, ())):
+                if (version is None or _version <= version) and min_args <= num_args <= max_args:
+                    return mixin
+            version = namespace.version
+            namespace = namespace.parent
+
+    def defined(self, code):
+        """
+        Returns all the mixins (or functions) visible in the scope, as a
+        dictionary of `'name:num_args': mixin`.
+        """
+        arities = set()
+        namespace = self
+        while namespace is not None:
+            defined = namespace.functions if code == '@function' else namespace.mixins
+            for name, overloads in defined.items():
+                for _, _, min_args, max_args in overloads:
+                    arities.update((name, n) for n in range(min_args, max_args + 1))
+            namespace = namespace.parent
+        defined = {}
+        for name, num_args in arities:
+            mixin = self.lookup(code, name, num_args)
+            if mixin is not None:
+                defined['%s:%d' % (name, num_args)] = mixin
+        return defined
+
+
+class Thunk(object):
+    """
+    Variable assignment whose value is only calculated the first time the
+    variable is read. The variables the expression refers to are captured
+    when it's assigned, so later assignments to them don't change it.
+    Thunks can refer to other thunks, up to a depth of max_depth.
+    """
+    __slots__ = ('calculate', 'expr', 'context', 'rule', 'value', 'depth')
+
+    # Longest chain of thunks referring to thunks (each one is calculated
+    # within the calculation of the one referring to it):
+    max_depth = 8
+
+    def __init__(self, calculate, expr, context, rule):
+        self.calculate = calculate
+        self.expr = expr
+        self.context = capture_vars(context, [expr] + [m.group(2) for m in _interpolate_re.finditer(expr)])
+        self.rule = rule
+        self.value = None
+        self.depth = 1 + max([v.depth for v in self._thunks()] or [0])
+
+    def get(self):
+        if self.expr is not None:
+            rule = self.rule
+            value = self.calculate(self.expr, self.context, rule[OPTIONS], rule)
+            if '!default' in self.expr:
+                value = strip_default(value)
+            self.value = value
+            self.expr = self.context = self.rule = None
+            self.depth = 0
+        return self.value
+
+    def _thunks(self):
+        # The captured variables still not calculated
+        if self.expr is None:
+            return []
+        return [v for v in self.context.itervalues() if isinstance(v, Thunk) and v.expr is not None]
+
+    def refers(self, name):
+        """
+        Whether the expression refers to the variable `name`, directly or
+        through the captured variables still not calculated.
+        """
+        seen = set()
+        thunks = [self]
+        while thunks:
+            thunk = thunks.pop()
+            if id(thunk) in seen:
+                continue
+            seen.add(id(thunk))
+            if name in thunk.context:
+                return True
+            thunks.extend(thunk._thunks())
+        return False
+
+
+def capture_vars(context, names, exclude=()):
+    """
+    Returns the values the given variables, and the variables they map to,
+    have in the context.
+    """
+    captured = {}
+    while names:
+        name = names.pop()
+        if name in captured or name in exclude or name not in context:
+            continue
+        value = captured[name] = context[name]
+        # Follow variables mapping to other variables:
+        if isinstance(value, basestring) and '$' in value:
+            names.append(value)
+            names.extend(m.group(2) for m in _interpolate_re.finditer(value))
+    return captured
+
+
+def force(value):
+    """
+    Returns the value of a variable, calculating it if it's still a thunk.
+    """
+    if isinstance(value, Thunk):
+        return value.get()
+    return value
+
+
+def strip_default(value):
+    if isinstance(value, basestring):
+        if '!default' in value:
+            value = value.replace('!default', '').replace('  ', ' ').strip()
+    elif isinstance(value, ListValue):
+        value = ListValue(value)
+        for i, v in enumerate(value.value):
+            if v == '!default':
+                del value.value[i]
+                value = value.first() if len(value) == 1 else value
+                break
+    return value
+
+
+class LineIndex(object):
+    """
+    Positions (line ids) of the code of the files loaded. Every file gets a
+    range of ids, one for each line of its preprocessed code, with an array
+    of their line numbers in the original file, so the positions are only
+    formatted as 'file:line' when they are needed (for debug_info or errors).
+    Id 0 is for code with an unknown position.
+    """
+    __slots__ = ('bases', 'files', 'codes')
+
+    def __init__(self):
+        self.bases = [0]
+        self.files = [('<unknown>', array('i', [0]))]
+        self.codes = {}  # Digest of the loaded code: id of its first line
+
+    def add(self, filename, lines):
+        # Gets the ids for the lines of a file, returns the first one
+        lineno = self.bases[-1] + len(self.files[-1][1])
+        self.bases.append(lineno)
+        self.files.append((filename, array('i', lines)))
+        return lineno
+
+    def __getitem__(self, lineno):
+        i = bisect.bisect_right(self.bases, lineno) - 1
+        filename, lines = self.files[i]
+        return '%s:%d' % (filename, lines[min(lineno - self.bases[i], len(lines) - 1)])
+
+
+def code_digest(codestr):
+    """
+    Digest of some code, to key what's kept for it without keeping the code.
+    """
+    if isinstance(codestr, unicode):
+        codestr = codestr.encode('utf-8')
+    return hashlib.sha1(codestr).digest()
+
+
+CSS_BUFFER_SIZE = 65536
+
+
+class CSSWriter(object):
+    """
+    Output sink for the generated CSS. Chunks are written to a file-like
+    object (or appended to a list of chunks) in batches, passed through
+    `filter` if given. The last chunk is always held back, so a trailing
+    semicolon can still be stripped from it.
+    """
+    __slots__ = ('_write', 'filter', 'buffer_size', 'chunks', 'size')
+
+    def __init__(self, output, filter=None, buffer_size=None):
+        self._write = output.write if hasattr(output, 'write') else output.append
+        self.filter = filter
+        self.buffer_size = buffer_size or CSS_BUFFER_SIZE
+        self.chunks = []
+        self.size = 0
+
+    def write(self, chunk):
+        if chunk:
+            chunks = self.chunks
+            chunks.append(chunk)
+            self.size += len(chunk)
+            if self.size >= self.buffer_size and len(chunks) > 1:
+                last = chunks.pop()
+                self._write_chunks()
+                self.chunks = [last]
+                self.size = len(last)
+
+    def strip_semicolon(self):
+        chunks = self.chunks
+        if chunks and chunks[-1][-1] == ';':
+            chunks[-1] = chunks[-1][:-1]
+            self.size -= 1
+            if not chunks[-1]:
+                chunks.pop()
+
+    def flush(self):
+        self._write_chunks()
+        self.chunks = []
+        self.size = 0
+
+    def _write_chunks(self):
+        cont = ''.join(self.chunks)
+        if self.filter is not None:
+            cont = self.filter(cont)
+        if cont:
+            self._write(cont)
+
+
+def _timed_generator(gen, name):
+    # Times each resume of a generator (what's done in between, i.e. the
+    # evaluation of the frames yielded by a handler, is timed apart)
+    while True:
+        t1 = time.time()
+        try:
+            res = gen.next()
+        finally:
+            profiling[name] += time.time() - t1
+        yield res
+
+
 def print_timing(level=0):
     def _print_timing(func):
         if config.VERBOSITY:
@@ -485,6 +909,8 @@ def print_timing(level=0):
                     t2 = time.time()
                     profiling.setdefault(func.func_name, 0)
                     profiling[func.func_name] += (t2 - t1)
+                    if isinstance(res, types.GeneratorType):
+                        return _timed_generator(res, func.func_name)
                     return res
                 else:
                     return func(*args, **kwargs)
@@ -560,28 +986,62 @@ def depar(s):
 ################################################################################
 # Scanner
 
-def _strip_selprop(selprop, lineno):
-    # Get the line number of the selector or property and strip all other
-    # line numbers that might still be there (from multiline selectors)
-    _lineno, _sep, selprop = selprop.partition(SEPARATOR)
-    if _sep == SEPARATOR:
-        _lineno = _lineno.strip(' \t\n;')
-        try:
-            lineno = int(_lineno)
-        except ValueError:
-            pass
-    else:
-        selprop = _lineno
-    selprop = _nl_num_re.sub('\n', selprop)
-    selprop = selprop.strip()
-    return selprop, lineno
-
-def _strip(selprop):
-    # Strip all line numbers, ignoring them in the way
-    selprop, _ = _strip_selprop(selprop, None)
-    return selprop
+def _lineno_at(codestr, pos, lines):
+    # Get the line (id) at pos in codestr. lines is [the id of the first line,
+    # and the last position and line asked for], newlines are only counted
+    # from there
+    lineno, last, line = lines
+    if lineno is None:
+        return 0
+    if pos < last:
+        last, line = 0, lineno
+    line += codestr.count('\n', last, pos)
+    lines[1:] = pos, line
+    return line
+
+def _strip_selprop(codestr, start, end, lines):
+    # Get the selector or property in codestr[start:end] and the line where
+    # it starts
+    selprop = codestr[start:end]
+    pos = end - len(selprop.lstrip(' \t\n\r\x0b\x0c;'))
+    return selprop.strip(), _lineno_at(codestr, pos, lines)
+
+def _block_codestr(block):
+    # Get the body of a located block (the code between its `{` and `}`)
+    return block[BLOCK_CODESTR][block[BLOCK_START]:block[BLOCK_END]].strip()
+
+def _block_lineno(block):
+    # Get the line (id) where the body of a located block starts (the code
+    # _block_codestr() returns), None if its position is unknown
+    lineno = block[BLOCK_LINENO]
+    if not lineno:
+        return None
+    body = block[BLOCK_CODESTR][block[BLOCK_START]:block[BLOCK_END]]
+    return lineno + block[BLOCK_SELPROP].count('\n') + body[:len(body) - len(body.lstrip())].count('\n')
+
+def _classify_block(selprop):
+    # Get the kind of a located block from its selectors (or property)
+    if selprop.startswith('@'):
+        if selprop.startswith('@else if '):
+            return _directive_kinds['@else if']
+        code = selprop.split(None, 1)[0].lower()
+        return _directive_kinds.get(code, KIND_AT_RULE)
+    elif selprop.startswith('+'):
+        return KIND_INCLUDE_SHORT
+    elif selprop.startswith('='):
+        return KIND_MIXIN_SHORT
+    return KIND_PLAIN
+
+def _flush_properties(codestr, lose, end, lines, blocks):
+    # Split the "lose" code between lose and end into properties
+    for _property in codestr[lose:end].split(';'):
+        _end = lose + len(_property)
+        _property, lineno = _strip_selprop(codestr, lose, _end, lines)
+        if _property:
+            blocks.append((lineno, _property, None, codestr, lose, _end, _classify_block(_property)))
+        lose = _end + 1
 
-def _locate_blocks(codestr):
+def _locate_blocks(codestr, lineno=None):
     """
     For processing CSS like strings.
 
@@ -590,104 +1050,207 @@ def _locate_blocks(codestr):
     (the one between `{` and `}`, which can be nested), or the "lose" code
     (properties) that doesn't have any blocks.
 
-    threshold is the number of blank lines before selectors are broken into
-    pieces (properties).
+    The whole tree is located in a single pass: every block is a tuple
+    (lineno, selectors, children, codestr, start, end, kind), where children
+    is the list of the blocks nested in it (None for properties),
+    codestr[start:end] is its code and kind is one of the KIND_* constants.
+
+    lineno is the line (id) where codestr starts, the lines of the blocks are
+    counted from it (if not given, they are all 0).
     """
-    lineno = 0
+    lines = [lineno, 0, lineno]
 
     par = 0
-    instr = None
-    depth = 0
-    skip = False
-    thin = None
-    i = init = safe = lose = 0
-    start = end = None
-
-    for m in _blocks_re.finditer(codestr):
-        i = m.start(0)
+    instr = ''
+    skip = 0
+    thin = -1
+    init = safe = lose = 0
+    blocks = []
+    stack = []
+
+    # A plain index loop over the characters (jumping over strings), so it
+    # stays fast (and JIT friendly) without the C speedups
+    i = -1
+    size = len(codestr)
+    while True:
+        i += 1
+        if i >= size:
+            break
         c = codestr[i]
-        if instr is not None:
-            if c == instr:
-                instr = None  # A string ends (FIXME: needs to accept escaped characters)
-        elif c in ('"', "'"):
-            instr = c  # A string starts
+        if c not in _block_chars:
+            continue
+        if c == '\n':
+            if not par and not skip:
+                if thin >= 0 and codestr[thin:i].strip():
+                    init = thin
+                    thin = i + 1
+                elif thin < 0 and codestr[safe:i].strip():
+                    thin = i + 1  # Step on thin ice, if it breaks, it breaks here
+        elif c == '"' or c == "'":  # A string starts, jump to where it ends
+            # (FIXME: needs to accept escaped characters)
+            end = codestr.find(c, i + 1)
+            if end < 0:
+                instr = c
+                break
+            i = end
         elif c == '(':  # parenthesis begins:
             par += 1
-            thin = None
+            thin = -1
             safe = i + 1
         elif c == ')':  # parenthesis ends:
             par -= 1
-        elif not par and not instr:
+        elif not par:
             if c == '{':  # block begins:
-                if depth == 0:
-                    if i > 0 and codestr[i - 1] == '#':  # Do not process #{...} as blocks!
-                        skip = True
-                    else:
-                        start = i
-                        if thin is not None and _strip(codestr[thin:i]):
-                            init = thin
-                        if lose < init:
-                            _property, lineno = _strip_selprop(codestr[lose:init], lineno)
-                            if _property:
-                                yield lineno, _property, None
-                            lose = init
-                        thin = None
-                depth += 1
+                if skip:
+                    skip += 1
+                elif i > 0 and codestr[i - 1] == '#':  # Do not process #{...} as blocks!
+                    skip = 1
+                else:
+                    if thin >= 0 and codestr[thin:i].strip():
+                        init = thin
+                    if lose < init:
+                        _property, lineno = _strip_selprop(codestr, lose, init, lines)
+                        if _property:
+                            blocks.append((lineno, _property, None, codestr, lose, init, _classify_block(_property)))
+                    _selectors, lineno = _strip_selprop(codestr, init, i, lines)
+                    stack.append((lineno, _selectors, blocks, i + 1))
+                    # Nested blocks are located in their own (fresh) frame:
+                    blocks = []
+                    thin = -1
+                    init = safe = lose = i + 1
             elif c == '}':  # block ends:
-                if depth > 0:
-                    depth -= 1
-                    if depth == 0:
-                        if not skip:
-                            end = i
-                            _selectors, lineno = _strip_selprop(codestr[init:start], lineno)
-                            _codestr = codestr[start + 1:end].strip()
-                            if _selectors:
-                                yield lineno, _selectors, _codestr
-                            init = safe = lose = end + 1
-                            thin = None
-                        skip = False
-            elif depth == 0:
+                if skip:
+                    skip -= 1
+                elif stack:
+                    _flush_properties(codestr, lose, i, lines, blocks)
+                    lineno, _selectors, _blocks, start = stack.pop()
+                    if _selectors:
+                        _blocks.append((lineno, _selectors, blocks, codestr, start, i, _classify_block(_selectors)))
+                    blocks = _blocks
+                    init = safe = lose = i + 1
+                    thin = -1
+            elif not skip:
                 if c == ';':  # End of property (or block):
                     init = i
                     if lose < init:
-                        _property, lineno = _strip_selprop(codestr[lose:init], lineno)
+                        _property, lineno = _strip_selprop(codestr, lose, init, lines)
                         if _property:
-                            yield lineno, _property, None
+                            blocks.append((lineno, _property, None, codestr, lose, init, _classify_block(_property)))
                         init = safe = lose = i + 1
-                    thin = None
+                    thin = -1
                 elif c == ',':
-                    if thin is not None and _strip(codestr[thin:i]):
+                    if thin >= 0 and codestr[thin:i].strip():
                         init = thin
-                    thin = None
+                    thin = -1
                     safe = i + 1
-                elif c == '\n':
-                    if thin is not None and _strip(codestr[thin:i]):
-                        init = thin
-                        thin = i + 1
-                    elif thin is None and _strip(codestr[safe:i]):
-                        thin = i + 1  # Step on thin ice, if it breaks, it breaks here
-    if depth > 0:
-        if not skip:
-            _selectors, lineno = _strip_selprop(codestr[init:start], lineno)
-            _codestr = codestr[start + 1:].strip()
-            if _selectors:
-                yield lineno, _selectors, _codestr
-            if par:
-                raise Exception("Missing closing parenthesis somewhere in block: '%s'" % _selectors)
-            elif instr:
-                raise Exception("Missing closing string somewhere in block: '%s'" % _selectors)
-            else:
-                raise Exception("Block never closed: '%s'" % _selectors)
-    losestr = codestr[lose:]
-    for _property in losestr.split(';'):
-        _property, lineno = _strip_selprop(_property, lineno)
-        if _property:
-            yield lineno, _property, None
+    if stack:
+        _selectors = stack[0][1]
+        if par:
+            raise Exception("Missing closing parenthesis somewhere in block: '%s'" % _selectors)
+        elif instr:
+            raise Exception("Missing closing string somewhere in block: '%s'" % _selectors)
+        else:
+            raise Exception("Block never closed: '%s'" % _selectors)
+    _flush_properties(codestr, lose, len(codestr), lines, blocks)
+    return blocks
 
 if locate_blocks is None:
     locate_blocks = _locate_blocks
 
 
+def _replace_colors(codestr, table, lower=False):
+    """
+    Replaces the colors (names, hex and rgb literals) in codestr which are
+    found in table. If lower is set, colors are looked up in lower case.
+    """
+    tokens = _colors_token_re.split(codestr)
+    get = table.get
+    if lower:
+        tokens[1::2] = [get(t.lower(), t) for t in tokens[1::2]]
+    else:
+        tokens[1::2] = [get(t, t) for t in tokens[1::2]]
+    return ''.join(tokens)
+
+if replace_colors is None:
+    replace_colors = _replace_colors
+
+
+def _preprocess(codestr, colors, number_lines=False):
+    """
+    Prepares Scss code for load_string(). Returns the code and, if
+    number_lines is set, a list with the line number (in the original code)
+    of each one of its lines.
+    """
+    if number_lines:
+        # every line is numbered as "N\x00" at its beginning, to keep track of
+        # them while the code is processed:
+        ids = itertools.count(2)
+        codestr = '1' + SEPARATOR + _nl_re.sub(lambda m: '\n' + str(next(ids)) + SEPARATOR, codestr)
+
+    # remove empty lines
+    codestr = _nl_num_nl_re.sub('\n', codestr)
+
+    # protects codestr: "..." strings
+    codestr = _strings_re.sub(lambda m: _reverse_safe_strings_re.sub(lambda n: _reverse_safe_strings[n.group(0)], m.group(0)), codestr)
+
+    # removes multiple line comments
+    codestr = _ml_comment_re.sub('', codestr)
+
+    # removes inline comments, but not :// (protocol)
+    codestr = _sl_comment_re.sub('', codestr)
+
+    codestr = _safe_strings_re.sub(lambda m: _safe_strings[m.group(0)], codestr)
+
+    # expand the space in rules
+    codestr = _expand_rules_space_re.sub(' {', codestr)
+
+    # collapse the space in properties blocks
+    codestr = _collapse_properties_space_re.sub(r'\1{', codestr)
+
+    # to do math operations, we need to get the color's hex values (for color names):
+    codestr = replace_colors(codestr, colors)
+
+    lines = None
+    if number_lines:
+        # take the numbers out of the lines:
+        lines = []
+        codestr = codestr.split('\n')
+        for i, line in enumerate(codestr):
+            lineno, sep, line = line.partition(SEPARATOR)
+            if sep and lineno.isdigit():
+                codestr[i] = line
+                lines.append(int(lineno))
+            else:
+                lines.append(lines[-1] if lines else 1)
+        codestr = '\n'.join(codestr)
+    return codestr, lines
+
+if preprocess is None:
+    preprocess = _preprocess
+
+
+def _postprocess(cont, reverse_colors, short_colors, compress):
+    """
+    Post processes the generated CSS. reverse_colors is the table to get the
+    shortest name of the colors (or None).
+    """
+    # short colors:
+    if short_colors:
+        cont = _short_color_re.sub(r'#\1\2\3', cont)
+    # color names:
+    if reverse_colors is not None:
+        cont = replace_colors(cont, reverse_colors, True)
+    if compress:
+        # zero units out (i.e. 0px or 0em -> 0):
+        cont = _zero_units_re.sub('0', cont)
+        # remove zeros before decimal point (i.e. 0.3 -> .3)
+        cont = _zero_re.sub('.', cont)
+    return cont
+
+if postprocess is None:
+    postprocess = _postprocess
+
+
 ################################################################################
 
 
@@ -705,15 +1268,21 @@ class Scss(object):
         self._scss_files = scss_files
         self._search_paths = search_paths
 
+        # The handlers of the directives, by kind of located block:
+        self._directives = []
+        for code in DIRECTIVES:
+            handler, block_only = self.directive_handlers[code]
+            self._directives.append((code, getattr(self, handler), block_only))
+
         self.reset()
 
     def get_scss_constants(self):
         scss_vars = self.scss_vars or {}
-        return dict((k, v) for k, v in scss_vars.items() if k and (not k.startswith('$') or k.startswith('$') and k[1].isupper()))
+        return dict((k, force(v)) for k, v in scss_vars.items() if k and (not k.startswith('$') or k.startswith('$') and k[1].isupper()))
 
     def get_scss_vars(self):
         scss_vars = self.scss_vars or {}
-        return dict((k, v) for k, v in scss_vars.items() if k and not (not k.startswith('$') or k.startswith('$') and k[1].isupper()))
+        return dict((k, force(v)) for k, v in scss_vars.items() if k and not (not k.startswith('$') or k.startswith('$') and k[1].isupper()))
 
     def clean(self):
         self.children = deque()
@@ -736,6 +1305,8 @@ class Scss(object):
         if self._scss_opts is not None:
             self.scss_opts.update(self._scss_opts)
 
+        self.namespace = Namespace()
+
         # Figure out search paths.  Fall back from provided explicitly to
         # defined globally to just searching the current directory
         self.search_paths = list(_default_search_paths)
@@ -765,7 +1336,7 @@ class Scss(object):
                     self._scss_files_order.append(f)
                 self.scss_files[f] = c
 
-        self._scss_index = _default_scss_index.copy()
+        self._scss_index = LineIndex()
 
         self._contexts = {}
 
@@ -773,7 +1344,24 @@ class Scss(object):
 
     #@profile
     #@print_timing(2)
-    def Compilation(self, scss_string=None, scss_file=None, super_selector=None, filename=None):
+    def Compilation(self, scss_string=None, scss_file=None, super_selector=None, filename=None, output=None):
+        if output is None:
+            return ''.join(self.iter_compile(scss_string, scss_file, super_selector, filename))
+        write = output.write if hasattr(output, 'write') else output.append
+        for chunk in self.iter_compile(scss_string, scss_file, super_selector, filename):
+            write(chunk)
+    compile = Compilation
+
+    def iter_compile(self, scss_string=None, scss_file=None, super_selector=None, filename=None, chunk_size=None):
+        """
+        Compiles the same as compile(), but it's a generator yielding the
+        CSS in chunks (of about `chunk_size` characters) as soon as they are
+        generated and post processed.
+
+        Chunks are only cut between whole selectors, properties and braces,
+        so post processing each one of them gives the same result as
+        post processing the whole CSS.
+        """
         if super_selector:
             self.super_selector = super_selector + ' '
         if scss_string is not None:
@@ -788,7 +1376,7 @@ class Scss(object):
             codestr = self.scss_files[fileid]
             codestr = self.load_string(codestr, fileid)
             self.scss_files[fileid] = codestr
-            rule = spawn_rule(fileid=fileid, codestr=codestr, context=self.scss_vars, options=self.scss_opts, index=self._scss_index)
+            rule = spawn_rule(fileid=fileid, codestr=self._file_block(codestr), context=self.scss_vars, options=self.scss_opts, namespace=self.namespace, index=self._scss_index)
             self.children.append(rule)
 
         # this will manage rule: child objects inside of a node
@@ -802,76 +1390,156 @@ class Scss(object):
 
         self.parse_properties()
 
+        # The CSS is post processed as it's written to the output:
+        chunks = []
+        out = CSSWriter(chunks, self.post_process, chunk_size)
+
         all_rules = 0
         all_selectors = 0
         exceeded = ''
-        final_cont = ''
+        debug_info = self.scss_opts.get('debug_info', False)
         for fileid in self.css_files:
-            fcont, total_rules, total_selectors = self.create_css(fileid)
+            if debug_info:
+                # The totals go before the CSS of the file:
+                fcont, total_rules, total_selectors = self.create_css(fileid, [])
+            else:
+                totals = [0, 0]
+                for _ in self._iter_css(fileid, out, totals):
+                    if chunks:
+                        for chunk in chunks:
+                            yield chunk
+                        del chunks[:]
+                total_rules, total_selectors = totals
             all_rules += total_rules
             all_selectors += total_selectors
             if not exceeded and all_selectors > 4095:
                 exceeded = " (IE exceeded!)"
                 log.error("Maximum number of supported selectors in Internet Explorer (4095) exceeded!")
-            if self.scss_opts.get('debug_info', False):
+            if debug_info:
                 if fileid.startswith('<string '):
-                    final_cont += "/* %s, add to %s%s selectors generated */\n" % (total_selectors, all_selectors, exceeded)
+                    out.write("/* %s, add to %s%s selectors generated */\n" % (total_selectors, all_selectors, exceeded))
                 else:
-                    final_cont += "/* %s, add to %s%s selectors generated from '%s' */\n" % (total_selectors, all_selectors, exceeded, fileid)
-            final_cont += fcont
-
-        final_cont = self.post_process(final_cont)
-
-        return final_cont
-    compile = Compilation
+                    out.write("/* %s, add to %s%s selectors generated from '%s' */\n" % (total_selectors, all_selectors, exceeded, fileid))
+                for chunk in fcont:
+                    out.write(chunk)
+                # The whole file is ready to be sent:
+                for chunk in chunks:
+                    yield chunk
+                del chunks[:]
+        out.flush()
+        for chunk in chunks:
+            yield chunk
 
     def load_string(self, codestr, filename=None):
         if filename is not None:
-            codestr += '\n'
-
-            idx = {
-                'next_id': len(self._scss_index),
-                'line': 1,
-            }
-
-            def _cnt(m):
-                idx['line'] += 1
-                lineno = '%s:%d' % (filename, idx['line'])
-                next_id = idx['next_id']
-                self._scss_index[next_id] = lineno
-                idx['next_id'] += 1
-                return '\n' + str(next_id) + SEPARATOR
-            lineno = '%s:%d' % (filename, idx['line'])
-            next_id = idx['next_id']
-            self._scss_index[next_id] = lineno
-            codestr = str(next_id) + SEPARATOR + _nl_re.sub(_cnt, codestr)
-
-        # remove empty lines
-        codestr = _nl_num_nl_re.sub('\n', codestr)
-
-        # protects codestr: "..." strings
-        codestr = _strings_re.sub(lambda m: _reverse_safe_strings_re.sub(lambda n: _reverse_safe_strings[n.group(0)], m.group(0)), codestr)
-
-        # removes multiple line comments
-        codestr = _ml_comment_re.sub('', codestr)
+            codestr, lines = preprocess(codestr + '\n', _colors, True)
+            # the lines of the code get their ids in the index:
+            lineno = self._scss_index.add(filename, lines)
+        else:
+            codestr, lines = preprocess(codestr, _colors)
+            lineno = None
 
-        # removes inline comments, but not :// (protocol)
-        codestr = _sl_comment_re.sub('', codestr)
+        if self.scss_opts.get('fold_constants'):
+            codestr = self.fold_constants(codestr, lineno)
 
-        codestr = _safe_strings_re.sub(lambda m: _safe_strings[m.group(0)], codestr)
+        if lineno is not None:
+            self._scss_index.codes[code_digest(codestr)] = lineno
+        return codestr
 
-        # expand the space in rules
-        codestr = _expand_rules_space_re.sub(' {', codestr)
+    def _file_block(self, codestr):
+        # Get the loaded code located as a block, knowing where its lines are
+        lineno = self._scss_index.codes.get(code_digest(codestr))
+        return (lineno or 0, '', locate_blocks(codestr, lineno), codestr, 0, len(codestr), KIND_PLAIN)
 
-        # collapse the space in properties blocks
-        codestr = _collapse_properties_space_re.sub(r'\1{', codestr)
+    @print_timing(3)
+    def fold_constants(self, codestr, lineno=None):
+        """
+        Replaces the property values and @if conditions which don't use any
+        variables with their calculated value, so they don't need to be
+        calculated again every time they're evaluated. Only the functions in
+        `_foldable_functions` are folded, assuming they aren't redefined by
+        @function in other files.
+        """
+        if isinstance(codestr, unicode):
+            # Folded as UTF-8, the blocks of unicode code are located in it:
+            return self.fold_constants(codestr.encode('utf-8'), lineno).decode('utf-8')
 
-        # to do math operations, we need to get the color's hex values (for color names):
-        def _pp(m):
-            v = m.group(0)
-            return _colors.get(v, v)
-        codestr = _colors_re.sub(_pp, codestr)
+        key = code_digest(codestr)
+        try:
+            # (the most recently used are moved to the end)
+            fold_cache[key] = folded = fold_cache.pop(key)
+            return folded
+        except KeyError:
+            pass
 
+        redefined = set(_function_def_re.findall(codestr))
+        rule = spawn_rule(context={}, options={}, index=self._scss_index)
+
+        def _fold(expr):
+            if '$' in expr or '#{' in expr or '!' in expr or '"' in expr or "'" in expr or is_literal(expr):
+                return None
+            for funct in _function_call_re.findall(expr):
+                if funct not in _foldable_functions or funct in redefined:
+                    return None
+            return self.calculate(expr, rule[CONTEXT], rule[OPTIONS], rule)
+
+        folded = []
+        blocks = list(locate_blocks(codestr, lineno))
+        while blocks:
+            block = blocks.pop()
+            c_lineno, c_property, c_children = block[:BLOCK_CODESTR]
+            rule[LINENO] = c_lineno
+            if c_children is None:
+                # Property value:
+                prop, _, value = c_property.partition(':')
+                if not prop or prop[0] in '@$' or '=' in prop:
+                    continue
+                value = value.strip()
+                if not value or '\n' in value:
+                    # (folding multiple lines would move the ones after them)
+                    continue
+                end = block[BLOCK_END]
+                while codestr[end - 1].isspace():
+                    end -= 1
+                if not codestr.endswith(value, block[BLOCK_START], end):
+                    continue
+                result = _fold(value)
+                if result is None:
+                    continue
+                result = to_str(result)
+                if result != value and is_literal(result):
+                    folded.append((end - len(value), end, result))
+            else:
+                blocks.extend(c_children)
+                # Static @if and @else if conditions:
+                if c_property.startswith('@if '):
+                    name = c_property[4:].strip()
+                elif c_property.startswith('@else if '):
+                    name = c_property[9:].strip()
+                else:
+                    continue
+                end = codestr.rfind('{', 0, block[BLOCK_START])
+                while codestr[end - 1].isspace():
+                    end -= 1
+                if not name or '\n' in name or not codestr.endswith(name, 0, end):
+                    continue
+                result = _fold(name)
+                if isinstance(result, (bool, BooleanValue)):
+                    folded.append((end - len(name), end, 'true' if result else 'false'))
+
+        if folded:
+            folded.sort()
+            cont = []
+            pos = 0
+            for start, end, result in folded:
+                cont.append(codestr[pos:start])
+                cont.append(result)
+                pos = end
+            cont.append(codestr[pos:])
+            codestr = ''.join(cont)
+        fold_cache[key] = codestr
+        if len(fold_cache) > FOLD_CACHE_SIZE:
+            fold_cache.popitem(last=False)
         return codestr
 
     def longest_common_prefix(self, seq1, seq2):
@@ -947,24 +1615,20 @@ class Scss(object):
                 # Optimization: the full cont is a variable in the context,
                 # flatten the interpolation and use it:
                 while isinstance(cont, basestring) and cont in context:
-                    _cont = context[cont]
+                    _cont = force(context[cont])
                     if _cont == cont:
                         break
                     cont = _cont
             else:
-                # Flatten the context (no variables mapping to variables)
-                flat_context = {}
-                for k, v in context.items():
+                # Interpolate variables (flattening variables mapping to
+                # variables):
+                def _av(m):
+                    v = force(context.get(m.group(2)))
                     while isinstance(v, basestring) and v in context:
-                        _v = context[v]
+                        _v = force(context[v])
                         if _v == v:
                             break
                         v = _v
-                    flat_context[k] = v
-
-                # Interpolate variables:
-                def _av(m):
-                    v = flat_context.get(m.group(2))
                     if v:
                         v = to_str(v)
                         if _dequote and m.group(1):
@@ -1014,11 +1678,40 @@ class Scss(object):
 
     @print_timing(4)
     def manage_children(self, rule, p_selectors, p_parents, p_children, scope, media):
-        for c_lineno, c_property, c_codestr in locate_blocks(rule[CODESTR]):
-            if '@return' in rule[OPTIONS]:
-                return
+        self.evaluate(Frame(rule, rule[CODESTR], p_selectors, p_parents, p_children, scope, media))
+
+    def evaluate(self, frame):
+        """
+        Evaluates the blocks of a frame, and of all the frames spawned by it,
+        using an explicit stack (the nesting depth is limited only by memory).
+
+        Handlers return the frame with the nested code that must be evaluated
+        next, or a generator yielding frames when they need to do something
+        after each one of them has been evaluated (the generator is resumed
+        once the yielded frame is done).
+        """
+        stack = [frame]
+        while stack:
+            frame = stack[-1]
+            if not isinstance(frame, Frame):
+                try:
+                    stack.append(frame.next())
+                except StopIteration:
+                    stack.pop()
+                continue
+            rule = frame.rule
+            if frame.index >= len(frame.blocks) or '@return' in rule[OPTIONS]:
+                stack.pop()
+                continue
+            c_block = frame.blocks[frame.index]
+            frame.index += 1
+            c_lineno = c_block[BLOCK_LINENO]
+            c_property = c_block[BLOCK_SELPROP]
+            c_codestr = None if c_block[BLOCK_CHILDREN] is None else c_block
+            kind = c_block[BLOCK_KIND]
+            spawned = None
             # Rules preprocessing...
-            if c_property.startswith('+'):  # expands a '+' at the beginning of a rule as @include
+            if kind == KIND_INCLUDE_SHORT:  # expands a '+' at the beginning of a rule as @include
                 c_property = '@include ' + c_property[1:]
                 try:
                     if '(' not in c_property or c_property.index(':') < c_property.index('('):
@@ -1027,87 +1720,115 @@ class Scss(object):
                             c_property += ')'
                 except ValueError:
                     pass
-            elif c_property.startswith('='):  # expands a '=' at the beginning of a rule as @mixin
+                kind = _classify_block(c_property)
+            elif kind == KIND_MIXIN_SHORT:  # expands a '=' at the beginning of a rule as @mixin
                 c_property = '@mixin' + c_property[1:]
-            elif c_property == '@prototype ':  # Remove '@prototype '
-                c_property = c_property[11:]
+                kind = _classify_block(c_property)
             ####################################################################
-            if c_property.startswith('@'):
-                code, name = (c_property.split(None, 1) + [''])[:2]
-                code = code.lower()
-                if code == '@warn':
-                    name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    log.warn(dequote(to_str(name)))
-                elif code == '@print':
-                    name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    print >>sys.stderr, dequote(to_str(name))
-                elif code == '@raw':
-                    name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    print >>sys.stderr, repr(name)
-                elif code == '@dump_context':
-                    log.info(repr(rule[CONTEXT]))
-                elif code == '@dump_options':
-                    log.info(repr(rule[OPTIONS]))
-                elif code == '@debug':
-                    name = name.strip()
-                    if name.lower() in ('1', 'true', 't', 'yes', 'y', 'on'):
-                        name = 1
-                    elif name.lower() in ('0', 'false', 'f', 'no', 'n', 'off', 'undefined'):
-                        name = 0
-                    config.DEBUG = name
-                    log.info("Debug mode is %s", 'On' if config.DEBUG else 'Off')
-                elif code == '@option':
-                    self._settle_options(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@content':
-                    self._do_content(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@import':
-                    self._do_import(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@extend':
-                    name = self.apply_vars(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    p_parents.update(p.strip() for p in name.replace(',', '&').split('&'))
-                    p_parents.discard('')
-                elif code == '@return':
-                    ret = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
-                    rule[OPTIONS]['@return'] = ret
-                elif code == '@include':
-                    self._do_include(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif c_codestr is None:
+            # Directives
+            if kind >= KIND_DIRECTIVE:
+                code, handler, block_only = self._directives[kind - KIND_DIRECTIVE]
+                if c_codestr is None and block_only:
                     rule[PROPERTIES].append((c_lineno, c_property, None))
-                elif code in ('@mixin', '@function'):
-                    self._do_functions(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@if' or c_property.startswith('@else if '):
-                    self._do_if(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@else':
-                    self._do_else(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@for':
-                    self._do_for(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code == '@each':
-                    self._do_each(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                # elif code == '@while':
-                #     self._do_while(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
-                elif code in ('@variables', '@vars'):
-                    self._get_variables(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr)
-                elif code == '@media':
-                    _media = (media or []) + [name]
-                    rule[CODESTR] = self.construct + ' {' + c_codestr + '}'
-                    self.manage_children(rule, p_selectors, p_parents, p_children, scope, _media)
-                elif scope is None:  # needs to have no scope to crawl down the nested rules
-                    self._nest_rules(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr)
+                else:
+                    name = c_property[len(code):].lstrip()
+                    spawned = handler(frame, c_lineno, c_property, c_codestr, code, name)
             ####################################################################
             # Properties
             elif c_codestr is None:
-                self._get_properties(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr)
+                if kind == KIND_AT_RULE:
+                    rule[PROPERTIES].append((c_lineno, c_property, None))
+                else:
+                    self._get_properties(frame, c_lineno, c_property, c_codestr)
             # Nested properties
-            elif c_property.endswith(':'):
-                rule[CODESTR] = c_codestr
-                self.manage_children(rule, p_selectors, p_parents, p_children, (scope or '') + c_property[:-1] + '-', media)
+            elif kind == KIND_PLAIN and c_property.endswith(':'):
+                spawned = frame.spawn(c_codestr, scope=(frame.scope or '') + c_property[:-1] + '-')
             ####################################################################
             # Nested rules
-            elif scope is None:  # needs to have no scope to crawl down the nested rules
-                self._nest_rules(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr)
+            elif frame.scope is None:  # needs to have no scope to crawl down the nested rules
+                spawned = self._nest_rules(frame, c_lineno, c_property, c_codestr)
+            if spawned is not None:
+                stack.append(spawned)
+
+    # Handlers of the directives (as methods), and whether the directive is
+    # only handled when it has a block (otherwise it's output as it is):
+    directive_handlers = {
+        '@warn': ('_do_warn', False),
+        '@print': ('_do_print', False),
+        '@raw': ('_do_raw', False),
+        '@dump_context': ('_do_dump_context', False),
+        '@dump_options': ('_do_dump_options', False),
+        '@debug': ('_do_debug', False),
+        '@option': ('_settle_options', False),
+        '@content': ('_do_content', False),
+        '@import': ('_do_import', False),
+        '@extend': ('_do_extend', False),
+        '@return': ('_do_return', False),
+        '@include': ('_do_include', False),
+        '@mixin': ('_do_functions', True),
+        '@function': ('_do_functions', True),
+        '@if': ('_do_if', True),
+        '@else if': ('_do_if', True),
+        '@else': ('_do_else', True),
+        '@for': ('_do_for', True),
+        '@each': ('_do_each', True),
+        # '@while': ('_do_while', True),
+        '@variables': ('_get_variables', True),
+        '@vars': ('_get_variables', True),
+        '@media': ('_do_media', True),
+    }
+
+    def _do_warn(self, frame, c_lineno, c_property, c_codestr, code, name):
+        rule = frame.rule
+        name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+        log.warn(dequote(to_str(name)))
+
+    def _do_print(self, frame, c_lineno, c_property, c_codestr, code, name):
+        rule = frame.rule
+        name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+        print >>sys.stderr, dequote(to_str(name))
+
+    def _do_raw(self, frame, c_lineno, c_property, c_codestr, code, name):
+        rule = frame.rule
+        name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+        print >>sys.stderr, repr(name)
+
+    def _do_dump_context(self, frame, c_lineno, c_property, c_codestr, code, name):
+        log.info(repr(frame.rule[CONTEXT]))
+
+    def _do_dump_options(self, frame, c_lineno, c_property, c_codestr, code, name):
+        log.info(repr(frame.rule[OPTIONS]))
+
+    def _do_debug(self, frame, c_lineno, c_property, c_codestr, code, name):
+        name = name.strip()
+        if name.lower() in ('1', 'true', 't', 'yes', 'y', 'on'):
+            name = 1
+        elif name.lower() in ('0', 'false', 'f', 'no', 'n', 'off', 'undefined'):
+            name = 0
+        config.DEBUG = name
+        log.info("Debug mode is %s", 'On' if config.DEBUG else 'Off')
+
+    def _do_extend(self, frame, c_lineno, c_property, c_codestr, code, name):
+        rule = frame.rule
+        name = self.apply_vars(name, rule[CONTEXT], rule[OPTIONS], rule)
+        frame.p_parents.update(p.strip() for p in name.replace(',', '&').split('&'))
+        frame.p_parents.discard('')
+
+    def _do_return(self, frame, c_lineno, c_property, c_codestr, code, name):
+        rule = frame.rule
+        ret = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
+        rule[OPTIONS]['@return'] = ret
+
+    def _do_media(self, frame, c_lineno, c_property, c_codestr, code, name):
+        _media = (frame.media or []) + [name]
+        # Wrap the located body of the media in a `self` block:
+        _block = (0, self.construct) + c_codestr[BLOCK_CHILDREN:BLOCK_KIND] + (KIND_PLAIN,)
+        _codestr = c_codestr[:BLOCK_CHILDREN] + ([_block],) + c_codestr[BLOCK_CODESTR:]
+        return frame.spawn(_codestr, media=_media)
 
     @print_timing(10)
-    def _settle_options(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _settle_options(self, frame, c_lineno, c_property, c_codestr, code, name):
+        rule = frame.rule
         for option in name.split(','):
             option, value = (option.split(':', 1) + [''])[:2]
             option = option.strip().lower()
@@ -1120,13 +1841,15 @@ class Scss(object):
                 rule[OPTIONS][option] = value
 
     @print_timing(10)
-    def _do_functions(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_functions(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @mixin and @function
         """
         if not name:
             return
 
+        rule = frame.rule
+
         funct, params, _ = name.partition('(')
         funct = funct.strip().replace('_', '-')
         params = split_params(depar(params + _))
@@ -1141,43 +1864,58 @@ class Scss(object):
                 if default:
                     default = self.apply_vars(default, rule[CONTEXT], None, rule)
                     defaults[param] = default
-        context = rule[CONTEXT].copy()
-        for p in new_params:
-            context.pop(p, None)
-        mixin = [list(new_params), defaults, self.apply_vars(c_codestr, context, None, rule)]
+        # The body is only processed when it's first used, with the values
+        # the variables it uses (other than its parameters) have here:
+        names = [m.group(2) for m in _interpolate_re.finditer(c_codestr[BLOCK_CODESTR], c_codestr[BLOCK_START], c_codestr[BLOCK_END])]
+        context = capture_vars(rule[CONTEXT], names, new_params)
+        mixin = [list(new_params), defaults, None, (c_lineno, c_property, c_codestr, context)]
         if code == '@function':
             def _call(mixin):
                 def __call(R, *args, **kwargs):
                     m_params = mixin[0]
                     m_vars = rule[CONTEXT].copy()
                     m_vars.update(mixin[1])
-                    m_codestr = mixin[2]
+                    m_codestr = self._mixin_block(mixin)
                     for i, a in enumerate(args):
                         m_vars[m_params[i]] = a
                     m_vars.update(kwargs)
                     _options = rule[OPTIONS].copy()
-                    _rule = spawn_rule(R, codestr=m_codestr, context=m_vars, options=_options, deps=set(), properties=[], final=False, lineno=c_lineno)
-                    self.manage_children(_rule, p_selectors, p_parents, p_children, (scope or '') + '', R[MEDIA])
+                    _rule = spawn_rule(R, codestr=m_codestr, context=m_vars, options=_options, namespace=Namespace(rule[NAMESPACE]), deps=set(), properties=[], final=False, lineno=c_lineno)
+                    # (the body is evaluated right away, as the value is
+                    # needed by the expression calling the function)
+                    self.evaluate(Frame(_rule, m_codestr, frame.p_selectors, frame.p_parents, frame.p_children, frame.scope or '', R[MEDIA]))
                     ret = _rule[OPTIONS].pop('@return', '')
                     return ret
                 return __call
             _mixin = _call(mixin)
             _mixin.mixin = mixin
             mixin = _mixin
-        # Insert as many @mixin options as the default parameters:
-        while len(new_params):
-            rule[OPTIONS]['%s %s:%d' % (code, funct, len(new_params))] = mixin
-            param = new_params.pop()
-            if param not in defaults:
-                break
-        if not new_params:
-            rule[OPTIONS][code + ' ' + funct + ':0'] = mixin
+        # It can be called without any of the trailing parameters that have
+        # default values:
+        min_args = len(new_params)
+        while min_args and new_params[min_args - 1] in defaults:
+            min_args -= 1
+        rule[NAMESPACE].define(code, funct, mixin, min_args, len(new_params))
+
+    def _mixin_block(self, mixin):
+        """
+        Returns the located body of a mixin or function, processing it the
+        first time it's used. The body is then used as a template.
+        """
+        m_block = mixin[2]
+        if m_block is None:
+            c_lineno, c_property, c_codestr, context = mixin[3]
+            m_codestr = self.apply_vars(_block_codestr(c_codestr), context)
+            m_block = mixin[2] = (c_lineno, c_property, locate_blocks(m_codestr, _block_lineno(c_codestr)), m_codestr, 0, len(m_codestr), KIND_PLAIN)
+            mixin[3] = None
+        return m_block
 
     @print_timing(10)
-    def _do_include(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_include(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @include, for @mixins
         """
+        rule = frame.rule
         funct, params, _ = name.partition('(')
         funct = funct.strip()
         funct = self.do_glob_math(funct, rule[CONTEXT], rule[OPTIONS], rule, True)
@@ -1196,10 +1934,10 @@ class Scss(object):
                     num_args += 1
             if param:
                 new_params[varname] = param
-        mixin = rule[OPTIONS].get('@mixin %s:%s' % (funct, num_args))
+        mixin = rule[NAMESPACE].lookup('@mixin', funct, num_args)
         if not mixin:
             # Fallback to single parmeter:
-            mixin = rule[OPTIONS].get('@mixin %s:1' % (funct,))
+            mixin = rule[NAMESPACE].lookup('@mixin', funct, 1)
             if mixin and all(map(lambda o: isinstance(o, int), new_params.keys())):
                 new_params = {0: ', '.join(new_params.values())}
         if not mixin:
@@ -1208,7 +1946,7 @@ class Scss(object):
 
         m_params = mixin[0]
         m_vars = mixin[1].copy()
-        m_codestr = mixin[2]
+        m_codestr = self._mixin_block(mixin)
         for varname, value in new_params.items():
             try:
                 m_param = m_params[varname]
@@ -1224,25 +1962,26 @@ class Scss(object):
         _context.update(m_vars)
         _rule = spawn_rule(rule, codestr=m_codestr, context=_context, lineno=c_lineno)
         _rule[OPTIONS]['@content'] = c_codestr
-        self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+        return frame.spawn(m_codestr, rule=_rule)
 
     @print_timing(10)
-    def _do_content(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_content(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @content
         """
+        rule = frame.rule
         if '@content' not in rule[OPTIONS]:
             log.error("Content string not found for @content (%s)", rule[INDEX][rule[LINENO]])
         c_codestr = rule[OPTIONS].pop('@content', '')
-        rule[CODESTR] = c_codestr
-        self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
+        return frame.spawn(c_codestr)
 
     @print_timing(10)
-    def _do_import(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_import(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @import
         Load and import mixins and functions and rules
         """
+        rule = frame.rule
         # Protect against going to prohibited places...
         if '..' in name or '://' in name or 'url(' in name:
             rule[PROPERTIES].append((c_lineno, c_property, None))
@@ -1303,7 +2042,7 @@ class Scss(object):
                     if i_codestr is not None:
                         break
                 if i_codestr is None:
-                    i_codestr = self._do_magic_import(rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name)
+                    i_codestr = self._do_magic_import(frame, c_lineno, c_property, c_codestr, code, name)
                 i_codestr = self.scss_files[name] = i_codestr and self.load_string(i_codestr, full_filename)
                 if name not in self.scss_files:
                     self._scss_files_order.append(name)
@@ -1312,16 +2051,18 @@ class Scss(object):
                 unsupported = unsupported and "\nPossible matches (for unsupported file format SASS):\n\t%s" % "\n\t".join(unsupported) or ''
                 log.warn("File to import not found or unreadable: '%s' (%s)%s%s", filename, rule[INDEX][rule[LINENO]], load_paths, unsupported)
             else:
+                i_codestr = self._file_block(i_codestr)
                 _rule = spawn_rule(rule, codestr=i_codestr, path=full_filename, lineno=c_lineno)
-                self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+                yield frame.spawn(i_codestr, rule=_rule)
                 rule[OPTIONS]['@import ' + name] = True
 
     @print_timing(10)
-    def _do_magic_import(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_magic_import(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @import for sprite-maps
         Imports magic sprite map directories
         """
+        rule = frame.rule
         if callable(config.STATIC_ROOT):
             files = sorted(config.STATIC_ROOT(name))
         else:
@@ -1339,11 +2080,11 @@ class Scss(object):
         def setdefault(var, val):
             _var = '$' + map_name + '-' + var
             if _var in rule[CONTEXT]:
-                kwargs[var] = interpolate(rule[CONTEXT][_var], rule)
+                kwargs[var] = interpolate(force(rule[CONTEXT][_var]), rule)
             else:
                 rule[CONTEXT][_var] = val
                 kwargs[var] = interpolate(val, rule)
-            return rule[CONTEXT][_var]
+            return force(rule[CONTEXT][_var])
 
         setdefault('sprite-base-class', StringValue('.' + map_name + '-sprite'))
         setdefault('sprite-dimensions', BooleanValue(False))
@@ -1396,10 +2137,11 @@ class Scss(object):
         return ret
 
     @print_timing(10)
-    def _do_if(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_if(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @if and @else if
         """
+        rule = frame.rule
         if code != '@if':
             if '@if' not in rule[OPTIONS]:
                 log.error("@else with no @if (%s)", rule[INDEX][rule[LINENO]])
@@ -1419,27 +2161,27 @@ class Scss(object):
             else:
                 val = True
             if val:
-                rule[CODESTR] = c_codestr
-                self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
+                yield frame.spawn(c_codestr)
             rule[OPTIONS]['@if'] = val
 
     @print_timing(10)
-    def _do_else(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_else(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @else
         """
+        rule = frame.rule
         if '@if' not in rule[OPTIONS]:
             log.error("@else with no @if (%s)", rule[INDEX][rule[LINENO]])
         val = rule[OPTIONS].pop('@if', True)
         if not val:
-            rule[CODESTR] = c_codestr
-            self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
+            return frame.spawn(c_codestr)
 
     @print_timing(10)
-    def _do_for(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_for(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @for
         """
+        rule = frame.rule
         var, _, name = name.partition(' from ')
         frm, _, through = name.partition(' through ')
         if not through:
@@ -1461,15 +2203,15 @@ class Scss(object):
         var = self.do_glob_math(var, rule[CONTEXT], rule[OPTIONS], rule, True)
 
         for i in rev(range(frm, through + 1)):
-            rule[CODESTR] = c_codestr
             rule[CONTEXT][var] = str(i)
-            self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
+            yield frame.spawn(c_codestr)
 
     @print_timing(10)
-    def _do_each(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    def _do_each(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @each
         """
+        rule = frame.rule
         var, _, name = name.partition(' in ')
         name = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
         if not name:
@@ -1481,18 +2223,17 @@ class Scss(object):
 
         for n, v in name.items():
             v = to_str(v)
-            rule[CODESTR] = c_codestr
             rule[CONTEXT][var] = v
             if not isinstance(n, int):
                 rule[CONTEXT][n] = v
-            self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
+            yield frame.spawn(c_codestr)
 
-    # @print_timing(10)
-    # def _do_while(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr, code, name):
+    # def _do_while(self, frame, c_lineno, c_property, c_codestr, code, name):
     #     THIS DOES NOT WORK AS MODIFICATION OF INNER VARIABLES ARE NOT KNOWN AT THIS POINT!!
     #     """
     #     Implements @while
     #     """
+    #     rule = frame.rule
     #     first_val = None
     #     while True:
     #         val = self.calculate(name, rule[CONTEXT], rule[OPTIONS], rule)
@@ -1501,25 +2242,24 @@ class Scss(object):
     #             first_val = val
     #         if not val:
     #             break
-    #         rule[CODESTR] = c_codestr
-    #         self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
+    #         yield frame.spawn(c_codestr)
     #     rule[OPTIONS]['@if'] = first_val
 
     @print_timing(10)
-    def _get_variables(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr):
+    def _get_variables(self, frame, c_lineno, c_property, c_codestr, code, name):
         """
         Implements @variables and @vars
         """
-        _rule = list(rule)
-        _rule[CODESTR] = c_codestr
-        _rule[PROPERTIES] = rule[CONTEXT]
-        self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+        _rule = list(frame.rule)
+        _rule[PROPERTIES] = frame.rule[CONTEXT]
+        return frame.spawn(c_codestr, rule=_rule)
 
     @print_timing(10)
-    def _get_properties(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr):
+    def _get_properties(self, frame, c_lineno, c_property, c_codestr):
         """
         Implements properties and variables extraction and assignment
         """
+        rule = frame.rule
         prop, value = (_prop_split_re.split(c_property, 1) + [None])[:2]
         try:
             is_var = (c_property[len(prop)] == '=')
@@ -1532,45 +2272,47 @@ class Scss(object):
 
         if value:
             value = value.strip()
-            value = self.calculate(value, rule[CONTEXT], rule[OPTIONS], rule)
-        _prop = (scope or '') + prop
+        _prop = (frame.scope or '') + prop
         if is_var or prop.startswith('$') and value is not None:
-            in_context = rule[CONTEXT].get(_prop)
-            is_defined = not (in_context is None or isinstance(in_context, basestring) and _undefined_re.match(in_context))
-            if isinstance(value, basestring):
-                if '!default' in value:
-                    if is_defined:
-                        value = None
-                    if value is not None:
-                        value = value.replace('!default', '').replace('  ', ' ').strip()
-                if value is not None and prop.startswith('$') and prop[1].isupper():
-                    if is_defined:
-                        log.warn("Constant %r redefined", prop)
-            elif isinstance(value, ListValue):
-                value = ListValue(value)
-                for k, v in value.value.items():
-                    if v == '!default':
-                        if is_defined:
-                            value = None
-                        if value is not None:
-                            del value.value[k]
-                            value = value.first() if len(value) == 1 else value
-                        break
-            if value is not None:
-                rule[CONTEXT][_prop] = value
+            if value is None:
+                return
+            is_default = '!default' in value
+            is_constant = prop.startswith('$') and prop[1].isupper()
+            if is_default or is_constant:
+                in_context = force(rule[CONTEXT].get(_prop))
+                is_defined = not (in_context is None or isinstance(in_context, basestring) and _undefined_re.match(in_context))
+                if is_defined:
+                    if is_default:
+                        return
+                    log.warn("Constant %r redefined", prop)
+            if '#{' in value:
+                # Interpolated variable names can't be known beforehand:
+                value = self.calculate(value, rule[CONTEXT], rule[OPTIONS], rule)
+                if is_default:
+                    value = strip_default(value)
+            elif value:
+                # Only calculated when (and if) the variable gets used, unless
+                # it's assigned in terms of itself (i.e. accumulated in loops)
+                # or the chain of thunks it refers to gets too long:
+                value = Thunk(self.calculate, value, rule[CONTEXT], rule)
+                if value.depth > Thunk.max_depth or value.refers(_prop):
+                    value = value.get()
+            rule[CONTEXT][_prop] = value
         else:
+            if value:
+                value = self.calculate(value, rule[CONTEXT], rule[OPTIONS], rule)
             _prop = self.apply_vars(_prop, rule[CONTEXT], rule[OPTIONS], rule, True)
             rule[PROPERTIES].append((c_lineno, _prop, to_str(value) if value is not None else None))
 
     @print_timing(10)
-    def _nest_rules(self, rule, p_selectors, p_parents, p_children, scope, media, c_lineno, c_property, c_codestr):
+    def _nest_rules(self, frame, c_lineno, c_property, c_codestr):
         """
         Implements Nested CSS rules
         """
+        rule = frame.rule
+        media = frame.media
         if c_property == self.construct and rule[MEDIA] == media:
-            rule[CODESTR] = c_codestr
-            self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
-            return
+            return frame.spawn(c_codestr)
 
         c_property = self.apply_vars(c_property, rule[CONTEXT], rule[OPTIONS], rule, True)
 
@@ -1580,7 +2322,7 @@ class Scss(object):
         better_selectors = set()
         c_selectors = c_selectors.split(',')
         for c_selector in c_selectors:
-            for p_selector in p_selectors:
+            for p_selector in frame.p_selectors:
                 if c_selector == self.construct:
                     better_selectors.add(p_selector)
                 elif '&' in c_selector:  # Parent References
@@ -1597,9 +2339,9 @@ class Scss(object):
             if parents:
                 better_selectors += ' extends ' + '&'.join(sorted(parents))
 
-        _rule = spawn_rule(rule, codestr=c_codestr, deps=set(), context=rule[CONTEXT].copy(), options=rule[OPTIONS].copy(), selectors=better_selectors, properties=[], final=False, media=media, lineno=c_lineno)
+        _rule = spawn_rule(rule, codestr=c_codestr, deps=set(), context=rule[CONTEXT].copy(), options=rule[OPTIONS].copy(), namespace=Namespace(rule[NAMESPACE]), selectors=better_selectors, properties=[], final=False, media=media, lineno=c_lineno)
 
-        p_children.appendleft(_rule)
+        frame.p_children.appendleft(_rule)
 
     @print_timing(4)
     def link_with_parents(self, parent, c_selectors, c_rules):
@@ -1761,10 +2503,22 @@ class Scss(object):
                         self.css_files.append(fileid)
 
     @print_timing(3)
-    def create_css(self, fileid=None):
+    def create_css(self, fileid=None, output=None):
         """
-        Generate the final CSS string
+        Generate the final CSS string (or write it to `output`, a file-like
+        object or a list of chunks)
         """
+        chunks = [] if output is None else output
+        out = CSSWriter(chunks)
+        totals = [0, 0]
+        for _ in self._iter_css(fileid, out, totals):
+            pass
+        out.flush()
+        if output is None:
+            return (''.join(chunks), totals[0], totals[1])
+        return (output, totals[0], totals[1])
+
+    def _iter_css(self, fileid, out, totals):
         if fileid:
             rules = self._rules.get(fileid) or []
         else:
@@ -1777,9 +2531,25 @@ class Scss(object):
             sc, sp, tb, nl = True, ' ', '  ', '\n'
 
         scope = set()
-        return self._create_css(rules, scope, sc, sp, tb, nl, not compress and self.scss_opts.get('debug_info', False))
+        return self._iter_create_css(rules, scope, sc, sp, tb, nl, not compress and self.scss_opts.get('debug_info', False), out, totals)
+
+    def _create_css(self, rules, scope=None, sc=True, sp=' ', tb='  ', nl='\n', debug_info=False, output=None):
+        chunks = [] if output is None else output
+        out = CSSWriter(chunks)
+        totals = [0, 0]
+        for _ in self._iter_create_css(rules, scope, sc, sp, tb, nl, debug_info, out, totals):
+            pass
+        out.flush()
+        if output is None:
+            return (''.join(chunks), totals[0], totals[1])
+        return (output, totals[0], totals[1])
 
-    def _create_css(self, rules, scope=None, sc=True, sp=' ', tb='  ', nl='\n', debug_info=False):
+    def _iter_create_css(self, rules, scope, sc, sp, tb, nl, debug_info, out, totals):
+        """
+        Writes the CSS of the rules to `out` (a CSSWriter), yielding after
+        every rule so the CSS can be sent while it's being generated. The
+        number of rules and selectors generated are left in `totals`.
+        """
         if scope is None:
             scope = set()
 
@@ -1800,7 +2570,6 @@ class Scss(object):
         total_rules = 0
         total_selectors = 0
 
-        result = ''
         for rule in rules:
             #print >>sys.stderr, rule[FILEID], rule[MEDIA], rule[POSITION], [ c for c in rule[CONTEXT] if not c.startswith('$__') ], rule[OPTIONS].keys(), rule[SELECTORS], rule[DEPS]
             if rule[POSITION] is None or not rule[PROPERTIES]:
@@ -1812,18 +2581,18 @@ class Scss(object):
             if old_media != media or media is not None:
                 if open_selectors:
                     if not skip_selectors:
-                        if not sc and result[-1] == ';':
-                            result = result[:-1]
-                        result += _tb + '}' + nl
+                        if not sc:
+                            out.strip_semicolon()
+                        out.write(_tb + '}' + nl)
                     open_selectors = False
                     skip_selectors = False
                 if open_media:
-                    if not sc and result[-1] == ';':
-                        result = result[:-1]
-                    result += '}' + nl
+                    if not sc:
+                        out.strip_semicolon()
+                    out.write('}' + nl)
                     open_media = False
                 if media:
-                    result += '@media ' + (' and ').join(set(media)) + sp + '{' + nl
+                    out.write('@media ' + (' and ').join(set(media)) + sp + '{' + nl)
                     open_media = True
                 old_media = media
                 old_selectors = None  # force entrance to add a new selector
@@ -1831,9 +2600,9 @@ class Scss(object):
             if old_selectors != selectors or selectors is not None:
                 if open_selectors:
                     if not skip_selectors:
-                        if not sc and result[-1] == ';':
-                            result = result[:-1]
-                        result += _tb + '}' + nl
+                        if not sc:
+                            out.strip_semicolon()
+                        out.write(_tb + '}' + nl)
                     open_selectors = False
                     skip_selectors = False
                 if selectors:
@@ -1874,11 +2643,11 @@ class Scss(object):
                                 _lineno = lineno
                                 _filename = _escape_chars_re.sub(r'\\\1', _filename)
                                 sass_debug_info += "@media -sass-debug-info{filename{font-family:file\:\/\/%s}line{font-family:\\00003%s}}" % (_filename, _lineno) + nl
-                            result += sass_debug_info
+                            out.write(sass_debug_info)
                         selector = (',' + sp).join('%s%s' % (self.super_selector, s) for s in _selectors) + sp + '{'
                         if nl:
                             selector = nl.join(wrap(selector))
-                        result += _tb + selector + nl
+                        out.write(_tb + selector + nl)
                     else:
                         skip_selectors = True
                     open_selectors = True
@@ -1887,32 +2656,34 @@ class Scss(object):
             if selectors:
                 _tb += tb
             if rule[OPTIONS].get('verbosity', 0) > 1:
-                result += _tb + '/* file: ' + rule[FILEID] + ' */' + nl
+                out.write(_tb + '/* file: ' + rule[FILEID] + ' */' + nl)
                 if rule[CONTEXT]:
-                    result += _tb + '/* vars:' + nl
+                    out.write(_tb + '/* vars:' + nl)
                     for k, v in rule[CONTEXT].items():
-                        result += _tb + _tb + k + ' = ' + v + ';' + nl
-                    result += _tb + '*/' + nl
+                        out.write(_tb + _tb + k + ' = ' + to_str(force(v)) + ';' + nl)
+                    out.write(_tb + '*/' + nl)
             if not skip_selectors:
-                result += self._print_properties(rule[PROPERTIES], scope, [old_property], sc, sp, _tb, nl, wrap)
+                self._print_properties(rule[PROPERTIES], scope, [old_property], sc, sp, _tb, nl, wrap, out)
+            totals[:] = total_rules, total_selectors
+            yield
 
         if open_media:
             _tb = tb
         else:
             _tb = ''
         if open_selectors and not skip_selectors:
-            if not sc and result[-1] == ';':
-                result = result[:-1]
-            result += _tb + '}' + nl
+            if not sc:
+                out.strip_semicolon()
+            out.write(_tb + '}' + nl)
 
         if open_media:
-            if not sc and result[-1] == ';':
-                result = result[:-1]
-            result += '}' + nl
+            if not sc:
+                out.strip_semicolon()
+            out.write('}' + nl)
 
-        return (result, total_rules, total_selectors)
+        totals[:] = total_rules, total_selectors
 
-    def _print_properties(self, properties, scope=None, old_property=None, sc=True, sp=' ', _tb='', nl='\n', wrap=None):
+    def _print_properties(self, properties, scope=None, old_property=None, sc=True, sp=' ', _tb='', nl='\n', wrap=None, output=None):
         if wrap is None:
             textwrap.TextWrapper.wordsep_re = re.compile(r'(?<=,)(\s*)')
             if hasattr(textwrap.TextWrapper, 'wordsep_simple_re'):
@@ -1920,13 +2691,13 @@ class Scss(object):
             else:
                 wrap = textwrap.TextWrapper(break_long_words=False)
             wrap = wrap.wrap
-            wrap = wrap.wrap
         if old_property is None:
             old_property = [None]
         if scope is None:
             scope = set()
 
-        result = ''
+        chunks = [] if output is None else output
+        out = CSSWriter(chunks)
         for lineno, prop, value in properties:
             if value is not None:
                 if nl:
@@ -1942,13 +2713,16 @@ class Scss(object):
                 old_property[0] = property
                 scope.add(prop)
                 old_property[0] = property
-                result += _tb + property + ';' + nl
-        return result
+                out.write(_tb + property + ';' + nl)
+        out.flush()
+        if output is None:
+            return ''.join(chunks)
+        return output
 
     def calculate(self, _base_str, context, options, rule):
         better_expr_str = _base_str
 
-        if _skip_word_re.match(better_expr_str) and '- ' not in better_expr_str and ' and ' not in better_expr_str and ' or ' not in better_expr_str and 'not ' not in better_expr_str:
+        if is_literal(better_expr_str):
             return better_expr_str
 
         rule = list(rule)
@@ -1990,18 +2764,9 @@ class Scss(object):
     @print_timing(3)
     def post_process(self, cont):
         compress = self.scss_opts.get('compress', 1) and 'compress_' or ''
-        # short colors:
-        if self.scss_opts.get(compress + 'short_colors', 1):
-            cont = _short_color_re.sub(r'#\1\2\3', cont)
-        # color names:
-        if self.scss_opts.get(compress + 'reverse_colors', 1):
-            cont = _reverse_colors_re.sub(lambda m: _reverse_colors[m.group(0).lower()], cont)
-        if compress:
-            # zero units out (i.e. 0px or 0em -> 0):
-            cont = _zero_units_re.sub('0', cont)
-            # remove zeros before decimal point (i.e. 0.3 -> .3)
-            cont = _zero_re.sub('.', cont)
-        return cont
+        short_colors = self.scss_opts.get(compress + 'short_colors', 1)
+        reverse_colors = self.scss_opts.get(compress + 'reverse_colors', 1) and _reverse_colors or None
+        return postprocess(cont, reverse_colors, bool(short_colors), bool(compress))
 
 
 import random
@@ -2081,15 +2846,30 @@ def _rgba(r, g, b, a, type='rgba'):
     return ColorValue(col)
 
 
-def _color_type(color, a, type):
+def __colors(fn, color, *args):
+    """
+    fn(color, *args), or a list of fn(c, *args) for each color c of color if
+    it's a list of them (so the functions on colors work on lists of colors,
+    parsing the rest of their arguments only once).
+    """
+    if isinstance(color, ListValue):
+        return color._map(lambda c: __colors(fn, c, *args))
+    return fn(color, *args)
+
+
+def __color_type(color, a, type):
     color = ColorValue(color).value
-    a = NumberValue(a).value if a is not None else color[3]
+    a = a if a is not None else color[3]
     col = list(color[:3])
     col += [0.0 if a < 0 else 1.0 if a > 1 else a]
     col += [type]
     return ColorValue(col)
 
 
+def _color_type(color, a, type):
+    return __colors(__color_type, color, NumberValue(a).value if a is not None else None, type)
+
+
 def _rgb2(color):
     return _color_type(color, 1.0, 'rgb')
 
@@ -2106,11 +2886,15 @@ def _hsla2(color, a=None):
     return _color_type(color, a, 'hsla')
 
 
-def _ie_hex_str(color):
+def __ie_hex_str(color):
     c = ColorValue(color).value
     return StringValue('#%02X%02X%02X%02X' % (round(c[3] * 255), round(c[0]), round(c[1]), round(c[2])))
 
 
+def _ie_hex_str(color):
+    return __colors(__ie_hex_str, color)
+
+
 def _hsl(h, s, l, type='hsl'):
     return _hsla(h, s, l, 1.0, type)
 
@@ -2132,14 +2916,18 @@ def _hsla(h, s, l, a, type='hsla'):
 
 
 def __rgba_op(op, color, r, g, b, a):
-    color = ColorValue(color)
-    c = color.value
     a = [
         None if r is None else NumberValue(r).value,
         None if g is None else NumberValue(g).value,
         None if b is None else NumberValue(b).value,
         None if a is None else NumberValue(a).value,
     ]
+    return __colors(__rgba_color, color, op, a)
+
+
+def __rgba_color(color, op, a):
+    color = ColorValue(color)
+    c = color.value
     # Do the additions:
     c = [op(c[i], a[i]) if op is not None and a[i] is not None else a[i] if a[i] is not None else c[i] for i in range(4)]
     # Validations:
@@ -2158,8 +2946,6 @@ def _transparentize(color, amount):
 
 
 def __hsl_op(op, color, h, s, l):
-    color = ColorValue(color)
-    c = color.value
     h = None if h is None else NumberValue(h)
     s = None if s is None else NumberValue(s)
     l = None if l is None else NumberValue(l)
@@ -2168,17 +2954,23 @@ def __hsl_op(op, color, h, s, l):
         None if s is None else s.value / 100.0 if s.unit != '%' and s.value >= 1 else s.value,
         None if l is None else l.value / 100.0 if l.unit != '%' and l.value >= 1 else l.value,
     ]
-    # Convert to HSL:
-    h, l, s = list(colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0))
-    c = h, s, l
+    return __colors(__hsl_color, color, op, a)
+
+
+def __hsl_color(color, op, a):
+    # Convert to HSL (kept by the color, when it's one already):
+    color = color if isinstance(color, ColorValue) else ColorValue(color)
+    h, l, s = color.hls
     # Do the additions:
-    c = [0.0 if c[i] < 0 else 1.0 if c[i] > 1 else op(c[i], a[i]) if op is not None and a[i] is not None else a[i] if a[i] is not None else c[i] for i in range(3)]
+    h, s, l = [0.0 if c < 0 else 1.0 if c > 1 else c if v is None else v if op is None else op(c, v) for c, v in zip((h, s, l), a)]
     # Validations:
-    c[0] = (c[0] * 360.0) % 360
-    r = 360.0, 1.0, 1.0
-    c = [0.0 if c[i] < 0 else r[i] if c[i] > r[i] else c[i] for i in range(3)]
+    h = (h * 360.0) % 360
+    h = 0.0 if h < 0 else 360.0 if h > 360.0 else h
+    s = 0.0 if s < 0 else 1.0 if s > 1.0 else s
+    l = 0.0 if l < 0 else 1.0 if l > 1.0 else l
     # Convert back to RGB:
-    c = colorsys.hls_to_rgb(c[0] / 360.0, 0.999999 if c[2] == 1 else c[2], 0.999999 if c[1] == 1 else c[1])
+    c = colorsys.hls_to_rgb(h / 360.0, 0.999999 if l == 1 else l, 0.999999 if s == 1 else s)
+    color = ColorValue(color)
     color.value = (c[0] * 255.0, c[1] * 255.0, c[2] * 255.0, color.value[3])
     return color
 
@@ -2211,11 +3003,7 @@ def _complement(color):
     return __hsl_op(operator.__add__, color, 180.0, 0, 0)
 
 
-def _invert(color):
-    """
-    Returns the inverse (negative) of a color.
-    The red, green, and blue values are inverted, while the opacity is left alone.
-    """
+def __invert(color):
     col = ColorValue(color)
     c = list(col.value)
     c[0] = 255.0 - c[0]
@@ -2225,6 +3013,14 @@ def _invert(color):
     return col
 
 
+def _invert(color):
+    """
+    Returns the inverse (negative) of a color.
+    The red, green, and blue values are inverted, while the opacity is left alone.
+    """
+    return __colors(__invert, color)
+
+
 def _adjust_lightness(color, amount):
     return __hsl_op(operator.__add__, color, 0, 0, amount)
 
@@ -2308,11 +3104,18 @@ def _mix(color1, color2, weight=None):
     #
     # Algorithm from the Sass project: http://sass-lang.com/
 
-    c1 = ColorValue(color1).value
-    c2 = ColorValue(color2).value
     p = NumberValue(weight).value if weight is not None else 0.5
     p = 0.0 if p < 0 else 1.0 if p > 1 else p
 
+    if isinstance(color1, ListValue) or isinstance(color2, ListValue):
+        return ListValue._broadcast(color1, color2, lambda c1, c2: __mix(c1, c2, p))
+    return __mix(color1, color2, p)
+
+
+def __mix(color1, color2, p):
+    c1 = ColorValue(color1).value
+    c2 = ColorValue(color2).value
+
     w = p * 2 - 1
     a = c1[3] - c2[3]
 
@@ -2329,47 +3132,38 @@ def _mix(color1, color2, weight=None):
 
 
 def _red(color):
-    c = ColorValue(color).value
-    return NumberValue(c[0])
+    return __colors(lambda c: NumberValue(ColorValue(c).value[0]), color)
 
 
 def _green(color):
-    c = ColorValue(color).value
-    return NumberValue(c[1])
+    return __colors(lambda c: NumberValue(ColorValue(c).value[1]), color)
 
 
 def _blue(color):
-    c = ColorValue(color).value
-    return NumberValue(c[2])
+    return __colors(lambda c: NumberValue(ColorValue(c).value[2]), color)
 
 
 def _alpha(color):
-    c = ColorValue(color).value
-    return NumberValue(c[3])
+    return __colors(lambda c: NumberValue(ColorValue(c).value[3]), color)
 
 
-def _hue(color):
-    c = ColorValue(color).value
-    h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
-    ret = NumberValue(h * 360.0)
-    ret.units = {'deg': _units_weights.get('deg', 1), '_': 'deg'}
+def __hls(color, i, scale, unit):
+    color = color if isinstance(color, ColorValue) else ColorValue(color)
+    ret = NumberValue(color.hls[i] * scale)
+    ret.units = _units_of(unit)
     return ret
 
 
+def _hue(color):
+    return __colors(__hls, color, 0, 360.0, 'deg')
+
+
 def _saturation(color):
-    c = ColorValue(color).value
-    h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
-    ret = NumberValue(s)
-    ret.units = {'%': _units_weights.get('%', 1), '_': '%'}
-    return ret
+    return __colors(__hls, color, 2, 1, '%')
 
 
 def _lightness(color):
-    c = ColorValue(color).value
-    h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
-    ret = NumberValue(l)
-    ret.units = {'%': _units_weights.get('%', 1), '_': '%'}
-    return ret
+    return __colors(__hls, color, 1, 1, '%')
 
 
 def __color_stops(percentages, *args):
@@ -2762,7 +3556,7 @@ def _sprite_map(g, **kwargs):
         collapse_x = NumberValue(kwargs.get('collapse_x', 0))
         collapse_y = NumberValue(kwargs.get('collapse_y', 0))
         if position and position > -1 and position < 1:
-            position.units = {'%': _units_weights.get('%', 1), '_': '%'}
+            position.units = _units_of('%')
 
         dst_colors = kwargs.get('dst_color')
         if isinstance(dst_colors, ListValue):
@@ -2833,7 +3627,7 @@ def _sprite_map(g, **kwargs):
                 else:
                     _position = NumberValue(_position)
                     if _position and _position > -1 and _position < 1:
-                        _position.units = {'%': _units_weights.get('%', 1), '_': '%'}
+                        _position.units = _units_of('%')
                 positions.append(_position)
                 _spacing = kwargs.get(name + '_spacing')
                 if _spacing is None:
@@ -3659,7 +4453,7 @@ def __compass_list(*args):
         separator = ','
     ret = ListValue(args)
     if separator:
-        ret.value['_'] = separator
+        ret.separator = separator
     return ret
 
 
@@ -3669,7 +4463,7 @@ def __compass_space_list(*lst):
     Otherwise it returns a new, single element, space-delimited list.
     """
     ret = __compass_list(*lst)
-    ret.value.pop('_', None)
+    ret.separator = None
     return ret
 
 
@@ -3681,84 +4475,47 @@ def _blank(*objs):
     return BooleanValue(True)
 
 
+def __compact_item(item):
+    if isinstance(item, (basestring, StringValue)):
+        return item != 'false' and not _undefined_re.match(unicode(item))
+    elif isinstance(item, (bool, BooleanValue)):
+        return bool(item)
+    return True
+
+
 def _compact(*args):
     """Returns a new list after removing any non-true values"""
-    ret = {}
     if len(args) == 1:
         args = args[0]
-        if isinstance(args, ListValue):
-            args = args.value
-        if isinstance(args, dict):
-            for i, item in args.items():
-                if isinstance(item, (basestring, StringValue)):
-                    if item != 'false' and not _undefined_re.match(unicode(item)):
-                        ret[i] = item
-                elif isinstance(item, (bool, BooleanValue)):
-                    if bool(item):
-                        ret[i] = item
-                else:
-                    ret[i] = item
-        elif isinstance(args, (basestring, StringValue)):
-            if args != 'false' and not _undefined_re.match(unicode(args)):
-                ret[0] = args
-        elif isinstance(args, (bool, BooleanValue)):
-            if bool(args):
-                ret[0] = args
+        if isinstance(args, (ListValue, dict)):
+            lst = ListValue(args)
         else:
-            ret[0] = args
+            lst = ListValue([args])
     else:
-        ret['_'] = ','
-        for i, item in enumerate(args):
-            if isinstance(item, (basestring, StringValue)):
-                if item != 'false' and not _undefined_re.match(unicode(item)):
-                    ret[i] = item
-            elif isinstance(item, (bool, BooleanValue)):
-                if bool(item):
-                    ret[i] = item
-            else:
-                ret[i] = item
-    if isinstance(args, ListValue):
-        args = args.value
-    if isinstance(args, dict):
-        separator = args.get('_', None)
-        if separator is not None:
-            ret['_'] = separator
-    return ListValue(ret)
+        lst = ListValue(args, ',')
+    return lst._filter(__compact_item)
 
 
 def _reject(lst, *values):
     """Removes the given values from the list"""
-    ret = {}
     if not isinstance(lst, ListValue):
         lst = ListValue(lst)
-    lst = lst.value
     if len(values) == 1:
         values = values[0]
         if isinstance(values, ListValue):
-            values = values.value.values()
+            values = values.values()
         elif not isinstance(values, (list, tuple)):
             values = list(values)
-    for i, item in lst.items():
-        if item not in values:
-            ret[i] = item
-    separator = lst.get('_', None)
-    if separator is not None:
-        ret['_'] = separator
-    return ListValue(ret)
+    return lst._filter(lambda item: item not in values)
 
 
 def __compass_slice(lst, start_index, end_index=None):
     start_index = NumberValue(start_index).value
     end_index = NumberValue(end_index).value if end_index is not None else None
-    ret = {}
-    lst = ListValue(lst).value
-    for i, item in lst.items():
-        if not isinstance(i, int):
-            if i == '_':
-                ret[i] = item
-        elif i > start_index and end_index is None or i <= end_index:
-            ret[i] = item
-    return ListValue(ret)
+    lst = ListValue(lst)
+    ret = ListValue(None, lst.separator)
+    ret.value = [item for i, item in enumerate(lst.value) if i > start_index and end_index is None or i <= end_index]
+    return ret
 
 
 def _first_value_of(*lst):
@@ -3784,23 +4541,23 @@ def _nth(lst, n=1):
             n = -1
     try:
         ret = lst[n]
-    except KeyError:
-        lst = [v for k, v in sorted(lst.items()) if isinstance(k, int)]
-        try:
-            ret = lst[n]
-        except:
-            ret = ''
+    except (IndexError, TypeError):
+        ret = ''
     return ret.__class__(ret)
 
 
 def _join(lst1, lst2, separator=None):
     ret = ListValue(lst1)
-    lst2 = ListValue(lst2).value
-    lst_len = len(ret.value)
-    ret.value.update((k + lst_len if isinstance(k, int) else k, v) for k, v in lst2.items())
+    lst2 = ListValue(lst2)
+    ret.value.extend(lst2.value)
+    if lst2.keywords:
+        ret.keywords = dict(ret.keywords)
+        ret.keywords.update(lst2.keywords)
     separator = __parse_separator(separator)
     if separator is not None:
-        ret.value['_'] = separator
+        ret.separator = separator
+    elif lst2.separator is not None:
+        ret.separator = lst2.separator
     return ret
 
 
@@ -3815,26 +4572,26 @@ def _max(*lst):
     if len(lst) == 1 and isinstance(lst[0], (list, tuple, ListValue)):
         lst = ListValue(lst[0]).values()
     lst = ListValue(lst).value
-    return max(lst.values())
+    return max(lst)
 
 
 def _min(*lst):
     if len(lst) == 1 and isinstance(lst[0], (list, tuple, ListValue)):
         lst = ListValue(lst[0]).values()
     lst = ListValue(lst).value
-    return min(lst.values())
+    return min(lst)
 
 
 def _append(lst, val, separator=None):
     separator = __parse_separator(separator)
     ret = ListValue(lst, separator)
-    ret.value[len(ret)] = val
+    ret.value.append(val)
     return ret
 
 
 def _index(lst, val):
-    for i in xrange(len(lst)):
-        if lst.value[i] == val:
+    for i, item in enumerate(ListValue(lst).value):
+        if item == val:
             return NumberValue(i + 1)
     return BooleanValue(False)
 
@@ -3846,7 +4603,7 @@ def _prefixed(prefix, *args):
     to_fnct_str = 'to_' + to_str(prefix).replace('-', '_')
     for arg in args:
         if isinstance(arg, ListValue):
-            for k, iarg in arg.value.items():
+            for iarg in arg:
                 if hasattr(iarg, to_fnct_str):
                     return BooleanValue(True)
         else:
@@ -3857,21 +4614,17 @@ def _prefixed(prefix, *args):
 
 def _prefix(prefix, *args):
     to_fnct_str = 'to_' + to_str(prefix).replace('-', '_')
+
+    def prefixed(arg):
+        to_fnct = getattr(arg, to_fnct_str, None)
+        return to_fnct() if to_fnct else arg
+
     args = list(args)
     for i, arg in enumerate(args):
         if isinstance(arg, ListValue):
-            _value = {}
-            for k, iarg in arg.value.items():
-                to_fnct = getattr(iarg, to_fnct_str, None)
-                if to_fnct:
-                    _value[k] = to_fnct()
-                else:
-                    _value[k] = iarg
-            args[i] = ListValue(_value)
+            args[i] = arg._map(prefixed)
         else:
-            to_fnct = getattr(arg, to_fnct_str, None)
-            if to_fnct:
-                args[i] = to_fnct()
+            args[i] = prefixed(arg)
     if len(args) == 1:
         return args[0]
     return ListValue(args, ',')
@@ -3917,7 +4670,7 @@ def __o(*args):
 
 def _percentage(value):
     value = NumberValue(value)
-    value.units = {'%': _units_weights.get('%', 1), '_': '%'}
+    value.units = _units_of('%')
     return value
 
 
@@ -4129,11 +4882,28 @@ def _inv(sign, value):
 
 
 class ParserValue(object):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
 
+# Values of the literals in the expressions (numbers, booleans and colors),
+# shared by all of them as the values are never modified once they're made
+_literals = {}
+
+
+def _literal(cls, value):
+    try:
+        return _literals[cls, value]
+    except KeyError:
+        ret = _literals[cls, value] = cls(ParserValue(value))
+        return ret
+
+
 class Value(object):
+    __slots__ = ()
+
     @staticmethod
     def _operatorOperands(tokenlist):
         "generator to extract operators and operands in pairs"
@@ -4266,8 +5036,9 @@ class Value(object):
 
 
 class BooleanValue(Value):
+    __slots__ = ('value',)
+
     def __init__(self, tokens):
-        self.tokens = tokens
         if tokens is None:
             self.value = False
         elif isinstance(tokens, ParserValue):
@@ -4303,24 +5074,8 @@ class BooleanValue(Value):
 
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k, v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._broadcast(first, second, op)
 
         first = BooleanValue(first)
         second = BooleanValue(second)
@@ -4336,16 +5091,17 @@ class BooleanValue(Value):
 
 
 class NumberValue(Value):
+    __slots__ = ('value', 'units')
+
     def __init__(self, tokens, type=None):
-        self.tokens = tokens
-        self.units = {}
+        self.units = _no_units
         if tokens is None:
             self.value = 0.0
         elif isinstance(tokens, ParserValue):
             self.value = float(tokens.value)
         elif isinstance(tokens, NumberValue):
             self.value = tokens.value
-            self.units = tokens.units.copy()
+            self.units = tokens.units
             if tokens.units:
                 type = None
         elif isinstance(tokens, (StringValue, basestring)):
@@ -4355,7 +5111,7 @@ class NumberValue(Value):
             try:
                 if tokens and tokens[-1] == '%':
                     self.value = to_float(tokens[:-1]) / 100.0
-                    self.units = {'%': _units_weights.get('%', 1), '_': '%'}
+                    self.units = _units_of('%')
                 else:
                     self.value = to_float(tokens)
             except ValueError:
@@ -4365,10 +5121,10 @@ class NumberValue(Value):
         else:
             raise ValueError("Can't convert to CSS number: %r" % tokens)
         if type is not None:
-            self.units = {type: _units_weights.get(type, 1), '_': type}
+            self.units = _units_of(type)
 
     def __hash__(self):
-        return hash((self.value, frozenset(self.units.items())))
+        return hash((self.value, self.units))
 
     def __repr__(self):
         return '<%s: %s, %s>' % (self.__class__.__name__, repr(self.value), repr(self.units))
@@ -4401,24 +5157,8 @@ class NumberValue(Value):
 
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k, v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._broadcast(first, second, op)
 
         if isinstance(first, basestring):
             first = StringValue(first)
@@ -4436,34 +5176,31 @@ class NumberValue(Value):
                 second = NumberValue(second)
         elif op == operator.__mul__:
             if isinstance(first, NumberValue) and isinstance(second, QuotedStringValue):
-                first.value = int(first.value)
-                val = op(second.value, first.value)
+                val = op(second.value, int(first.value))
                 return second.__class__(val)
             if isinstance(first, QuotedStringValue) and isinstance(second, NumberValue):
-                second.value = int(second.value)
-                val = op(first.value, second.value)
+                val = op(first.value, int(second.value))
                 return first.__class__(val)
 
         if not isinstance(first, NumberValue) or not isinstance(second, NumberValue):
             return op(first.value if isinstance(first, NumberValue) else first, second.value if isinstance(second, NumberValue) else second)
 
+        # The operands can be shared (i.e. literals), they're not modified
         first_unit = first.unit
         second_unit = second.unit
         if op == operator.__add__ or op == operator.__sub__:
             if first_unit == '%' and not second_unit:
-                second.units = {'%': _units_weights.get('%', 1), '_': '%'}
-                second.value /= 100.0
+                second = NumberValue(second.value / 100.0, '%')
             elif first_unit == '%' and second_unit != '%':
                 first = NumberValue(second) * first.value
             elif second_unit == '%' and not first_unit:
-                first.units = {'%': _units_weights.get('%', 1), '_': '%'}
-                first.value /= 100.0
+                first = NumberValue(first.value / 100.0, '%')
             elif second_unit == '%' and first_unit != '%':
                 second = NumberValue(first) * second.value
         elif op == operator.__div__:
             if first_unit and first_unit == second_unit:
-                first.units = {}
-                second.units = {}
+                first = NumberValue(first.value)
+                second = NumberValue(second.value)
 
         val = op(first.value, second.value)
 
@@ -4475,13 +5212,7 @@ class NumberValue(Value):
     def merge(self, obj):
         obj = NumberValue(obj)
         self.value = obj.value
-        for unit, val in obj.units.items():
-            if unit != '_':
-                self.units.setdefault(unit, 0)
-                self.units[unit] += val
-        unit = obj.unit
-        if _units_weights.get(self.units.get('_'), 1) <= _units_weights.get(unit, 1):
-            self.units['_'] = unit
+        self.units = self.units.merge(obj.units)
         return self
 
     def convert_to(self, type):
@@ -4491,43 +5222,37 @@ class NumberValue(Value):
         ret = NumberValue(val)
         if type == 'deg':
             ret.value = ret.value % 360.0
-        ret.units = {type: _units_weights.get(type, 1), '_': type}
+        ret.units = _units_of(type)
         return ret
 
     @property
     def unit(self):
-        unit = ''
-        if self.units:
-            if '_'in self.units:
-                units = self.units.copy()
-                _unit = units.pop('_')
-                units.setdefault(_unit, 0)
-                units[_unit] += _units_weights.get(_unit, 1)  # Give more weight to the first unit ever set
-            else:
-                units = self.units
-            units = sorted(units, key=units.get)
-            while len(units):
-                unit = units.pop()
-                if unit:
-                    break
-        return unit
+        return self.units.unit
 
 
 class ListValue(Value):
+    """
+    List of values: the positional ones (value, a list), the keyword ones
+    (keywords, by their $names) and the separator (None for spaces).
+    """
+    __slots__ = ('value', 'keywords', 'separator')
+
     def __init__(self, tokens, separator=None):
-        self.tokens = tokens
+        keywords = None
+        _separator = None
         if tokens is None:
-            self.value = {}
+            self.value = []
         elif isinstance(tokens, ParserValue):
-            self.value = self._reorder_list(tokens.value)
+            self.value, keywords, _separator = self._from_dict(tokens.value)
         elif isinstance(tokens, ListValue):
-            self.value = tokens.value.copy()
+            self.value = list(tokens.value)
+            keywords, _separator = tokens.keywords, tokens.separator
         elif isinstance(tokens, Value):
-            self.value = {0: tokens}
+            self.value = [tokens]
         elif isinstance(tokens, dict):
-            self.value = self._reorder_list(tokens)
+            self.value, keywords, _separator = self._from_dict(tokens)
         elif isinstance(tokens, (list, tuple)):
-            self.value = dict(enumerate(tokens))
+            self.value = list(tokens)
         else:
             if isinstance(tokens, StringValue):
                 tokens = tokens.value
@@ -4536,17 +5261,24 @@ class ListValue(Value):
             if len(lst) == 1:
                 lst = [i.strip() for i in lst[0].split(',') if i.strip()]
                 if len(lst) > 1:
-                    separator = ',' if separator is None else separator
+                    _separator = ','
                 else:
                     lst = [tokens]
-            self.value = dict(enumerate(lst))
-        if separator is None:
-            separator = self.value.pop('_', None)
-        if separator:
-            self.value['_'] = separator
+            self.value = lst
+        # The keywords are shared by the copies, they're never modified in place
+        self.keywords = keywords or {}
+        self.separator = (_separator if separator is None else separator) or None
+
+    @staticmethod
+    def _from_dict(lst):
+        # Values of a dict list (as made by the parser, i.e. {0: a, 1: b,
+        # '$c': c, '_': ','}): the positional ones in the order of their keys
+        value = [lst[k] for k in sorted(k for k in lst if isinstance(k, int))]
+        keywords = dict((k, v) for k, v in lst.items() if not isinstance(k, int) and k != '_')
+        return value, keywords, lst.get('_')
 
     def __hash__(self):
-        return hash((frozenset(self.value.items())))
+        return hash((tuple(self.value), frozenset(self.keywords.items()), self.separator))
 
     @classmethod
     def _do_cmps(cls, first, second, op):
@@ -4555,56 +5287,77 @@ class ListValue(Value):
             second = ListValue(second)
         except ValueError:
             return op(getattr(first, 'value', first), getattr(second, 'value', second))
-        return op(first.value, second.value)
+        return op((first.value, first.keywords, first.separator), (second.value, second.keywords, second.separator))
 
     @classmethod
     def _do_op(cls, first, second, op):
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._broadcast(first, second, op)
+
+    @staticmethod
+    def _broadcast(first, second, op):
+        """
+        Operation with a list, done item by item (the items of a list without
+        a counterpart in the other list are left as they are).
+        """
         if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
+            n = len(second.value)
+            ret = ListValue(None, first.separator)
+            ret.value = [op(v, second.value[i]) if i < n else v for i, v in enumerate(first.value)]
+            ret.keywords = dict((k, op(v, second.keywords[k]) if k in second.keywords else v) for k, v in first.keywords.items())
             return ret
         if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
+            return first._map(lambda v: op(v, second))
+        return second._map(lambda v: op(first, v))
 
-            for k, v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+    def _map(self, fn):
+        """
+        Copy of the list with fn applied to its items.
+        """
+        ret = ListValue(None, self.separator)
+        ret.value = [fn(v) for v in self.value]
+        if self.keywords:
+            ret.keywords = dict((k, fn(v)) for k, v in self.keywords.items())
+        return ret
 
-    def _reorder_list(self, lst):
-        return dict((i if isinstance(k, int) else k, v) for i, (k, v) in enumerate(sorted(lst.items())))
+    def _filter(self, fn):
+        """
+        Copy of the list with the items for which fn is true.
+        """
+        ret = ListValue(None, self.separator)
+        ret.value = [v for v in self.value if fn(v)]
+        if self.keywords:
+            ret.keywords = dict((k, v) for k, v in self.keywords.items() if fn(v))
+        return ret
 
     def __nonzero__(self):
         return len(self)
 
     def __len__(self):
-        return len(self.value) - (1 if '_' in self.value else 0)
+        return len(self.value) + len(self.keywords)
+
+    def __getitem__(self, i):
+        return self.value[i]
 
     def __str__(self):
-        return to_str(self.value)
+        return ((self.separator or '') + ' ').join(to_str(v) for v in self.values())
 
     def __tuple__(self):
-        return tuple(sorted((k, v) for k, v in self.value.items() if k != '_'))
+        return tuple(self.items())
 
     def __iter__(self):
         return iter(self.values())
 
     def values(self):
-        return zip(*self.items())[1]
+        if self.keywords:
+            return tuple(self.value) + tuple(v for k, v in sorted(self.keywords.items()))
+        return tuple(self.value)
 
     def keys(self):
-        return zip(*self.items())[0]
+        return tuple(range(len(self.value))) + tuple(sorted(self.keywords))
 
     def items(self):
-        return sorted((k, v) for k, v in self.value.items() if k != '_')
+        return list(enumerate(self.value)) + sorted(self.keywords.items())
 
     def first(self):
         for v in self.values():
@@ -4615,7 +5368,13 @@ class ListValue(Value):
         return v
 
 
+# Colors parsed from their text (or the errors parsing them), by the text
+_parsed_colors = {}
+
+
 class ColorValue(Value):
+    __slots__ = ('value', 'types', '_hls')
+
     HEX2RGBA = {
         9: lambda c: (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16), int(c[7:9], 16)),
         7: lambda c: (int(c[1:3], 16), int(c[3:5], 16), int(c[5:7], 16), 1.0),
@@ -4624,18 +5383,19 @@ class ColorValue(Value):
     }
 
     def __init__(self, tokens):
-        self.tokens = tokens
         self.value = (0, 0, 0, 1)
         self.types = {}
+        self._hls = None
         if tokens is None:
             self.value = (0, 0, 0, 1)
+        elif isinstance(tokens, ColorValue):
+            self.value = tokens.value
+            self.types = tokens.types.copy()
+            self._hls = tokens._hls
         elif isinstance(tokens, ParserValue):
             hex = tokens.value
             self.value = self.HEX2RGBA[len(hex)](hex)
             self.types = {'rgba': 1}
-        elif isinstance(tokens, ColorValue):
-            self.value = tokens.value
-            self.types = tokens.types.copy()
         elif isinstance(tokens, NumberValue):
             val = tokens.value
             self.value = (val, val, val, 1)
@@ -4653,44 +5413,78 @@ class ColorValue(Value):
         else:
             if isinstance(tokens, StringValue):
                 tokens = tokens.value
-            tokens = to_str(tokens)
-            tokens.replace(' ', '').lower()
-            if _undefined_re.match(tokens):
-                raise ValueError("Value is not a Color! (%s)" % tokens)
+            color = self._parse(to_str(tokens))
+            self.value = color.value
+            self.types = color.types.copy()
+            self._hls = color._hls
+
+    @staticmethod
+    def _parse(text):
+        """
+        Color of a text (the texts are parsed only once).
+        """
+        try:
+            color = _parsed_colors[text]
+        except KeyError:
             try:
-                self.value = self.HEX2RGBA[len(tokens)](tokens)
-            except:
-                try:
-                    val = to_float(tokens)
-                    self.value = (val, val, val, 1)
-                except ValueError:
-                    try:
-                        type, _, colors = tokens.partition('(')
-                        colors = colors.rstrip(')')
-                        if type in ('rgb', 'rgba'):
-                            c = tuple(colors.split(','))
-                            try:
-                                c = [to_float(c[i]) for i in range(4)]
-                                col = [0.0 if c[i] < 0 else 255.0 if c[i] > 255 else c[i] for i in range(3)]
-                                col += [0.0 if c[3] < 0 else 1.0 if c[3] > 1 else c[3]]
-                                self.value = tuple(col)
-                                self.types = {type: 1}
-                            except:
-                                raise ValueError("Value is not a Color! (%s)" % tokens)
-                        elif type in ('hsl', 'hsla'):
-                            c = colors.split(',')
-                            try:
-                                c = [to_float(c[i]) for i in range(4)]
-                                col = [c[0] % 360.0] / 360.0
-                                col += [0.0 if c[i] < 0 else 1.0 if c[i] > 1 else c[i] for i in range(1, 4)]
-                                self.value = tuple([c * 255.0 for c in colorsys.hls_to_rgb(col[0], 0.999999 if col[2] == 1 else col[2], 0.999999 if col[1] == 1 else col[1])] + [col[3]])
-                                self.types = {type: 1}
-                            except:
-                                raise ValueError("Value is not a Color! (%s)" % tokens)
-                        else:
-                            raise ValueError("Value is not a Color! (%s)" % tokens)
-                    except:
-                        raise ValueError("Value is not a Color! (%s)" % tokens)
+                color = ColorValue._parse_text(text)
+            except ValueError, e:
+                color = e
+            _parsed_colors[text] = color
+        if isinstance(color, ValueError):
+            raise color
+        return color
+
+    @staticmethod
+    def _parse_text(text):
+        if _undefined_re.match(text):
+            raise ValueError("Value is not a Color! (%s)" % text)
+        color = ColorValue(None)
+        try:
+            color.value = ColorValue.HEX2RGBA[len(text)](text)
+            return color
+        except:
+            pass
+        try:
+            val = to_float(text)
+            color.value = (val, val, val, 1)
+            return color
+        except ValueError:
+            pass
+        try:
+            type, _, colors = text.partition('(')
+            colors = colors.rstrip(')')
+            if type in ('rgb', 'rgba'):
+                c = tuple(colors.split(','))
+                c = [to_float(c[i]) for i in range(4)]
+                col = [0.0 if c[i] < 0 else 255.0 if c[i] > 255 else c[i] for i in range(3)]
+                col += [0.0 if c[3] < 0 else 1.0 if c[3] > 1 else c[3]]
+                color.value = tuple(col)
+                color.types = {type: 1}
+                return color
+            elif type in ('hsl', 'hsla'):
+                c = colors.split(',')
+                c = [to_float(c[i]) for i in range(4)]
+                col = [c[0] % 360.0] / 360.0
+                col += [0.0 if c[i] < 0 else 1.0 if c[i] > 1 else c[i] for i in range(1, 4)]
+                color.value = tuple([c * 255.0 for c in colorsys.hls_to_rgb(col[0], 0.999999 if col[2] == 1 else col[2], 0.999999 if col[1] == 1 else col[1])] + [col[3]])
+                color.types = {type: 1}
+                return color
+        except:
+            pass
+        raise ValueError("Value is not a Color! (%s)" % text)
+
+    @property
+    def hls(self):
+        """
+        Hue, lightness and saturation of the color (in [0, 1]), worked out only
+        once for its value.
+        """
+        c = self.value
+        hls = self._hls
+        if hls is None or hls[0] is not c:
+            hls = self._hls = c, colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
+        return hls[1]
 
     def __hash__(self):
         return hash((tuple(self.value), frozenset(self.types.items())))
@@ -4702,10 +5496,10 @@ class ColorValue(Value):
         type = self.type
         c = self.value
         if type == 'hsl' or type == 'hsla' and c[3] == 1:
-            h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
+            h, l, s = self.hls
             return 'hsl(%s, %s%%, %s%%)' % (to_str(h * 360.0), to_str(s * 100.0), to_str(l * 100.0))
         if type == 'hsla':
-            h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
+            h, l, s = self.hls
             return 'hsla(%s, %s%%, %s%%, %s)' % (to_str(h * 360.0), to_str(s * 100.0), to_str(l * 100.0), to_str(c[3]))
         r, g, b = to_str(c[0]), to_str(c[1]), to_str(c[2])
         _, _, r = r.partition('.')
@@ -4730,24 +5524,8 @@ class ColorValue(Value):
 
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k, v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._broadcast(first, second, op)
 
         first = ColorValue(first)
         second = ColorValue(second)
@@ -4787,8 +5565,9 @@ class ColorValue(Value):
 
 
 class QuotedStringValue(Value):
+    __slots__ = ('value',)
+
     def __init__(self, tokens):
-        self.tokens = tokens
         if tokens is None:
             self.value = ''
         elif isinstance(tokens, ParserValue):
@@ -4818,24 +5597,8 @@ class QuotedStringValue(Value):
 
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k, v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k, v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._broadcast(first, second, op)
 
         first = QuotedStringValue(first)
         first_value = first.value
@@ -4857,6 +5620,8 @@ class QuotedStringValue(Value):
 
 
 class StringValue(QuotedStringValue):
+    __slots__ = ()
+
     def __hash__(self):
         return hash((False, self.value))
 
@@ -5060,7 +5825,7 @@ for u in _units:
 
 def interpolate(var, rule):
     context = rule[CONTEXT]
-    value = context.get(var, var)
+    value = force(context.get(var, var))
     if var != value and isinstance(value, basestring):
         _vi = eval_expr(value, rule, True)
         if _vi is not None:
@@ -5069,38 +5834,61 @@ def interpolate(var, rule):
 
 
 def call(name, args, R, is_function=True):
-    C, O = R[CONTEXT], R[OPTIONS]
+    C, N = R[CONTEXT], R[NAMESPACE]
     # Function call:
     _name = name.replace('_', '-')
-    s = args and args.value.items() or []
+    s = args and args.items() or []
     _args = [v for n, v in s if isinstance(n, int)]
-    _kwargs = dict((str(n[1:]).replace('-', '_'), v) for n, v in s if not isinstance(n, int) and n != '_')
+    _kwargs = dict((str(n[1:]).replace('-', '_'), v) for n, v in s if not isinstance(n, int))
     _fn_a = '%s:%d' % (_name, len(_args))
     #print >>sys.stderr, '#', _fn_a, _args, _kwargs
     _fn_n = '%s:n' % _name
     try:
-        fn = O and O.get('@function ' + _fn_a)
+        fn = N and N.lookup('@function', _name, len(_args))
         if fn:
             node = fn(R, *_args, **_kwargs)
         else:
             fn = fnct.get(_fn_a) or fnct[_fn_n]
             node = fn(*_args, **_kwargs)
     except KeyError:
-        sp = args and args.value.get('_') or ''
+        sp = args and args.separator or ''
         if is_function:
             if not _css_functions_re.match(_name):
                 log.error("Required function not found: %s (%s)", _fn_a, R[INDEX][R[LINENO]], extra={'stack': True})
             _args = (sp + ' ').join(to_str(v) for n, v in s if isinstance(n, int))
-            _kwargs = (sp + ' ').join('%s: %s' % (n, to_str(v)) for n, v in s if not isinstance(n, int) and n != '_')
+            _kwargs = (sp + ' ').join('%s: %s' % (n, to_str(v)) for n, v in s if not isinstance(n, int))
             if _args and _kwargs:
                 _args += (sp + ' ')
             # Function not found, simply write it as a string:
             node = StringValue(name + '(' + _args + _kwargs + ')')
         else:
-            node = StringValue((sp + ' ').join(str(v) for n, v in s if n != '_'))
+            node = StringValue((sp + ' ').join(str(v) for n, v in s))
     return node
 
 
+def is_literal(expr):
+    """
+    Whether the expression is its own value, so it doesn't need to be
+    calculated.
+    """
+    return bool(_skip_word_re.match(expr)) and '- ' not in expr and ' and ' not in expr and ' or ' not in expr and 'not ' not in expr
+
+
+# Functions whose result only depends on their arguments, used when folding
+# constant expressions:
+_foldable_functions = frozenset([
+    'abs', 'adjust-color', 'adjust-hue', 'adjust-lightness', 'adjust-saturation',
+    'alpha', 'blue', 'ceil', 'change-color', 'comparable', 'complement',
+    'darken', 'desaturate', 'fade-in', 'fade-out', 'fadein', 'fadeout',
+    'floor', 'grayscale', 'green', 'greyscale', 'hsl', 'hsla', 'hue',
+    'invert', 'lighten', 'lightness', 'max', 'min', 'mix', 'opacify',
+    'opacity', 'percentage', 'red', 'rgb', 'rgba', 'round', 'saturate',
+    'saturation', 'scale-color', 'scale-lightness', 'scale-saturation',
+    'spin', 'transparentize', 'unit', 'unitless',
+])
+
+FOLD_CACHE_SIZE = 64
+fold_cache = OrderedDict()  # Folded code, by the digest of the code
 expr_cache = {}
 def eval_expr(expr, rule, raw=False):
     # print >>sys.stderr, '>>',expr,'<<'
@@ -5114,7 +5902,7 @@ def eval_expr(expr, rule, raw=False):
             chkd = {}
             while expr in rule[CONTEXT] and expr not in chkd:
                 chkd[expr] = 1
-                _expr = rule[CONTEXT][expr]
+                _expr = force(rule[CONTEXT][expr])
                 if _expr == expr:
                     break
                 expr = _expr
@@ -5159,7 +5947,19 @@ class _NoMoreTokens(Exception):
     """
     pass
 
+_backref_re = re.compile(r'\\[1-9]')
+
+
+def _master_regex(alternatives, tokens, flags=0):
+    # Combines the patterns of the tokens as the alternatives of a single
+    # regex, each one in a group; returns it and the token of each group
+    regexp = re.compile('|'.join('(?P<_%d>%s)' % (i, a) for i, a in enumerate(alternatives)), flags)
+    return regexp, dict((regexp.groupindex['_%d' % i], p) for i, p in enumerate(tokens))
+
+
 class _Scanner(object):
+    _masters = None
+
     def __init__(self, patterns, ignore, input=None):
         """
         Patterns is [(terminal,regex)...]
@@ -5183,6 +5983,40 @@ class _Scanner(object):
         self.input = input
         self.pos = 0
 
+    def _master(self, restrict):
+        """
+        Gets the regexes to scan the tokens allowed by restrict (and the
+        ignored ones) with, and the token each one of their groups is for.
+        Usually a single regex, with all the patterns as alternatives (in
+        order, so the first one that matches wins).
+        """
+        if self._masters is None:
+            self._masters = {}
+        key = frozenset(restrict) if restrict else None
+        try:
+            return self._masters[key]
+        except KeyError:
+            pass
+        masters = []
+        alternatives = []
+        tokens = []
+        for p, regexp in self.patterns:
+            if restrict and p not in restrict and p not in self.ignore:
+                continue
+            if regexp.flags or _backref_re.search(regexp.pattern):
+                # Can't be combined with the others, it's tried on its own:
+                if alternatives:
+                    masters.append(_master_regex(alternatives, tokens))
+                    alternatives, tokens = [], []
+                masters.append(_master_regex([regexp.pattern], [p], regexp.flags))
+            else:
+                alternatives.append(regexp.pattern)
+                tokens.append(p)
+        if alternatives:
+            masters.append(_master_regex(alternatives, tokens))
+        self._masters[key] = masters
+        return masters
+
     def __repr__(self):
         """
         Print the last 10 tokens that have been scanned in
@@ -5199,20 +6033,18 @@ class _Scanner(object):
         """
         # Keep looking for a token, ignoring any in self.ignore
         token = None
+        masters = self._master(restrict)
         while True:
             best_pat = None
             # Search the patterns for a match, with earlier
             # tokens in the list having preference
             best_pat_len = 0
-            for p, regexp in self.patterns:
-                # First check to see if we're restricting to this token
-                if restrict and p not in restrict and p not in self.ignore:
-                    continue
+            for regexp, tokens in masters:
                 m = regexp.match(self.input, self.pos)
                 if m:
                     # We got a match
-                    best_pat = p
-                    best_pat_len = len(m.group(0))
+                    best_pat = tokens[m.lastindex]
+                    best_pat_len = m.end() - m.start()
                     break
 
             # If we didn't find anything, raise an error
@@ -5265,8 +6097,8 @@ class _Scanner(object):
         tokens_len = len(self.tokens)
         if i <= tokens_len:
             token = self.tokens[i]
-            self.tokens = self.tokens[:i]
-            self.restrictions = self.restrictions[:i]
+            del self.tokens[i:]
+            del self.restrictions[i:]
             self.pos = token[0]
 
 if not Scanner:
@@ -5280,6 +6112,8 @@ class CachedScanner(Scanner):
     """
     _cache_ = {}
     _goals_ = ['END']
+    cache_hits = 0
+    cache_misses = 0
 
     @classmethod
     def cleanup(cls):
@@ -5288,18 +6122,23 @@ class CachedScanner(Scanner):
     def __init__(self, patterns, ignore, input=None):
         try:
             self._tokens = self._cache_[input]
+            CachedScanner.cache_hits += 1
         except KeyError:
+            if input is not None:
+                CachedScanner.cache_misses += 1
             self._tokens = None
-            self.__tokens = {}
+            self.__tokens = []
             self.__input = input
             super(CachedScanner, self).__init__(patterns, ignore, input)
 
     def reset(self, input):
         try:
             self._tokens = self._cache_[input]
+            CachedScanner.cache_hits += 1
         except KeyError:
+            CachedScanner.cache_misses += 1
             self._tokens = None
-            self.__tokens = {}
+            self.__tokens = []
             self.__input = input
             super(CachedScanner, self).reset(input)
 
@@ -5314,21 +6153,30 @@ class CachedScanner(Scanner):
     def token(self, i, restrict=None):
         if self._tokens is None:
             token = super(CachedScanner, self).token(i, restrict)
-            self.__tokens[i] = token
+            tokens = self.__tokens
+            if i < len(tokens):
+                tokens[i] = token
+            else:
+                # Tokens are (almost always) asked for in order:
+                tokens.extend([None] * (i - len(tokens)))
+                tokens.append(token)
             if token[2] in self._goals_:  # goal tokens
-                self._cache_[self.__input] = self._tokens = self.__tokens
+                self._cache_[self.__input] = self._tokens = tokens
             return token
         else:
-            token = self._tokens.get(i)
-            if token is None:
+            tokens = self._tokens
+            if i >= len(tokens) or tokens[i] is None:
                 raise NoMoreTokens
-            return token
+            return tokens[i]
 
     def rewind(self, i):
         if self._tokens is None:
             super(CachedScanner, self).rewind(i)
 
 
+_scan_restrictions = {}
+
+
 class Parser(object):
     def __init__(self, scanner):
         self._scanner = scanner
@@ -5350,7 +6198,11 @@ class Parser(object):
         """
         Returns the matched text, and moves to the next token
         """
-        tok = self._scanner.token(self._pos, set([type]))
+        try:
+            restrict = _scan_restrictions[type]
+        except KeyError:
+            restrict = _scan_restrictions[type] = frozenset([type])
+        tok = self._scanner.token(self._pos, restrict)
         if tok[2] != type:
             raise SyntaxError("SyntaxError[@ char %s: %s]" % (repr(tok[0]), "Trying to find " + type))
         self._pos += 1
@@ -5406,6 +6258,7 @@ class CalculatorScanner(CachedScanner):
             self.__class__.patterns = []
             for t, p in self._patterns:
                 self.patterns.append((t, re.compile(p)))
+            self.__class__._masters = {}
         super(CalculatorScanner, self).__init__(None, ['[ \r\t\n]+'], input)
 
 
@@ -5554,7 +6407,7 @@ class Calculator(Parser):
             return call(FNCT, v, R)
         elif _token_ == 'NUM':
             NUM = self._scan('NUM')
-            return NumberValue(ParserValue(NUM))
+            return _literal(NumberValue, NUM)
         elif _token_ == 'STR':
             STR = self._scan('STR')
             return StringValue(ParserValue(STR))
@@ -5563,10 +6416,10 @@ class Calculator(Parser):
             return QuotedStringValue(ParserValue(QSTR))
         elif _token_ == 'BOOL':
             BOOL = self._scan('BOOL')
-            return BooleanValue(ParserValue(BOOL))
+            return _literal(BooleanValue, BOOL)
         elif _token_ == 'COLOR':
             COLOR = self._scan('COLOR')
-            return ColorValue(ParserValue(COLOR))
+            return _literal(ColorValue, COLOR)
         else:  # == 'VAR'
             VAR = self._scan('VAR')
             return interpolate(VAR, R)
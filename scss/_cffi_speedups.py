@@ -0,0 +1,242 @@
+"""
+cffi binding of the C core of the speedups (the block locator and the
+scanner), with the same interface as the _speedups extension. It's used where
+the extension can't be (i.e. PyPy); the text processor passes are CPython
+only, their pure Python versions are used instead.
+
+The core is built by scss/src/build_cffi.py.
+"""
+from __future__ import absolute_import
+
+import weakref
+
+from scss._cffi_core import ffi, lib
+
+lib.BlockLocator_initialize()
+lib.Scanner_initialize(ffi.NULL, 0)
+
+# Counters of the work done. The ones of the scanners are added to them when
+# they are asked for, or when the scanners are gone (as the C calls can run
+# without the GIL, they are collected in Python)
+_stats = dict.fromkeys(('locate_calls', 'blocks_located', 'bytes_located', 'scanner_resets', 'bytes_scanned', 'tokens_scanned', 'patterns_tried'), 0)
+_scanners = weakref.WeakSet()
+
+
+def _collect_locator(locator):
+    stats = locator.stats
+    _stats['locate_calls'] += stats.calls
+    _stats['blocks_located'] += stats.blocks
+    _stats['bytes_located'] += stats.bytes
+    stats.calls = stats.blocks = stats.bytes = 0
+
+
+def _collect_scanner(scanner):
+    stats = scanner.stats
+    _stats['scanner_resets'] += stats.resets
+    _stats['bytes_scanned'] += stats.bytes
+    _stats['tokens_scanned'] += stats.tokens
+    _stats['patterns_tried'] += stats.matches
+    stats.resets = stats.bytes = stats.tokens = stats.matches = 0
+
+
+def _del_scanner(scanner):
+    _collect_scanner(scanner)
+    lib.Scanner_del(scanner)
+
+
+def stats(reset=False):
+    """
+    Counters of the work done (blocks located, tokens scanned, etc.), resets
+    them if asked to.
+    """
+    for scanner in list(_scanners):
+        _collect_scanner(scanner._scanner)
+    result = dict(_stats)
+    if reset:
+        _stats.update(dict.fromkeys(_stats, 0))
+    return result
+
+
+class NoMoreTokens(Exception):
+    pass
+
+
+def _input(obj):
+    # Gets the object whose buffer is to be used in place (unicode is encoded as UTF-8)
+    if isinstance(obj, unicode):
+        obj = obj.encode('utf-8')
+    try:
+        return obj, ffi.from_buffer(obj)
+    except TypeError:
+        raise TypeError("expected string or buffer")
+
+
+def locate_blocks(codestr, lineno=None):
+    """
+    Locate Scss blocks (returns the tree of blocks).
+    """
+    # The blocks refer to the code by their offsets in it (it's not copied)
+    codestr, buf = _input(codestr)
+    locator = lib.BlockLocator_new(buf, len(buf), -1 if lineno is None else lineno)
+    if locator == ffi.NULL:
+        raise MemoryError
+    try:
+        blocks_sz = ffi.new('int *')
+        blocks = lib.BlockLocator_locate(locator, blocks_sz)
+        if blocks == ffi.NULL:
+            raise MemoryError
+        _collect_locator(locator)
+        try:
+            result = children = []
+            stack = []
+            for i in xrange(blocks_sz[0]):
+                block = blocks[i]
+                if block.error <= 0:
+                    if block.error < 0:
+                        raise Exception(ffi.string(locator.exc))
+                    break
+                if block.type == lib.BLOCK_PROPERTY:
+                    children.append((block.lineno, ffi.unpack(block.selprop, block.selprop_sz), None, codestr, block.start, block.end, block.kind))
+                elif block.type == lib.BLOCK_OPEN:
+                    # frame: (lineno, selectors, start, children, kind)
+                    frame = (block.lineno, ffi.unpack(block.selprop, block.selprop_sz), block.start, [], block.kind)
+                    stack.append(frame)
+                    children = frame[3]
+                elif block.type == lib.BLOCK_CLOSE:
+                    _lineno, _selectors, start, _children, kind = stack.pop()
+                    children = stack[-1][3] if stack else result
+                    # Blocks without selectors are dropped
+                    if _selectors:
+                        children.append((_lineno, _selectors, _children, codestr, start, block.end, kind))
+            return result
+        finally:
+            lib.free(blocks)
+    finally:
+        lib.BlockLocator_del(locator)
+
+
+def _pattern_array(patterns):
+    # Gets the array of patterns (and the strings it points to, which must be
+    # kept alive while it's used)
+    patterns = [p for p in patterns or () if isinstance(p, (tuple, list)) and isinstance(p[0], str) and isinstance(p[1], str)]
+    strings = []
+    _patterns = ffi.new('Pattern[]', len(patterns))
+    for i, (tok, expr) in enumerate(patterns):
+        strings.append(ffi.new('char[]', tok))
+        strings.append(ffi.new('char[]', expr))
+        _patterns[i].tok, _patterns[i].expr = strings[-2], strings[-1]
+    return _patterns, len(patterns), strings
+
+
+class Scanner(object):
+    """
+    Scanner object.
+    """
+    # Restrictions (by their set of tokens) and the names of the tokens (by
+    # the ids of their patterns), looked up only once:
+    _restrictions = {}
+    _toks = {}
+
+    def __init__(self, patterns, ignore, input=None):
+        if not lib.Scanner_initialized():
+            self.setup_patterns(patterns)
+        _patterns, patterns_sz, strings = _pattern_array(patterns if isinstance(patterns, (tuple, list)) else None)
+        ignore = [tok for tok in ignore or () if isinstance(tok, str)] if isinstance(ignore, (tuple, list)) else []
+        _ignore = ffi.new('Pattern[]', len(ignore))
+        for i, tok in enumerate(ignore):
+            strings.append(ffi.new('char[]', tok))
+            _ignore[i].tok = strings[-1]
+        scanner = lib.Scanner_new(_patterns, patterns_sz, _ignore, len(ignore), ffi.NULL, 0)
+        if scanner == ffi.NULL:
+            raise MemoryError
+        self._scanner = ffi.gc(scanner, _del_scanner)
+        self._input = None
+        self.reset(input)
+        _scanners.add(self)
+
+    @staticmethod
+    def setup_patterns(patterns):
+        """
+        Initialize patterns.
+        """
+        if not lib.Scanner_initialized():
+            _patterns, patterns_sz, strings = _pattern_array(patterns if isinstance(patterns, (tuple, list)) else None)
+            lib.Scanner_initialize(_patterns, patterns_sz)
+
+    @staticmethod
+    def jit(enabled=None):
+        """
+        Whether the patterns are JIT compiled, turns the JIT on or off if
+        asked to.
+        """
+        return bool(lib.Scanner_jit(-1 if enabled is None else int(bool(enabled))))
+
+    def reset(self, input=None):
+        """
+        Reset the scanner, to scan input
+        """
+        if input is not None:
+            # The input is scanned in place
+            input, buf = _input(input)
+            lib.Scanner_reset(self._scanner, buf, len(buf))
+            self._input = input, buf
+        else:
+            lib.Scanner_reset(self._scanner, ffi.NULL, 0)
+            self._input = None
+
+    def _restriction(self, restrict):
+        # Gets the restriction for the tokens in restrict (or None)
+        key = frozenset(restrict) if restrict is not None else None
+        try:
+            return self._restrictions[key]
+        except KeyError:
+            pass
+        restriction = ffi.new('Restriction *')
+        lib.Restriction_init(restriction)
+        for tok in key or ():
+            if isinstance(tok, str):
+                lib.Restriction_add(restriction, lib.Pattern_regex(tok, ffi.NULL))
+        self._restrictions[key] = restriction
+        return restriction
+
+    def _tok(self, regex):
+        try:
+            return self._toks[regex.id]
+        except KeyError:
+            tok = self._toks[regex.id] = ffi.string(regex.tok)
+            return tok
+
+    def token(self, i, restrict=None):
+        """
+        Get the nth token
+        """
+        token = lib.Scanner_token(self._scanner, i, self._restriction(restrict))
+        error = int(ffi.cast('long', token))
+        if error < 0:
+            if error == lib.SCANNER_EXC_NO_MORE_TOKENS:
+                raise NoMoreTokens
+            if error == lib.SCANNER_EXC_UNIMPLEMENTED:
+                raise NotImplementedError(ffi.string(self._scanner.exc))
+            if error in (lib.SCANNER_EXC_BAD_TOKEN, lib.SCANNER_EXC_RESTRICTED):
+                raise SyntaxError(ffi.string(self._scanner.exc))
+            raise Exception
+        start = token.string - self._scanner.input
+        end = start + token.string_sz
+        return (start, end, self._tok(token.regex), self._input[0][start:end])
+
+    def rewind(self, i):
+        """
+        Rewind scanner
+        """
+        lib.Scanner_rewind(self._scanner, i)
+
+    def __repr__(self):
+        # Print the last 10 tokens that have been scanned in
+        scanner = self._scanner
+        if not scanner.tokens_sz:
+            return 'None'
+        output = ''
+        for i in xrange(max(scanner.tokens_sz - 10, 0), scanner.tokens_sz):
+            token = scanner.tokens[i]
+            output += "\n  (@%d)  %s  =  %r" % (token.string - scanner.input, self._tok(token.regex), ffi.unpack(token.string, token.string_sz))
+        return output
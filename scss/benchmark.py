@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+Benchmarks the compiler with a generated stylesheet, so the different ways
+of running pyScss can be compared (i.e. CPython with the C speedups against
+PyPy, which uses their cffi binding, or the pure Python block locator and
+scanner)::
+
+    python -mscss.benchmark
+    pypy -mscss.benchmark
+
+"""
+from __future__ import absolute_import
+
+import platform
+import sys
+import threading
+import time
+
+import scss
+from scss import Scss, Scanner, Calculator, CalculatorScanner, spawn_rule
+
+
+_block = '''
+/* block %(i)d */
+.block-%(i)d {
+  margin: $base + %(i)dpx;
+  color: darken($color, %(m)d%%);
+  .inner-%(i)d, .other-%(i)d > a {
+    padding: ($base / 2) ($base * 3);
+    @include box(%(i)dpx);
+    &:hover { color: red; background: lighten(#eee, 5%%); }
+  }
+  // line comment %(i)d
+  font: 12px/1.5 "Helvetica", sans-serif;
+}'''
+
+_expressions = [
+    '10px + 10px',
+    '(10px / 2) (10px * 3)',
+    '12px/1.5 "Helvetica", sans-serif',
+    'darken(#336699, 10%)',
+    '1px solid #336699',
+    'not true and (false or 3 >= 2em)',
+    '-10px, 1em + 2em * 3',
+]
+
+
+def make_stylesheet(blocks):
+    """
+    Makes a stylesheet with the given number of (nested) blocks, using
+    variables, mixins, comments and some math and color functions.
+    """
+    parts = [
+        '@option compress:no;',
+        '$base: 10px;',
+        '$color: #336699;',
+        '@mixin box($w) { width: $w; height: $w * 2; border: 1px solid $color; }',
+    ]
+    for i in range(blocks):
+        parts.append(_block % {'i': i, 'm': i % 20})
+    return '\n'.join(parts)
+
+
+def engine():
+    """
+    Describes the Python implementation and the engine used for scanning.
+    """
+    if scss.locate_blocks is scss._locate_blocks:
+        speedups = 'pure Python'
+    elif scss.locate_blocks.__module__.endswith('_cffi_speedups'):
+        speedups = 'cffi speedups'
+    else:
+        speedups = 'C speedups'
+    return '%s %s (%s)' % (platform.python_implementation(), platform.python_version(), speedups)
+
+
+def scan(scanner, expressions):
+    """
+    Scans the expressions (uncached) with the given calculator scanner;
+    returns the number of tokens scanned.
+    """
+    tokens = 0
+    for expr in expressions:
+        Scanner.reset(scanner, expr)
+        i = 0
+        while Scanner.token(scanner, i)[2] != 'END':
+            i += 1
+        tokens += i + 1
+    return tokens
+
+
+def timeit(fn, repeat, warmup):
+    """
+    Runs fn warmup times (to let JITs kick in) and then repeat times; returns
+    the best and the average times.
+    """
+    for i in range(warmup):
+        fn()
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
+
+
+def threaded(fn, threads):
+    """
+    Makes fn run in the given number of threads at once, to see how the work
+    done without the GIL (i.e. locating the blocks) scales.
+    """
+    def run_threads():
+        workers = [threading.Thread(target=fn) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    return run_threads
+
+
+def jit_available():
+    """
+    Whether the scanner JIT compiles its patterns (and so, whether it can be
+    compared with and without the JIT).
+    """
+    return hasattr(Scanner, 'jit') and Scanner.jit()
+
+
+def run(blocks=200, repeat=10, warmup=5, jit=False, threads=1, out=sys.stdout):
+    """
+    Times the modes; with jit, the scanning ones only, with the scanner
+    patterns JIT compiled and not. With more than one thread, each run is
+    the mode run in all the threads at once.
+    """
+    src = make_stylesheet(blocks)
+    codestr = scss.preprocess(src + '\n', scss._colors, True)[0]
+    css = Scss()
+    rule = spawn_rule(context=css.scss_vars, options=css.scss_opts, namespace=css.namespace)
+
+    expressions = _expressions * blocks
+
+    def locate():
+        scss.locate_blocks(codestr, 1)
+
+    def tokens():
+        return scan(CalculatorScanner(), expressions)
+
+    def calculate():
+        for i in range(blocks):
+            for expr in _expressions:
+                CalculatorScanner.cleanup()
+                p = Calculator(CalculatorScanner())
+                p.reset(expr)
+                p.goal(rule)
+
+    def compile():
+        Scss().compile(src)
+
+    if jit:
+        modes = [('%s, JIT %s' % (name, 'on' if on else 'off'), fn, on)
+                 for name, fn in (('scan', tokens), ('calculate', calculate))
+                 for on in (False, True)]
+    else:
+        modes = [(name, fn, None) for name, fn in (('locate', locate), ('scan', tokens), ('calculate', calculate), ('compile', compile))]
+    width = max(len(name) for name, fn, on in modes)
+
+    print >>out, "%s, %d blocks (%d KB)%s" % (engine(), blocks, len(src) // 1024, ", %d threads" % threads if threads > 1 else "")
+    for name, fn, on in modes:
+        if on is not None:
+            Scanner.jit(on)
+        best, avg = timeit(threaded(fn, threads) if threads > 1 else fn, repeat, warmup)
+        line = "%-*s best: %8.2fms  avg: %8.2fms" % (width + 1, name, best * 1000, avg * 1000)
+        if fn is tokens:
+            line += "  (%.0fk tokens/s)" % (tokens() * threads / best / 1000)
+        print >>out, line
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="Usage: %prog [options]",
+                          description="Benchmarks the Scss compiler.")
+    parser.add_option("-b", "--blocks", type="int", default=200,
+                      help="Number of blocks in the generated stylesheet [default: %default]")
+    parser.add_option("-r", "--repeat", type="int", default=10,
+                      help="Number of timed runs [default: %default]")
+    parser.add_option("-w", "--warmup", type="int", default=5,
+                      help="Number of runs before timing (for JITs to warm up) [default: %default]")
+    parser.add_option("-j", "--jit", action="store_true", default=False,
+                      help="Compare the scanning with and without the scanner patterns JIT compiled")
+    parser.add_option("-t", "--threads", type="int", default=1,
+                      help="Number of threads running each mode at once [default: %default]")
+    (options, args) = parser.parse_args()
+    if options.jit and not jit_available():
+        parser.error("the scanner doesn't JIT compile its patterns")
+    if options.threads < 1:
+        parser.error("there must be at least one thread")
+
+    run(options.blocks, options.repeat, options.warmup, options.jit, options.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,138 +11,82 @@
 #include <Python.h>
 #include "block_locator.h"
 #include "scanner.h"
-
-/* BlockLocator */
-staticforward PyTypeObject scss_BlockLocatorType;
-
-typedef struct {
-	PyObject_HEAD
-	BlockLocator *locator;
-} scss_BlockLocator;
-
-static int
-scss_BlockLocator_init(scss_BlockLocator *self, PyObject *args, PyObject *kwds)
-{
-	char *codestr;
-	int codestr_sz;
-
-	self->locator = NULL;
-
-	if (!PyArg_ParseTuple(args, "s#", &codestr, &codestr_sz)) {
-		return -1;
-	}
-
-	self->locator = BlockLocator_new(codestr, codestr_sz);
-
-	#ifdef DEBUG
-		PySys_WriteStderr("Scss BlockLocator object initialized! (%lu bytes)\n", sizeof(scss_BlockLocator));
-	#endif
-
-	return 0;
-}
-
-static void
-scss_BlockLocator_dealloc(scss_BlockLocator *self)
-{
-	if (self->locator != NULL) BlockLocator_del(self->locator);
-
-	self->ob_type->tp_free((PyObject*)self);
-
-	#ifdef DEBUG
-		PySys_WriteStderr("Scss BlockLocator object destroyed!\n");
-	#endif
-}
-
-scss_BlockLocator*
-scss_BlockLocator_iter(scss_BlockLocator *self)
-{
-	Py_INCREF(self);
-	return self;
-}
-
-PyObject*
-scss_BlockLocator_iternext(scss_BlockLocator *self)
+#include "processor.h"
+
+/* The GIL is released while working on big enough inputs that can't change
+ * meanwhile (for small ones, handing it over costs more than the work) */
+#define NOGIL_MIN_SIZE 8192
+#define BEGIN_NOGIL(nogil) { PyThreadState *_save = (nogil) ? PyEval_SaveThread() : NULL;
+#define END_NOGIL if (_save != NULL) PyEval_RestoreThread(_save); }
+
+/* Counters of the work done, the ones of every locator and scanner are added
+ * to them (holding the GIL) as they are used */
+static BlockLocatorStats scss_locator_stats;
+static ScannerStats scss_scanner_stats;
+
+/* Returns the object whose buffer is to be used in place (a new reference),
+ * setting buf and len to its contents: strings and any other objects with
+ * the buffer interface (such as mmap) are used as they are, unicode is
+ * encoded as UTF-8. Returns NULL on errors */
+static PyObject *
+_scss_input(PyObject *obj, char **buf, Py_ssize_t *len)
 {
-	Block *block;
-
-	if (self->locator != NULL) {
-		block = BlockLocator_iternext(self->locator);
-
-		if (block->error > 0) {
-			return Py_BuildValue(
-				"is#s#",
-				block->lineno,
-				block->selprop,
-				block->selprop_sz,
-				block->codestr,
-				block->codestr_sz
-			);
-		}
+	const void *_buf;
 
-		if (block->error > 0) {
-			PyErr_SetString(PyExc_Exception, self->locator->exc);
+	if (PyUnicode_Check(obj)) {
+		obj = PyUnicode_AsUTF8String(obj);
+		if (obj == NULL) {
 			return NULL;
 		}
+	} else {
+		Py_INCREF(obj);
 	}
-
-	/* Raising of standard StopIteration exception with empty value. */
-	PyErr_SetNone(PyExc_StopIteration);
-	return NULL;
+	if (PyObject_AsReadBuffer(obj, &_buf, len) < 0) {
+		Py_DECREF(obj);
+		PyErr_SetString(PyExc_TypeError, "expected string or buffer");
+		return NULL;
+	}
+	*buf = (char *)_buf;
+	return obj;
 }
 
-/* Type definition */
-
-static PyTypeObject scss_BlockLocatorType = {
-	PyObject_HEAD_INIT(NULL)
-	0,                                         /* ob_size */
-	"scss._BlockLocator",                      /* tp_name */
-	sizeof(scss_BlockLocator),                 /* tp_basicsize */
-	0,                                         /* tp_itemsize */
-	(destructor)scss_BlockLocator_dealloc,     /* tp_dealloc */
-	0,                                         /* tp_print */
-	0,                                         /* tp_getattr */
-	0,                                         /* tp_setattr */
-	0,                                         /* tp_compare */
-	0,                                         /* tp_repr */
-	0,                                         /* tp_as_number */
-	0,                                         /* tp_as_sequence */
-	0,                                         /* tp_as_mapping */
-	0,                                         /* tp_hash  */
-	0,                                         /* tp_call */
-	0,                                         /* tp_str */
-	0,                                         /* tp_getattro */
-	0,                                         /* tp_setattro */
-	0,                                         /* tp_as_buffer */
-	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_ITER, /* tp_flags */
-	"Internal BlockLocator iterator object.",  /* tp_doc */
-	0,                                         /* tp_traverse */
-	0,                                         /* tp_clear */
-	0,                                         /* tp_richcompare */
-	0,                                         /* tp_weaklistoffset */
-	(getiterfunc)scss_BlockLocator_iter,       /* tp_iter: __iter__() method */
-	(iternextfunc)scss_BlockLocator_iternext,  /* tp_iternext: next() method */
-	0,                                         /* tp_methods */
-	0,                                         /* tp_members */
-	0,                                         /* tp_getset */
-	0,                                         /* tp_base */
-	0,                                         /* tp_dict */
-	0,                                         /* tp_descr_get */
-	0,                                         /* tp_descr_set */
-	0,                                         /* tp_dictoffset */
-	(initproc)scss_BlockLocator_init,          /* tp_init */
-};
-
 
 /* Scanner */
 static PyObject *PyExc_scss_NoMoreTokens;
 
+/* Ids of the patterns, by token name */
+static PyObject *scss_pattern_ids;
+
 staticforward PyTypeObject scss_ScannerType;
 
 typedef struct {
 	PyObject_HEAD
 	Scanner *scanner;
+	PyObject *input;  /* The object with the buffer being scanned */
 } scss_Scanner;
 
+/* Sets the input to scan, which is used in place (returns -1 on errors) */
+static int
+_scss_Scanner_set_input(scss_Scanner *self, PyObject *input)
+{
+	char *buf = NULL;
+	Py_ssize_t len = 0;
+
+	if (input != NULL && input != Py_None) {
+		input = _scss_input(input, &buf, &len);
+		if (input == NULL) {
+			return -1;
+		}
+	} else {
+		input = NULL;
+	}
+	Scanner_reset(self->scanner, buf, (int)len);
+	Scanner_collect_stats(self->scanner, &scss_scanner_stats);
+	Py_XDECREF(self->input);
+	self->input = input;
+	return 0;
+}
+
 
 static PyObject *
 scss_Scanner_rewind(scss_Scanner *self, PyObject *args)
@@ -158,37 +102,64 @@ scss_Scanner_rewind(scss_Scanner *self, PyObject *args)
 }
 
 
+/* Gets the restriction for the tokens in the restrictions iterable (a set
+ * of token names, or None). Returns -1 on errors */
+static int
+_scss_Scanner_restriction(PyObject *restrictions, Restriction *restriction)
+{
+	PyObject *iterator, *item, *id;
+	Pattern *regex;
+
+	Restriction_init(restriction);
+	if (restrictions == NULL || restrictions == Py_None) {
+		return 0;
+	}
+	iterator = PyObject_GetIter(restrictions);
+	if (iterator == NULL) {
+		return -1;
+	}
+	while ((item = PyIter_Next(iterator)) != NULL) {
+		if (PyString_Check(item)) {
+			/* The ids of the patterns are looked up by name only once */
+			id = PyDict_GetItem(scss_pattern_ids, item);
+			if (id != NULL) {
+				regex = &Pattern_patterns[PyInt_AS_LONG(id)];
+			} else {
+				regex = Pattern_regex(PyString_AS_STRING(item), NULL);
+				if (regex != NULL) {
+					id = PyInt_FromLong(regex->id);
+					if (id == NULL || PyDict_SetItem(scss_pattern_ids, item, id) < 0) {
+						Py_XDECREF(id);
+						Py_DECREF(item);
+						Py_DECREF(iterator);
+						return -1;
+					}
+					Py_DECREF(id);
+				}
+			}
+			Restriction_add(restriction, regex);
+		}
+		Py_DECREF(item);
+	}
+	Py_DECREF(iterator);
+	return PyErr_Occurred() ? -1 : 0;
+}
+
 static PyObject *
 scss_Scanner_token(scss_Scanner *self, PyObject *args)
 {
-	PyObject *item;
-	int i, is_tuple;
-	long size;
-
 	Token *p_token;
 
 	int token_num;
-	PyObject *restrictions;
-	Pattern *_restrictions = NULL;
-	int restrictions_sz = 0;
+	PyObject *restrictions = NULL;
+	Restriction restriction;
 	if (self->scanner != NULL) {
 		if (PyArg_ParseTuple(args, "i|O", &token_num, &restrictions)) {
-			is_tuple = PyTuple_Check(restrictions);
-			if (is_tuple || PyList_Check(restrictions)) {
-				size = is_tuple ? PyTuple_Size(restrictions) : PyList_Size(restrictions);
-				_restrictions = PyMem_New(Pattern, size);
-				for (i = 0; i < size; ++i) {
-					item = is_tuple ? PyTuple_GetItem(restrictions, i) : PyList_GetItem(restrictions, i);
-					if (PyString_Check(item)) {
-						_restrictions[restrictions_sz].tok = PyString_AsString(item);
-						_restrictions[restrictions_sz].expr = NULL;
-						restrictions_sz++;
-					}
-				}
+			if (_scss_Scanner_restriction(restrictions, &restriction) < 0) {
+				return NULL;
 			}
-			p_token = Scanner_token(self->scanner, token_num, _restrictions, restrictions_sz);
-
-			if (_restrictions != NULL) PyMem_Del(_restrictions);
+			p_token = Scanner_token(self->scanner, token_num, &restriction);
+			Scanner_collect_stats(self->scanner, &scss_scanner_stats);
 
 			if (p_token == (Token *)SCANNER_EXC_BAD_TOKEN) {
 				PyErr_SetString(PyExc_SyntaxError, self->scanner->exc);
@@ -227,12 +198,14 @@ scss_Scanner_token(scss_Scanner *self, PyObject *args)
 static PyObject *
 scss_Scanner_reset(scss_Scanner *self, PyObject *args, PyObject *kwds)
 {
-	char *input = NULL;
-	int input_sz = 0;
+	PyObject *input = NULL;
 
 	if (self->scanner != NULL) {
-		if (PyArg_ParseTuple(args, "|z#", &input, &input_sz)) {
-			Scanner_reset(self->scanner, input, input_sz);
+		if (!PyArg_ParseTuple(args, "|O", &input)) {
+			return NULL;
+		}
+		if (_scss_Scanner_set_input(self, input) < 0) {
+			return NULL;
 		}
 	}
 
@@ -275,6 +248,24 @@ scss_Scanner_setup_patterns(PyObject *self, PyObject *patterns)
 	return (PyObject *)Py_None;
 }
 
+static PyObject *
+scss_Scanner_jit(PyObject *self, PyObject *args)
+{
+	PyObject *enabled = Py_None;
+	int jit = -1;
+
+	if (!PyArg_ParseTuple(args, "|O", &enabled)) {
+		return NULL;
+	}
+	if (enabled != Py_None) {
+		jit = PyObject_IsTrue(enabled);
+		if (jit < 0) {
+			return NULL;
+		}
+	}
+	return PyBool_FromLong(Scanner_jit(jit));
+}
+
 static int
 scss_Scanner_init(scss_Scanner *self, PyObject *args, PyObject *kwds)
 {
@@ -282,17 +273,16 @@ scss_Scanner_init(scss_Scanner *self, PyObject *args, PyObject *kwds)
 	int i, is_tuple, _is_tuple;
 	long size;
 
-	PyObject *patterns, *ignore;
+	PyObject *patterns, *ignore, *input = NULL;
 	Pattern *_patterns = NULL;
 	int patterns_sz = 0;
 	Pattern *_ignore = NULL;
 	int ignore_sz = 0;
-	char *input = NULL;
-	int input_sz = 0;
 
 	self->scanner = NULL;
+	self->input = NULL;
 
-	if (!PyArg_ParseTuple(args, "OO|z#", &patterns, &ignore, &input, &input_sz)) {
+	if (!PyArg_ParseTuple(args, "OO|O", &patterns, &ignore, &input)) {
 		return -1;
 	}
 
@@ -332,11 +322,19 @@ scss_Scanner_init(scss_Scanner *self, PyObject *args, PyObject *kwds)
 		}
 	}
 
-	self->scanner = Scanner_new(_patterns, patterns_sz, _ignore, ignore_sz, input, input_sz);
+	self->scanner = Scanner_new(_patterns, patterns_sz, _ignore, ignore_sz, NULL, 0);
 
 	if (_patterns != NULL) PyMem_Del(_patterns);
 	if (_ignore != NULL) PyMem_Del(_ignore);
 
+	if (self->scanner == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	if (_scss_Scanner_set_input(self, input) < 0) {
+		return -1;
+	}
+
 	#ifdef DEBUG
 		PySys_WriteStderr("Scss Scanner object initialized! (%lu bytes)\n", sizeof(scss_Scanner));
 	#endif
@@ -438,6 +436,7 @@ static void
 scss_Scanner_dealloc(scss_Scanner *self)
 {
 	if (self->scanner != NULL) Scanner_del(self->scanner);
+	Py_XDECREF(self->input);
 
 	self->ob_type->tp_free((PyObject*)self);
 
@@ -451,6 +450,7 @@ static PyMethodDef scss_Scanner_methods[] = {
 	{"token", (PyCFunction)scss_Scanner_token, METH_VARARGS, "Get the nth token"},
 	{"rewind", (PyCFunction)scss_Scanner_rewind, METH_VARARGS, "Rewind scanner"},
 	{"setup_patterns", (PyCFunction)scss_Scanner_setup_patterns, METH_O | METH_STATIC, "Initialize patterns."},
+	{"jit", (PyCFunction)scss_Scanner_jit, METH_VARARGS | METH_STATIC, "Whether the patterns are JIT compiled, turns the JIT on or off if asked to."},
 	{NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -500,21 +500,373 @@ static PyTypeObject scss_ScannerType = {
 static PyObject *
 scss_locate_blocks(PyObject *self, PyObject *args)
 {
-	scss_BlockLocator *result = NULL;
+	PyObject *codestr, *py_lineno = Py_None, *result, *stack, *frame, *children, *node;
+	BlockLocator *locator;
+	Block *blocks, *block;
+	char *buf;
+	Py_ssize_t len;
+	int lineno = -1, blocks_sz, i;
+
+	if (!PyArg_ParseTuple(args, "O|O", &codestr, &py_lineno)) {
+		return NULL;
+	}
+	if (py_lineno != Py_None) {
+		lineno = (int)PyInt_AsLong(py_lineno);
+		if (lineno == -1 && PyErr_Occurred()) {
+			return NULL;
+		}
+	}
+	/* The blocks refer to the code by their offsets in it (it's not copied) */
+	codestr = _scss_input(codestr, &buf, &len);
+	if (codestr == NULL) {
+		return NULL;
+	}
 
-	result = PyObject_New(scss_BlockLocator, &scss_BlockLocatorType);
-	if (result) {
-		scss_BlockLocator_init(result, args, NULL);
+	locator = BlockLocator_new(buf, (int)len, lineno);
+	if (locator == NULL) {
+		Py_DECREF(codestr);
+		return PyErr_NoMemory();
 	}
 
-	return (PyObject *)result;
+	/* Blocks are all located first (strings are immutable, so their blocks
+	 * can be located without the GIL), the tree is built afterwards */
+	BEGIN_NOGIL(PyString_CheckExact(codestr) && len >= NOGIL_MIN_SIZE)
+	blocks = BlockLocator_locate(locator, &blocks_sz);
+	END_NOGIL
+	BlockLocator_collect_stats(locator, &scss_locator_stats);
+	if (blocks == NULL) {
+		BlockLocator_del(locator);
+		Py_DECREF(codestr);
+		return PyErr_NoMemory();
+	}
+
+	result = PyList_New(0);
+	stack = PyList_New(0);
+	children = result;
+
+	for (i = 0; i < blocks_sz && result != NULL && stack != NULL; i++) {
+		block = &blocks[i];
+		if (block->error <= 0) {
+			if (block->error < 0) {
+				PyErr_SetString(PyExc_Exception, locator->exc);
+				Py_CLEAR(result);
+			}
+			break;
+		}
+		node = NULL;
+		if (block->type == BLOCK_PROPERTY) {
+			node = Py_BuildValue(
+				"(is#OOiii)",
+				block->lineno,
+				block->selprop,
+				block->selprop_sz,
+				Py_None,
+				codestr,
+				block->start,
+				block->end,
+				block->kind
+			);
+			if (node == NULL || PyList_Append(children, node) < 0) {
+				Py_CLEAR(result);
+			}
+		} else if (block->type == BLOCK_OPEN) {
+			/* frame: (lineno, selectors, start, children, kind) */
+			frame = Py_BuildValue(
+				"(is#iNi)",
+				block->lineno,
+				block->selprop,
+				block->selprop_sz,
+				block->start,
+				PyList_New(0),
+				block->kind
+			);
+			if (frame == NULL || PyList_Append(stack, frame) < 0) {
+				Py_CLEAR(result);
+			} else {
+				children = PyTuple_GET_ITEM(frame, 3);
+			}
+			Py_XDECREF(frame);
+		} else if (block->type == BLOCK_CLOSE) {
+			frame = PySequence_GetItem(stack, -1);
+			if (frame == NULL || PySequence_DelItem(stack, -1) < 0) {
+				Py_XDECREF(frame);
+				Py_CLEAR(result);
+				break;
+			}
+			children = PyList_GET_SIZE(stack) ? PyTuple_GET_ITEM(PyList_GET_ITEM(stack, PyList_GET_SIZE(stack) - 1), 3) : result;
+			/* Blocks without selectors are dropped */
+			if (PyString_GET_SIZE(PyTuple_GET_ITEM(frame, 1))) {
+				node = Py_BuildValue(
+					"(OOOOOiO)",
+					PyTuple_GET_ITEM(frame, 0),
+					PyTuple_GET_ITEM(frame, 1),
+					PyTuple_GET_ITEM(frame, 3),
+					codestr,
+					PyTuple_GET_ITEM(frame, 2),
+					block->end,
+					PyTuple_GET_ITEM(frame, 4)
+				);
+				if (node == NULL || PyList_Append(children, node) < 0) {
+					Py_CLEAR(result);
+				}
+			}
+			Py_DECREF(frame);
+		}
+		Py_XDECREF(node);
+	}
+
+	Py_XDECREF(stack);
+	free(blocks);
+	BlockLocator_del(locator);
+	Py_DECREF(codestr);
+
+	return result;
+}
+
+
+/* Text processor */
+
+/* Returns the bytes of the string (for unicode, its UTF-8 encoding, which is
+ * safe to process as all the characters looked for are ASCII) */
+static PyObject *
+_processor_bytes(PyObject *string)
+{
+	if (PyUnicode_Check(string)) {
+		return PyUnicode_AsUTF8String(string);
+	} else if (PyString_Check(string)) {
+		Py_INCREF(string);
+		return string;
+	}
+	PyErr_SetString(PyExc_TypeError, "expected string");
+	return NULL;
+}
+
+/* Returns the processed text, of the same type as the original string */
+static PyObject *
+_processor_result(PyObject *string, char *str, Py_ssize_t len)
+{
+	if (PyUnicode_Check(string)) {
+		return PyUnicode_DecodeUTF8(str, len, NULL);
+	}
+	return PyString_FromStringAndSize(str, len);
+}
+
+/* Runs a pass (unless a previous one failed), its result is the input of
+ * the next one */
+#define PROCESSOR_PASS(call) \
+	if (!failed) { \
+		if ((call) < 0) { \
+			failed = 1; \
+		} else { \
+			str = buffers[current].str; \
+			len = buffers[current].len; \
+			current = !current; \
+		} \
+	}
+
+/* Sets the exception for a failed pass (if it's not set, it ran out of memory) */
+#define PROCESSOR_ERROR() \
+	if (!PyErr_Occurred()) PyErr_NoMemory();
+
+static PyObject *
+scss_preprocess(PyObject *self, PyObject *args)
+{
+	PyObject *string, *codestr, *colors, *lines = NULL, *result = NULL;
+	TextBuffer buffers[2];
+	char *str;
+	Py_ssize_t len;
+	int number_lines = 0, current = 0, failed = 0;
+
+	if (!PyArg_ParseTuple(args, "OO!|i", &string, &PyDict_Type, &colors, &number_lines)) {
+		return NULL;
+	}
+	codestr = _processor_bytes(string);
+	if (codestr == NULL) {
+		return NULL;
+	}
+	str = PyString_AS_STRING(codestr);
+	len = PyString_GET_SIZE(codestr);
+	if (TextBuffer_init(&buffers[0], len * 2) < 0) {
+		Py_DECREF(codestr);
+		return PyErr_NoMemory();
+	}
+	if (TextBuffer_init(&buffers[1], len * 2) < 0) {
+		TextBuffer_del(&buffers[0]);
+		Py_DECREF(codestr);
+		return PyErr_NoMemory();
+	}
+
+	/* The passes that only work on the text run without the GIL */
+	BEGIN_NOGIL(len >= NOGIL_MIN_SIZE)
+	if (number_lines) {
+		PROCESSOR_PASS(Processor_number_lines(str, len, &buffers[current], 1));
+	}
+	PROCESSOR_PASS(Processor_remove_empty_lines(str, len, &buffers[current]));
+	PROCESSOR_PASS(Processor_protect_strings(str, len, &buffers[current]));
+	PROCESSOR_PASS(Processor_remove_comments(str, len, &buffers[current]));
+	PROCESSOR_PASS(Processor_remove_line_comments(str, len, &buffers[current]));
+	PROCESSOR_PASS(Processor_restore_strings(str, len, &buffers[current]));
+	PROCESSOR_PASS(Processor_fix_braces_space(str, len, &buffers[current]));
+	END_NOGIL
+	PROCESSOR_PASS(Processor_replace_colors(str, len, &buffers[current], colors, 0));
+	if (failed) {
+		PROCESSOR_ERROR();
+		goto error;
+	}
+	if (number_lines) {
+		/* The lines were numbered to keep track of them while processing,
+		 * take the numbers out of the code: */
+		lines = PyList_New(0);
+		if (lines == NULL) {
+			goto error;
+		}
+		PROCESSOR_PASS(Processor_extract_lines(str, len, &buffers[current], lines));
+		if (failed) {
+			PROCESSOR_ERROR();
+			goto error;
+		}
+	} else {
+		lines = Py_None;
+		Py_INCREF(lines);
+	}
+	result = _processor_result(string, str, len);
+	if (result != NULL) {
+		result = Py_BuildValue("(NO)", result, lines);
+	}
+
+error:
+	Py_XDECREF(lines);
+	TextBuffer_del(&buffers[0]);
+	TextBuffer_del(&buffers[1]);
+	Py_DECREF(codestr);
+	return result;
+}
+
+static PyObject *
+scss_postprocess(PyObject *self, PyObject *args)
+{
+	PyObject *string, *codestr, *reverse_colors, *result = NULL;
+	TextBuffer buffers[2];
+	char *str;
+	Py_ssize_t len;
+	int short_colors, compress, current = 0, failed = 0;
+
+	if (!PyArg_ParseTuple(args, "OOii", &string, &reverse_colors, &short_colors, &compress)) {
+		return NULL;
+	}
+	if (reverse_colors != Py_None && !PyDict_Check(reverse_colors)) {
+		PyErr_SetString(PyExc_TypeError, "expected a table of colors or None");
+		return NULL;
+	}
+	codestr = _processor_bytes(string);
+	if (codestr == NULL) {
+		return NULL;
+	}
+	str = PyString_AS_STRING(codestr);
+	len = PyString_GET_SIZE(codestr);
+	if (TextBuffer_init(&buffers[0], len) < 0) {
+		Py_DECREF(codestr);
+		return PyErr_NoMemory();
+	}
+	if (TextBuffer_init(&buffers[1], len) < 0) {
+		TextBuffer_del(&buffers[0]);
+		Py_DECREF(codestr);
+		return PyErr_NoMemory();
+	}
+
+	BEGIN_NOGIL(len >= NOGIL_MIN_SIZE)
+	if (short_colors) {
+		PROCESSOR_PASS(Processor_short_colors(str, len, &buffers[current]));
+	}
+	END_NOGIL
+	if (reverse_colors != Py_None) {
+		PROCESSOR_PASS(Processor_replace_colors(str, len, &buffers[current], reverse_colors, 1));
+	}
+	BEGIN_NOGIL(len >= NOGIL_MIN_SIZE)
+	if (compress) {
+		PROCESSOR_PASS(Processor_zero_units(str, len, &buffers[current]));
+		PROCESSOR_PASS(Processor_zero_decimals(str, len, &buffers[current]));
+	}
+	END_NOGIL
+	if (failed) {
+		PROCESSOR_ERROR();
+		goto error;
+	}
+	result = _processor_result(string, str, len);
+
+error:
+	TextBuffer_del(&buffers[0]);
+	TextBuffer_del(&buffers[1]);
+	Py_DECREF(codestr);
+	return result;
+}
+
+static PyObject *
+scss_replace_colors(PyObject *self, PyObject *args)
+{
+	PyObject *string, *codestr, *table, *result = NULL;
+	TextBuffer buffer;
+	int lower = 0;
+
+	if (!PyArg_ParseTuple(args, "OO!|i", &string, &PyDict_Type, &table, &lower)) {
+		return NULL;
+	}
+	codestr = _processor_bytes(string);
+	if (codestr == NULL) {
+		return NULL;
+	}
+	if (TextBuffer_init(&buffer, PyString_GET_SIZE(codestr)) == 0) {
+		if (Processor_replace_colors(PyString_AS_STRING(codestr), PyString_GET_SIZE(codestr), &buffer, table, lower) == 0) {
+			result = _processor_result(string, buffer.str, buffer.len);
+		} else {
+			PROCESSOR_ERROR();
+		}
+		TextBuffer_del(&buffer);
+	} else {
+		PyErr_NoMemory();
+	}
+	Py_DECREF(codestr);
+	return result;
+}
+
+
+/* Counters */
+
+static PyObject *
+scss_stats(PyObject *self, PyObject *args)
+{
+	PyObject *result;
+	int reset = 0;
+
+	if (!PyArg_ParseTuple(args, "|i", &reset)) {
+		return NULL;
+	}
+	result = Py_BuildValue(
+		"{s:l,s:l,s:l,s:l,s:l,s:l,s:l}",
+		"locate_calls", scss_locator_stats.calls,
+		"blocks_located", scss_locator_stats.blocks,
+		"bytes_located", scss_locator_stats.bytes,
+		"scanner_resets", scss_scanner_stats.resets,
+		"bytes_scanned", scss_scanner_stats.bytes,
+		"tokens_scanned", scss_scanner_stats.tokens,
+		"patterns_tried", scss_scanner_stats.matches
+	);
+	if (result != NULL && reset) {
+		memset(&scss_locator_stats, 0, sizeof(BlockLocatorStats));
+		memset(&scss_scanner_stats, 0, sizeof(ScannerStats));
+	}
+	return result;
 }
 
 
 /* Module functions */
 
 static PyMethodDef scss_methods[] = {
-	{"locate_blocks", (PyCFunction)scss_locate_blocks, METH_VARARGS, "Locate Scss blocks."},
+	{"locate_blocks", (PyCFunction)scss_locate_blocks, METH_VARARGS, "Locate Scss blocks (returns the tree of blocks)."},
+	{"replace_colors", (PyCFunction)scss_replace_colors, METH_VARARGS, "Replace the colors found in the table (returns the new string)."},
+	{"preprocess", (PyCFunction)scss_preprocess, METH_VARARGS, "Preprocess Scss code (removes comments, etc.), returns it with its lines numbers."},
+	{"postprocess", (PyCFunction)scss_postprocess, METH_VARARGS, "Post process the generated CSS (short colors, zero units, etc.)"},
+	{"stats", (PyCFunction)scss_stats, METH_VARARGS, "Counters of the work done (blocks located, tokens scanned, etc.), resets them if asked to."},
 	{NULL, NULL, 0, NULL}        /* Sentinel */
 };
 
@@ -526,10 +878,6 @@ init_speedups(void)
 {
 	PyObject* m;
 
-	scss_BlockLocatorType.tp_new = PyType_GenericNew;
-	if (PyType_Ready(&scss_BlockLocatorType) < 0)
-		return;
-
 	scss_ScannerType.tp_new = PyType_GenericNew;
 	if (PyType_Ready(&scss_ScannerType) < 0)
 		return;
@@ -539,8 +887,7 @@ init_speedups(void)
 
 	m = Py_InitModule("_speedups", scss_methods);
 
-	Py_INCREF(&scss_BlockLocatorType);
-	PyModule_AddObject(m, "_BlockLocator", (PyObject *)&scss_BlockLocatorType);
+	scss_pattern_ids = PyDict_New();
 
 	Py_INCREF(&scss_ScannerType);
 	PyModule_AddObject(m, "Scanner", (PyObject *)&scss_ScannerType);
@@ -8,39 +8,66 @@
 * MIT license (http://www.opensource.org/licenses/mit-license.php)
 * Copyright (c) 2011 German M. Bravo (Kronuz), All rights reserved.
 */
-#include <Python.h>
+#include "memory.h"
 
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <strings.h>
+#include <ctype.h>
 #include "block_locator.h"
 
-int _strip(char *begin, char *end, int *lineno) {
-	// "    1\0     some,    \n  2\0 aca  "
+/* Directives, in the same order as scss.DIRECTIVES (the kind of a directive
+ * block is KIND_DIRECTIVE plus its index) */
+static const char *directives[] = {
+	"@warn", "@print", "@raw", "@dump_context", "@dump_options", "@debug",
+	"@option", "@content", "@import", "@extend", "@return", "@include",
+	"@mixin", "@function", "@if", "@else if", "@else", "@for", "@each",
+	"@variables", "@vars", "@media",
+	NULL
+};
+#define DIRECTIVE_ELSE_IF 15
+
+static int
+_classify(char *selprop, int selprop_sz) {
+	int i, len;
+
+	if (selprop_sz == 0) {
+		return KIND_PLAIN;
+	}
+	switch (*selprop) {
+		case '@':
+			if (selprop_sz >= 9 && strncmp(selprop, "@else if ", 9) == 0) {
+				return KIND_DIRECTIVE + DIRECTIVE_ELSE_IF;
+			}
+			for (len = 0; len < selprop_sz && !isspace((unsigned char)selprop[len]); len++);
+			for (i = 0; directives[i] != NULL; i++) {
+				if ((int)strlen(directives[i]) == len && strncasecmp(directives[i], selprop, len) == 0) {
+					return KIND_DIRECTIVE + i;
+				}
+			}
+			return KIND_AT_RULE;
+		case '+':
+			return KIND_INCLUDE_SHORT;
+		case '=':
+			return KIND_MIXIN_SHORT;
+	}
+	return KIND_PLAIN;
+}
+
+int _strip(char *begin, char *end, char *write) {
+	// "    some,    \n   aca  " -> "some,\naca"
+	// (written to write, if given)
 	int _cnt,
 		cnt = 0,
 		pass = 1,
 		addnl = 0;
 	char c,
-		*line = NULL,
 		*first = begin,
-		*last = begin,
-		*write = lineno ? begin : NULL;
+		*last = begin;
 	while (begin < end) {
 		c = *begin;
-		if (c == '\0') {
-			if (lineno && line == NULL) {
-				line = first - 1;
-				do {
-					c = *++line;
-				} while (c == ' ' || c == '\t' || c == '\n' || c == ';');
-				if (c != '\0') {
-					sscanf(line, "%d", lineno);
-				}
-			}
-			first = last = begin + 1;
-			pass = 1;
-		} else if (c == '\n') {
+		if (c == '\n') {
 			_cnt = (int)(last - first);
 			if (_cnt > 0) {
 				cnt += _cnt + addnl;
@@ -86,6 +113,82 @@ int _strip(char *begin, char *end, int *lineno) {
 
 typedef void _BlockLocator_Callback(BlockLocator*);
 
+/* Returns the line (id) where the selector or property between begin and end
+ * starts. Newlines are counted from the last line asked for */
+static int
+_BlockLocator_lineno(BlockLocator *self, char *begin, char *end) {
+	char *pos = begin, *nl, c;
+
+	if (self->lineno < 0) {
+		return 0;
+	}
+	while (pos < end) {
+		c = *pos;
+		if (c != ' ' && c != '\t' && c != '\n' && c != '\r' && c != '\v' && c != '\f' && c != ';') {
+			break;
+		}
+		pos++;
+	}
+	if (pos < self->line_ptr) {
+		self->line_ptr = self->codestr;
+		self->line = self->lineno;
+	}
+	while ((nl = memchr(self->line_ptr, '\n', pos - self->line_ptr)) != NULL) {
+		self->line++;
+		self->line_ptr = nl + 1;
+	}
+	self->line_ptr = pos;
+	return self->line;
+}
+
+/* Gets the selector or property between begin and end, stripped (the code
+ * is never modified, it's written to the selprops buffer, which is reused once
+ * the blocks queued are returned). Returns its length, -1 if out of memory */
+static int
+_BlockLocator_selprop(BlockLocator *self, char *begin, char *end, char **selprop) {
+	char *selprops;
+	int i, len, sz = self->selprops_len + (int)(end - begin);
+
+	if (sz > self->selprops_sz) {
+		selprops = self->selprops;
+		MEM_RESIZE(selprops, char, sz + 256);
+		if (selprops == NULL) {
+			self->block.error = -1;
+			sprintf(self->exc, "Out of memory while locating blocks");
+			return -1;
+		}
+		// Blocks already queued point to the old buffer:
+		for (i = self->dequeued; i < self->queued; i++) {
+			if (self->queue[i].selprop != NULL) {
+				self->queue[i].selprop = selprops + (self->queue[i].selprop - self->selprops);
+			}
+		}
+		self->selprops = selprops;
+		self->selprops_sz = sz + 256;
+	}
+	*selprop = self->selprops + self->selprops_len;
+	len = _strip(begin, end, *selprop);
+	self->selprops_len += len;
+	return len;
+}
+
+static void
+_BlockLocator_emit(BlockLocator *self, int type, int lineno, char *selprop, int selprop_sz, char *start, char *end) {
+	Block *block = &self->queue[self->queued++];
+
+	block->error = 1;
+	block->type = type;
+	block->kind = _classify(selprop, selprop_sz);
+	block->lineno = lineno;
+	block->selprop = selprop;
+	block->selprop_sz = selprop_sz;
+	block->start = (int)(start - self->codestr);
+	block->end = (int)(end - self->codestr);
+	if (type != BLOCK_CLOSE) {
+		self->stats.blocks++;
+	}
+}
+
 static void
 _BlockLocator_start_string(BlockLocator *self) {
 	#ifdef DEBUG
@@ -128,50 +231,76 @@ _BlockLocator_end_parenthesis(BlockLocator *self) {
 }
 
 static void
-_BlockLocator_flush_properties(BlockLocator *self) {
-	int len, lineno = -1;
+_BlockLocator_flush_properties(BlockLocator *self, char *end) {
+	int len, lineno;
+	char *selprop;
 
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
 	// Flush properties
-	if (self->lose <= self->init) {
-		len = _strip(self->lose, self->init, &lineno);
+	if (self->lose <= end) {
+		lineno = _BlockLocator_lineno(self, self->lose, end);
+		len = _BlockLocator_selprop(self, self->lose, end, &selprop);
+		if (len < 0) {
+			return;
+		}
 		if (len) {
-			if (lineno != -1) {
-				self->lineno = lineno;
-			}
-
-			self->block.selprop = self->lose;
-			self->block.selprop_sz = len;
-			self->block.codestr = NULL;
-			self->block.codestr_sz = 0;
-			self->block.lineno = self->lineno;
-			self->block.error = 1;
+			_BlockLocator_emit(self, BLOCK_PROPERTY, lineno, selprop, len, self->lose, end);
 		}
-		self->lose = self->init;
+		self->lose = end;
 	}
 }
 
 static void
 _BlockLocator_start_block1(BlockLocator *self) {
+	int len, lineno;
+	char *selprop;
+	BlockFrame *frames;
+
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
 	// Start block:
 	if (self->codestr_ptr > self->codestr && *(self->codestr_ptr - 1) == '#') {
+		// Do not process #{...} as blocks!
 		self->skip = 1;
-	} else {
-		self->start = self->codestr_ptr;
-		if (self->thin != NULL && _strip(self->thin, self->codestr_ptr, NULL)) {
-			self->init = self->thin;
+		return;
+	}
+	if (self->thin != NULL && _strip(self->thin, self->codestr_ptr, NULL)) {
+		self->init = self->thin;
+	}
+	_BlockLocator_flush_properties(self, self->init);
+	if (self->block.error < 0) {
+		return;
+	}
+
+	if (self->depth == self->frames_sz) {
+		frames = self->frames;
+		MEM_RESIZE(frames, BlockFrame, self->frames_sz + 16);
+		if (frames == NULL) {
+			self->block.error = -1;
+			sprintf(self->exc, "Out of memory while locating blocks");
+			return;
 		}
-		_BlockLocator_flush_properties(self);
-		self->thin = NULL;
+		self->frames = frames;
+		self->frames_sz += 16;
 	}
+
+	lineno = _BlockLocator_lineno(self, self->init, self->codestr_ptr);
+	len = _BlockLocator_selprop(self, self->init, self->codestr_ptr, &selprop);
+	if (len < 0) {
+		return;
+	}
+	_BlockLocator_emit(self, BLOCK_OPEN, lineno, selprop, len, self->codestr_ptr + 1, self->codestr_ptr + 1);
+
+	// Nested blocks are located in their own (fresh) frame:
+	self->frames[self->depth].start = self->codestr_ptr + 1;
 	self->depth++;
+	self->thin = NULL;
+	self->init = self->safe = self->lose = self->codestr_ptr + 1;
 }
 
 static void
@@ -180,38 +309,29 @@ _BlockLocator_start_block(BlockLocator *self) {
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	// Start block:
-	self->depth++;
+	// Start skipped block:
+	self->skip++;
 }
 
 static void
 _BlockLocator_end_block1(BlockLocator *self) {
-	int len, lineno = -1;
+	BlockFrame *frame;
 
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
 	// Block ends:
-	self->depth--;
-	if (!self->skip) {
-		self->end = self->codestr_ptr;
-		len = _strip(self->init, self->start, &lineno);
-		if (lineno != -1) {
-			self->lineno = lineno;
-		}
+	if (self->depth == 0) {
+		return;
+	}
+	_BlockLocator_flush_properties(self, self->codestr_ptr);
 
-		self->block.selprop = self->init;
-		self->block.selprop_sz = len;
-		self->block.codestr = (self->start + 1);
-		self->block.codestr_sz = (int)(self->end - (self->start + 1));
-		self->block.lineno = self->lineno;
-		self->block.error = 1;
+	frame = &self->frames[--self->depth];
+	_BlockLocator_emit(self, BLOCK_CLOSE, 0, NULL, 0, frame->start, self->codestr_ptr);
 
-		self->init = self->safe = self->lose = self->end + 1;
-		self->thin = NULL;
-	}
-	self->skip = 0;
+	self->init = self->safe = self->lose = self->codestr_ptr + 1;
+	self->thin = NULL;
 }
 
 static void
@@ -220,13 +340,14 @@ _BlockLocator_end_block(BlockLocator *self) {
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	// Block ends:
-	self->depth--;
+	// Skipped block ends:
+	self->skip--;
 }
 
 static void
 _BlockLocator_end_property(BlockLocator *self) {
-	int len, lineno = -1;
+	int len, lineno;
+	char *selprop;
 
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
@@ -235,18 +356,13 @@ _BlockLocator_end_property(BlockLocator *self) {
 	// End of property (or block):
 	self->init = self->codestr_ptr;
 	if (self->lose <= self->init) {
-		len = _strip(self->lose, self->init, &lineno);
+		lineno = _BlockLocator_lineno(self, self->lose, self->init);
+		len = _BlockLocator_selprop(self, self->lose, self->init, &selprop);
+		if (len < 0) {
+			return;
+		}
 		if (len) {
-			if (lineno != -1) {
-				self->lineno = lineno;
-			}
-
-			self->block.selprop = self->lose;
-			self->block.selprop_sz = len;
-			self->block.codestr = NULL;
-			self->block.codestr_sz = 0;
-			self->block.lineno = self->lineno;
-			self->block.error = 1;
+			_BlockLocator_emit(self, BLOCK_PROPERTY, lineno, selprop, len, self->lose, self->init);
 		}
 		self->init = self->safe = self->lose = self->codestr_ptr + 1;
 	}
@@ -283,7 +399,7 @@ _BlockLocator_mark_thin(BlockLocator *self) {
 }
 
 int function_map_initialized = 0;
-_BlockLocator_Callback* scss_function_map[256 * 256 * 2 * 3]; // (c, instr, par, depth)
+_BlockLocator_Callback* scss_function_map[256 * 256 * 2 * 2]; // (c, instr, par, skip)
 
 static void
 init_function_map(void) {
@@ -298,7 +414,7 @@ init_function_map(void) {
 	}
 	function_map_initialized = 1;
 
-	for (i = 0; i < 256 * 256 * 2 * 3; i++) {
+	for (i = 0; i < 256 * 256 * 2 * 2; i++) {
 		scss_function_map[i] = NULL;
 	}
 	scss_function_map[(int)'\"' + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_start_string;
@@ -309,10 +425,6 @@ init_function_map(void) {
 	scss_function_map[(int)'\'' + 256*0 + 256*256*0 + 256*256*2*1] = _BlockLocator_start_string;
 	scss_function_map[(int)'\"' + 256*0 + 256*256*1 + 256*256*2*1] = _BlockLocator_start_string;
 	scss_function_map[(int)'\'' + 256*0 + 256*256*1 + 256*256*2*1] = _BlockLocator_start_string;
-	scss_function_map[(int)'\"' + 256*0 + 256*256*0 + 256*256*2*2] = _BlockLocator_start_string;
-	scss_function_map[(int)'\'' + 256*0 + 256*256*0 + 256*256*2*2] = _BlockLocator_start_string;
-	scss_function_map[(int)'\"' + 256*0 + 256*256*1 + 256*256*2*2] = _BlockLocator_start_string;
-	scss_function_map[(int)'\'' + 256*0 + 256*256*1 + 256*256*2*2] = _BlockLocator_start_string;
 
 	scss_function_map[(int)'\"' + 256*(int)'\"' + 256*256*0 + 256*256*2*0] = _BlockLocator_end_string;
 	scss_function_map[(int)'\'' + 256*(int)'\'' + 256*256*0 + 256*256*2*0] = _BlockLocator_end_string;
@@ -322,28 +434,20 @@ init_function_map(void) {
 	scss_function_map[(int)'\'' + 256*(int)'\'' + 256*256*0 + 256*256*2*1] = _BlockLocator_end_string;
 	scss_function_map[(int)'\"' + 256*(int)'\"' + 256*256*1 + 256*256*2*1] = _BlockLocator_end_string;
 	scss_function_map[(int)'\'' + 256*(int)'\'' + 256*256*1 + 256*256*2*1] = _BlockLocator_end_string;
-	scss_function_map[(int)'\"' + 256*(int)'\"' + 256*256*0 + 256*256*2*2] = _BlockLocator_end_string;
-	scss_function_map[(int)'\'' + 256*(int)'\'' + 256*256*0 + 256*256*2*2] = _BlockLocator_end_string;
-	scss_function_map[(int)'\"' + 256*(int)'\"' + 256*256*1 + 256*256*2*2] = _BlockLocator_end_string;
-	scss_function_map[(int)'\'' + 256*(int)'\'' + 256*256*1 + 256*256*2*2] = _BlockLocator_end_string;
 
 	scss_function_map[(int)'(' + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_start_parenthesis;
 	scss_function_map[(int)'(' + 256*0 + 256*256*1 + 256*256*2*0] = _BlockLocator_start_parenthesis;
 	scss_function_map[(int)'(' + 256*0 + 256*256*0 + 256*256*2*1] = _BlockLocator_start_parenthesis;
 	scss_function_map[(int)'(' + 256*0 + 256*256*1 + 256*256*2*1] = _BlockLocator_start_parenthesis;
-	scss_function_map[(int)'(' + 256*0 + 256*256*0 + 256*256*2*2] = _BlockLocator_start_parenthesis;
-	scss_function_map[(int)'(' + 256*0 + 256*256*1 + 256*256*2*2] = _BlockLocator_start_parenthesis;
 
 	scss_function_map[(int)')' + 256*0 + 256*256*1 + 256*256*2*0] = _BlockLocator_end_parenthesis;
 	scss_function_map[(int)')' + 256*0 + 256*256*1 + 256*256*2*1] = _BlockLocator_end_parenthesis;
-	scss_function_map[(int)')' + 256*0 + 256*256*1 + 256*256*2*2] = _BlockLocator_end_parenthesis;
 
 	scss_function_map[(int)'{' + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_start_block1;
 	scss_function_map[(int)'{' + 256*0 + 256*256*0 + 256*256*2*1] = _BlockLocator_start_block;
-	scss_function_map[(int)'{' + 256*0 + 256*256*0 + 256*256*2*2] = _BlockLocator_start_block;
 
-	scss_function_map[(int)'}' + 256*0 + 256*256*0 + 256*256*2*1] = _BlockLocator_end_block1;
-	scss_function_map[(int)'}' + 256*0 + 256*256*0 + 256*256*2*2] = _BlockLocator_end_block;
+	scss_function_map[(int)'}' + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_end_block1;
+	scss_function_map[(int)'}' + 256*0 + 256*256*0 + 256*256*2*1] = _BlockLocator_end_block;
 
 	scss_function_map[(int)';' + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_end_property;
 
@@ -351,10 +455,6 @@ init_function_map(void) {
 
 	scss_function_map[(int)'\n' + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_mark_thin;
 
-	scss_function_map[0 + 256*0 + 256*256*0 + 256*256*2*0] = _BlockLocator_flush_properties;
-	scss_function_map[0 + 256*0 + 256*256*0 + 256*256*2*1] = _BlockLocator_flush_properties;
-	scss_function_map[0 + 256*0 + 256*256*0 + 256*256*2*2] = _BlockLocator_flush_properties;
-
 	#ifdef DEBUG
 		fprintf(stderr, "\tScss function maps initialized!\n");
 	#endif
@@ -382,7 +482,7 @@ BlockLocator_finalize(void)
 }
 
 BlockLocator *
-BlockLocator_new(char *codestr, int codestr_sz)
+BlockLocator_new(char *codestr, int codestr_sz, int lineno)
 {
 	BlockLocator *self;
 
@@ -390,26 +490,34 @@ BlockLocator_new(char *codestr, int codestr_sz)
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	self = PyMem_New(BlockLocator, 1);
+	self = MEM_NEW(BlockLocator, 1);
 	if (self) {
 		memset(self, 0, sizeof(BlockLocator));
-		self->_codestr = PyMem_New(char, codestr_sz);
-		memcpy(self->_codestr, codestr, codestr_sz);
+		// The code is never copied (nor modified), it must outlive the locator:
+		self->codestr = codestr;
 		self->codestr_sz = codestr_sz;
-		self->codestr = PyMem_New(char, self->codestr_sz);
-		memcpy(self->codestr, self->_codestr, self->codestr_sz);
 		self->codestr_ptr = self->codestr;
-		self->lineno = 0;
+		self->selprops = NULL;
+		self->selprops_sz = 0;
+		self->selprops_len = 0;
+		self->keep_selprops = 0;
+		self->lineno = lineno;
+		self->line = lineno;
+		self->line_ptr = codestr;
 		self->par = 0;
 		self->instr = 0;
-		self->depth = 0;
 		self->skip = 0;
 		self->thin = self->codestr;
 		self->init = self->codestr;
 		self->safe = self->codestr;
 		self->lose = self->codestr;
-		self->start = NULL;
-		self->end = NULL;
+		self->depth = 0;
+		self->frames_sz = 0;
+		self->frames = NULL;
+		self->queued = 0;
+		self->dequeued = 0;
+		self->stats.calls = 1;
+		self->stats.bytes = codestr_sz;
 		#ifdef DEBUG
 			fprintf(stderr, "\tScss BlockLocator object created (%d bytes)!\n", codestr_sz);
 		#endif
@@ -424,39 +532,28 @@ BlockLocator_del(BlockLocator *self)
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	free(self->codestr);
-	free(self->_codestr);
-	free(self);
+	MEM_DEL(self->frames);
+	MEM_DEL(self->selprops);
+	MEM_DEL(self);
 }
 
 void
-BlockLocator_rewind(BlockLocator *self)
+BlockLocator_collect_stats(BlockLocator *self, BlockLocatorStats *total)
 {
-	#ifdef DEBUG
-		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
-	#endif
-
-	free(self->codestr);
-	self->codestr = PyMem_New(char, self->codestr_sz);
-	memcpy(self->codestr, self->_codestr, self->codestr_sz);
-	self->codestr_ptr = self->codestr;
-	self->lineno = 0;
-	self->par = 0;
-	self->instr = 0;
-	self->depth = 0;
-	self->skip = 0;
-	self->thin = self->codestr;
-	self->init = self->codestr;
-	self->safe = self->codestr;
-	self->lose = self->codestr;
-	self->start = NULL;
-	self->end = NULL;
-
-	#ifdef DEBUG
-		fprintf(stderr, "\tScss BlockLocator object rewound!\n");
-	#endif
+	total->calls += self->stats.calls;
+	total->blocks += self->stats.blocks;
+	total->bytes += self->stats.bytes;
+	memset(&self->stats, 0, sizeof(BlockLocatorStats));
 }
 
+/*
+ * Returns the next block event: a property (BLOCK_PROPERTY), the start of a
+ * nested block (BLOCK_OPEN, with its selectors) or its end (BLOCK_CLOSE).
+ * All blocks are located in a single pass, start and end are the offsets of
+ * the code of the block in the original buffer. The selectors (or property)
+ * of a block are only valid until the next call. Returns a block with error
+ * set to zero when done, and a negative one on exceptions.
+ */
 Block*
 BlockLocator_iternext(BlockLocator *self)
 {
@@ -468,80 +565,104 @@ BlockLocator_iternext(BlockLocator *self)
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	memset(&self->block, 0, sizeof(Block));
+	if (self->dequeued < self->queued) {
+		return &self->queue[self->dequeued++];
+	}
+	self->queued = self->dequeued = 0;
+	if (!self->keep_selprops) {
+		self->selprops_len = 0;
+	}
 
 	while (self->codestr_ptr < codestr_end) {
 		c = *(self->codestr_ptr);
-		if (!c) {
-			self->codestr_ptr++;
-			continue;
-		}
-
-		repeat:
-
-		fn = scss_function_map[
-			(int)c +
-			256 * self->instr +
-			256 * 256 * (int)(self->par != 0) +
-			256 * 256 * 2 * (int)(self->depth > 1 ? 2 : self->depth)
-		];
-
-		if (fn != NULL) {
-			fn(self);
+		if (c) {
+			fn = scss_function_map[
+				(int)(unsigned char)c +
+				256 * self->instr +
+				256 * 256 * (int)(self->par != 0) +
+				256 * 256 * 2 * (int)(self->skip != 0)
+			];
+
+			if (fn != NULL) {
+				fn(self);
+			}
 		}
 
 		self->codestr_ptr++;
-		if (self->codestr_ptr > codestr_end) {
-			self->codestr_ptr = codestr_end;
-		}
 
-		if (self->block.error) {
+		if (self->block.error < 0) {
 			#ifdef DEBUG
-				if (self->block.error > 0) {
-					fprintf(stderr, "\tBlock found!\n");
-				} else {
-					fprintf(stderr, "\tException!\n");
-				}
+				fprintf(stderr, "\tException!\n");
 			#endif
 			return &self->block;
 		}
-	}
-	if (self->par > 0) {
-		if (self->block.error >= 0) {
-			self->block.error = -1;
-			sprintf(self->exc, "Missing closing parenthesis somewhere in block");
-			#ifdef DEBUG
-				fprintf(stderr, "\t%s\n", self->exc);
-			#endif
-		}
-	} else if (self->instr != 0) {
-		if (self->block.error >= 0) {
-			self->block.error = -2;
-			sprintf(self->exc, "Missing closing string somewhere in block");
-			#ifdef DEBUG
-				fprintf(stderr, "\t%s\n", self->exc);
-			#endif
-		}
-	} else if (self->depth > 0) {
-		if (self->block.error >= 0) {
-			self->block.error = -3;
-			sprintf(self->exc, "Missing closing string somewhere in block");
+		if (self->queued) {
 			#ifdef DEBUG
-				fprintf(stderr, "\t%s\n", self->exc);
+				fprintf(stderr, "\tBlock found!\n");
 			#endif
+			return &self->queue[self->dequeued++];
 		}
-		if (self->init < codestr_end) {
-			c = '}';
-			goto repeat;
-		}
-	}
-	if (self->init < codestr_end) {
-		self->init = codestr_end;
-		c = 0;
-		goto repeat;
 	}
 
-	BlockLocator_rewind(self);
+	self->codestr_ptr = codestr_end;
+	if (self->depth > 0) {
+		// Blocks never closed are closed at the end of the code:
+		self->skip = 0;
+		_BlockLocator_end_block1(self);
+	} else {
+		_BlockLocator_flush_properties(self, codestr_end);
+	}
+	if (self->queued) {
+		return &self->queue[self->dequeued++];
+	}
 
+	memset(&self->block, 0, sizeof(Block));
 	return &self->block;
 }
+
+/*
+ * Locates all the blocks at once, returns an array with the blocks found (the
+ * last one has error set to zero, or negative on exceptions) and its size in
+ * blocks_sz. It doesn't use the Python API, so it can run without holding the
+ * GIL. Returns NULL if out of memory.
+ */
+Block*
+BlockLocator_locate(BlockLocator *self, int *blocks_sz)
+{
+	Block *blocks = NULL, *_blocks, *block;
+	char *selprops;
+	int sz = 0, bsz = 0;
+
+	#ifdef DEBUG
+		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
+	#endif
+
+	// Selectors and properties are all kept, they are stripped from separate
+	// parts of the code, so all of them fit in the size of the code:
+	selprops = self->selprops;
+	MEM_RESIZE(selprops, char, self->codestr_sz + 1);
+	if (selprops == NULL) {
+		return NULL;
+	}
+	self->selprops = selprops;
+	self->selprops_sz = self->codestr_sz + 1;
+	self->keep_selprops = 1;
+
+	do {
+		block = BlockLocator_iternext(self);
+		if (sz == bsz) {
+			_blocks = blocks;
+			MEM_RESIZE(_blocks, Block, bsz + BLOCK_SIZE_BLOCKS);
+			if (_blocks == NULL) {
+				MEM_DEL(blocks);
+				return NULL;
+			}
+			blocks = _blocks;
+			bsz += BLOCK_SIZE_BLOCKS;
+		}
+		memcpy(&blocks[sz++], block, sizeof(Block));
+	} while (block->error > 0);
+
+	*blocks_sz = sz;
+	return blocks;
+}
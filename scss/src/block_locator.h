@@ -13,40 +13,81 @@
 
 #define MAX_EXC_STRING 200
 
+#define BLOCK_PROPERTY 1
+#define BLOCK_OPEN 2
+#define BLOCK_CLOSE 3
+
+#define BLOCK_QUEUE_SZ 2
+#define BLOCK_SIZE_BLOCKS 256
+
+/* Kinds of blocks (the same as scss.KIND_*) */
+#define KIND_PLAIN 0
+#define KIND_AT_RULE 1
+#define KIND_INCLUDE_SHORT 2
+#define KIND_MIXIN_SHORT 3
+#define KIND_DIRECTIVE 4
+
 typedef struct {
     int error;
+    int type;
+    int kind;
     int lineno;
     char *selprop;
     int selprop_sz;
-    char *codestr;
-    int codestr_sz;
+    int start;
+    int end;
 } Block;
 
+typedef struct {
+    char *start;
+} BlockFrame;
+
+/* Counters of the work done (see BlockLocator_collect_stats) */
+typedef struct {
+    long calls;
+    long blocks;
+    long bytes;
+} BlockLocatorStats;
+
 typedef struct {
     char exc[MAX_EXC_STRING];
-    char *_codestr;
     char *codestr;
     char *codestr_ptr;
     int codestr_sz;
+    char *selprops;
+    int selprops_sz;
+    int selprops_len;
+    int keep_selprops;
     int lineno;
+    char *line_ptr;
+    int line;
     int par;
     char instr;
-    int depth;
     int skip;
     char *thin;
     char *init;
     char *safe;
     char *lose;
-    char *start;
-    char *end;
+    int depth;
+    int frames_sz;
+    BlockFrame *frames;
+    int queued;
+    int dequeued;
+    Block queue[BLOCK_QUEUE_SZ];
     Block block;
+    BlockLocatorStats stats;
 } BlockLocator;
 
 void BlockLocator_initialize(void);
 void BlockLocator_finalize(void);
 
 Block* BlockLocator_iternext(BlockLocator *self);
-BlockLocator *BlockLocator_new(char *codestr, int codestr_sz);
+Block* BlockLocator_locate(BlockLocator *self, int *blocks_sz);
+/* codestr is used in place (not copied), lineno is the line (id) of the start
+ * of the code, or -1 to not track lines */
+BlockLocator *BlockLocator_new(char *codestr, int codestr_sz, int lineno);
 void BlockLocator_del(BlockLocator *self);
+/* Adds the counters of the locator to total (and zeroes them) */
+void BlockLocator_collect_stats(BlockLocator *self, BlockLocatorStats *total);
 
 #endif
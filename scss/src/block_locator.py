@@ -367,18 +367,20 @@ def _locate_blocks_b(codestr):
     (the one between `{` and `}`, which can be nested), or the "lose" code
     (properties) that doesn't have any blocks.
 
-    threshold is the number of blank lines before selectors are broken into
-    pieces (properties).
+    The whole tree is located in a single pass: every block is a tuple
+    (lineno, selectors, children, codestr, start, end), where children is the
+    list of the blocks nested in it (None for properties) and
+    codestr[start:end] is its code.
     """
     lineno = 0
 
     par = 0
     instr = None
-    depth = 0
-    skip = False
+    skip = 0
     thin = None
     i = init = safe = lose = 0
-    start = end = None
+    blocks = []
+    stack = []
 
     for m in _blocks_re.finditer(codestr):
         i = m.start(0)
@@ -396,40 +398,47 @@ def _locate_blocks_b(codestr):
             par -= 1
         elif not par and not instr:
             if c == '{':  # block begins:
-                if depth == 0:
-                    if i > 0 and codestr[i - 1] == '#':  # Do not process #{...} as blocks!
-                        skip = True
-                    else:
-                        start = i
-                        if thin is not None and _strip(codestr[thin:i]):
-                            init = thin
-                        if lose <= init:
-                            _property, lineno = _strip_selprop(codestr[lose:init], lineno)
-                            if _property:
-                                yield lineno, _property, None
-                            lose = init
-                        thin = None
-                depth += 1
+                if skip:
+                    skip += 1
+                elif i > 0 and codestr[i - 1] == '#':  # Do not process #{...} as blocks!
+                    skip = 1
+                else:
+                    if thin is not None and _strip(codestr[thin:i]):
+                        init = thin
+                    if lose < init:
+                        _property, lineno = _strip_selprop(codestr[lose:init], lineno)
+                        if _property:
+                            blocks.append((lineno, _property, None, codestr, lose, init))
+                    _selectors, lineno = _strip_selprop(codestr[init:i], lineno)
+                    stack.append((lineno, _selectors, blocks, i + 1))
+                    # Nested blocks are located in their own (fresh) frame:
+                    lineno = 0
+                    blocks = []
+                    thin = None
+                    init = safe = lose = i + 1
             elif c == '}':  # block ends:
-                if depth > 0:
-                    depth -= 1
-                    if depth == 0:
-                        if not skip:
-                            end = i
-                            _selectors, lineno = _strip_selprop(codestr[init:start], lineno)
-                            _codestr = codestr[start + 1:end].strip()
-                            if _selectors:
-                                yield lineno, _selectors, _codestr
-                            init = safe = lose = end + 1
-                            thin = None
-                        skip = False
-            elif depth == 0:
+                if skip:
+                    skip -= 1
+                elif stack:
+                    for _property in codestr[lose:i].split(';'):
+                        _end = lose + len(_property)
+                        _property, lineno = _strip_selprop(_property, lineno)
+                        if _property:
+                            blocks.append((lineno, _property, None, codestr, lose, _end))
+                        lose = _end + 1
+                    lineno, _selectors, _blocks, start = stack.pop()
+                    if _selectors:
+                        _blocks.append((lineno, _selectors, blocks, codestr, start, i))
+                    blocks = _blocks
+                    init = safe = lose = i + 1
+                    thin = None
+            elif not skip:
                 if c == ';':  # End of property (or block):
                     init = i
-                    if lose <= init:
+                    if lose < init:
                         _property, lineno = _strip_selprop(codestr[lose:init], lineno)
                         if _property:
-                            yield lineno, _property, None
+                            blocks.append((lineno, _property, None, codestr, lose, init))
                         init = safe = lose = i + 1
                     thin = None
                 elif c == ',':
@@ -443,23 +452,21 @@ def _locate_blocks_b(codestr):
                         thin = i + 1
                     elif thin is None and _strip(codestr[safe:i]):
                         thin = i + 1  # Step on thin ice, if it breaks, it breaks here
-    if depth > 0:
-        if not skip:
-            _selectors, lineno = _strip_selprop(codestr[init:start], lineno)
-            _codestr = codestr[start + 1:].strip()
-            if _selectors:
-                yield lineno, _selectors, _codestr
-            if par:
-                raise Exception("Missing closing parenthesis somewhere in block: '%s'" % _selectors)
-            elif instr:
-                raise Exception("Missing closing string somewhere in block: '%s'" % _selectors)
-            else:
-                raise Exception("Block never closed: '%s'" % _selectors)
-    losestr = codestr[lose:]
-    for _property in losestr.split(';'):
+    if stack:
+        _selectors = stack[0][1]
+        if par:
+            raise Exception("Missing closing parenthesis somewhere in block: '%s'" % _selectors)
+        elif instr:
+            raise Exception("Missing closing string somewhere in block: '%s'" % _selectors)
+        else:
+            raise Exception("Block never closed: '%s'" % _selectors)
+    for _property in codestr[lose:].split(';'):
+        _end = lose + len(_property)
         _property, lineno = _strip_selprop(_property, lineno)
         if _property:
-            yield lineno, _property, None
+            blocks.append((lineno, _property, None, codestr, lose, _end))
+        lose = _end + 1
+    return blocks
 
 
 ################################################################################
@@ -514,7 +521,12 @@ verify = '\t--------------------------------------------------------------------
 
 def process_block(locate_blocks, codestr, level=0, dump=False):
     ret = '' if dump else None
-    for lineno, selprop, block in locate_blocks(codestr):
+    if isinstance(codestr, basestring):
+        blocks = locate_blocks(codestr)
+    else:
+        blocks = codestr  # nested blocks already located (single pass)
+    for block in blocks:
+        lineno, selprop, block = block[:3]
         if dump:
             ret += '\t%s\n\t>%s[%s] %s\n' % ('-' * 70, '\t' * level, lineno, repr(selprop))
         if block:
@@ -534,8 +546,8 @@ if __name__ == "__main__":
 
     for locate_blocks, desc in (
         (_locate_blocks_a, "Pure Python, Full algorithm (_locate_blocks_a)"),
-        (_locate_blocks_b, "Pure Python, Condensed algorithm (_locate_blocks_b)"),
-        (_locate_blocks_c, "Builtin C Function, Full algorithm (_locate_blocks_c)"),
+        (_locate_blocks_b, "Pure Python, Condensed single pass algorithm (_locate_blocks_b)"),
+        (_locate_blocks_c, "Builtin C Function, Full single pass algorithm (_locate_blocks_c)"),
     ):
         if locate_blocks:
             ret = process_block(locate_blocks, codestr, dump=True)
@@ -16,7 +16,7 @@ if len(sys.argv) == 1:
 setup(ext_modules=[
     Extension(
         '_speedups',
-        sources=['_speedups.c', 'block_locator.c', 'scanner.c'],
+        sources=['_speedups.c', 'block_locator.c', 'scanner.c', 'processor.c'],
         libraries=['pcre'],
     ),
 ], cmdclass={'build_ext': build_ext})
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+cffi build of the C core (block locator and scanner), for the Python
+implementations that can't load the _speedups extension (i.e. PyPy). The
+binding is in scss/_cffi_speedups.py. setup.py builds it on PyPy, or build it
+in place with::
+
+    python scss/src/build_cffi.py
+
+"""
+import os
+import shutil
+import tempfile
+
+from cffi import FFI
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+ffibuilder = FFI()
+
+ffibuilder.cdef("""
+    #define BLOCK_PROPERTY ...
+    #define BLOCK_OPEN ...
+    #define BLOCK_CLOSE ...
+
+    typedef struct {
+        int error;
+        int type;
+        int kind;
+        int lineno;
+        char *selprop;
+        int selprop_sz;
+        int start;
+        int end;
+        ...;
+    } Block;
+
+    typedef struct {
+        long calls;
+        long blocks;
+        long bytes;
+    } BlockLocatorStats;
+
+    typedef struct {
+        char exc[...];
+        BlockLocatorStats stats;
+        ...;
+    } BlockLocator;
+
+    void BlockLocator_initialize(void);
+    BlockLocator *BlockLocator_new(char *codestr, int codestr_sz, int lineno);
+    Block *BlockLocator_locate(BlockLocator *self, int *blocks_sz);
+    void BlockLocator_del(BlockLocator *self);
+
+    #define SCANNER_EXC_BAD_TOKEN ...
+    #define SCANNER_EXC_RESTRICTED ...
+    #define SCANNER_EXC_UNIMPLEMENTED ...
+    #define SCANNER_EXC_NO_MORE_TOKENS ...
+
+    typedef struct {
+        char *tok;
+        char *expr;
+        int id;
+        ...;
+    } Pattern;
+
+    typedef struct {
+        Pattern *regex;
+        char *string;
+        int string_sz;
+        ...;
+    } Token;
+
+    typedef struct {
+        ...;
+    } Restriction;
+
+    typedef struct {
+        long resets;
+        long bytes;
+        long tokens;
+        long matches;
+    } ScannerStats;
+
+    typedef struct {
+        char exc[...];
+        int tokens_sz;
+        Token *tokens;
+        char *input;
+        ScannerStats stats;
+        ...;
+    } Scanner;
+
+    int Scanner_initialized(void);
+    void Scanner_initialize(Pattern *patterns, int patterns_sz);
+    int Scanner_jit(int jit);
+    Scanner *Scanner_new(Pattern *patterns, int patterns_sz, Pattern *ignore, int ignore_sz, char *input, int input_sz);
+    void Scanner_del(Scanner *self);
+    void Scanner_reset(Scanner *self, char *input, int input_sz);
+    Pattern *Pattern_regex(char *tok, char *expr);
+    void Restriction_init(Restriction *self);
+    void Restriction_add(Restriction *self, Pattern *regex);
+    Token *Scanner_token(Scanner *self, int i, Restriction *restriction);
+    void Scanner_rewind(Scanner *self, int i);
+
+    void free(void *ptr);
+""")
+
+ffibuilder.set_source(
+    'scss._cffi_core',
+    """
+    #include <stdlib.h>
+    #include "block_locator.h"
+    #include "scanner.h"
+    """,
+    sources=[os.path.join(here, 'block_locator.c'), os.path.join(here, 'scanner.c')],
+    include_dirs=[here],
+    define_macros=[('SCSS_CFFI', None)],
+    libraries=['pcre'],
+)
+
+if __name__ == '__main__':
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shutil.copy(ffibuilder.compile(tmpdir=tmpdir), os.path.join(here, '..'))
+    finally:
+        shutil.rmtree(tmpdir)
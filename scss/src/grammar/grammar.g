@@ -10,6 +10,7 @@ StringValue = lambda s: s
 QuotedStringValue = lambda s: s
 BooleanValue = lambda s: bool(s)
 ColorValue = lambda s: s
+_literal = lambda cls, s: cls(ParserValue(s))
 class ListValue():
     def __init__(self, v):
         if isinstance(v, self.__class__):
@@ -128,15 +129,15 @@ parser Calculator:
                                   expr_lst<<R>>             {{ v = expr_lst }}
                               ] RPAR                        {{ return call(FNCT, v, R) }}
                               |
-                              NUM                           {{ return NumberValue(ParserValue(NUM)) }}
+                              NUM                           {{ return _literal(NumberValue, NUM) }}
                               |
                               STR                           {{ return StringValue(ParserValue(STR)) }}
                               |
                               QSTR                          {{ return QuotedStringValue(ParserValue(QSTR)) }}
                               |
-                              BOOL                          {{ return BooleanValue(ParserValue(BOOL)) }}
+                              BOOL                          {{ return _literal(BooleanValue, BOOL) }}
                               |
-                              COLOR                         {{ return ColorValue(ParserValue(COLOR)) }}
+                              COLOR                         {{ return _literal(ColorValue, COLOR) }}
                               |
                               VAR                           {{ return interpolate(VAR, R) }}
     rule expr_lst<<R>>:                                     {{ n = None }}
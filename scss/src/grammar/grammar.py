@@ -10,6 +10,7 @@ StringValue = lambda s: s
 QuotedStringValue = lambda s: s
 BooleanValue = lambda s: bool(s)
 ColorValue = lambda s: s
+_literal = lambda cls, s: cls(ParserValue(s))
 class ListValue():
     def __init__(self, v):
         if isinstance(v, self.__class__):
@@ -233,7 +234,7 @@ class Calculator(Parser):
             return call(FNCT, v, R)
         elif _token_ == 'NUM':
             NUM = self._scan('NUM')
-            return NumberValue(ParserValue(NUM))
+            return _literal(NumberValue, NUM)
         elif _token_ == 'STR':
             STR = self._scan('STR')
             return StringValue(ParserValue(STR))
@@ -242,10 +243,10 @@ class Calculator(Parser):
             return QuotedStringValue(ParserValue(QSTR))
         elif _token_ == 'BOOL':
             BOOL = self._scan('BOOL')
-            return BooleanValue(ParserValue(BOOL))
+            return _literal(BooleanValue, BOOL)
         elif _token_ == 'COLOR':
             COLOR = self._scan('COLOR')
-            return ColorValue(ParserValue(COLOR))
+            return _literal(ColorValue, COLOR)
         else:  # == 'VAR'
             VAR = self._scan('VAR')
             return interpolate(VAR, R)
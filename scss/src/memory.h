@@ -0,0 +1,23 @@
+/*
+* pyScss, a Scss compiler for Python
+* Memory allocation for the C core (block locator and scanner).
+*
+* German M. Bravo (Kronuz) <german.mb@gmail.com>
+* https://github.com/Kronuz/pyScss
+*
+* MIT license (http://www.opensource.org/licenses/mit-license.php)
+* Copyright (c) 2011 German M. Bravo (Kronuz), All rights reserved.
+*/
+#ifndef MEMORY_H
+#define MEMORY_H
+
+/* The core allocates with the C library, not with PyMem_*: the block locator
+ * runs without the GIL (PyMem_* may only be called with it held), and the cffi
+ * binding (built with SCSS_CFFI defined) doesn't link with Python. Memory it
+ * returns (i.e. the located blocks) is freed with free() */
+#include <stdlib.h>
+#define MEM_NEW(type, n) ((type *)malloc((n) * sizeof(type)))
+#define MEM_RESIZE(p, type, n) ((p) = (type *)realloc((p), (n) * sizeof(type)))
+#define MEM_DEL(p) free(p)
+
+#endif
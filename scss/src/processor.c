@@ -0,0 +1,524 @@
+/*
+* pyScss, a Scss compiler for Python
+* SCSS text processor (load_string and post_process passes).
+*
+* German M. Bravo (Kronuz) <german.mb@gmail.com>
+* https://github.com/Kronuz/pyScss
+*
+* MIT license (http://www.opensource.org/licenses/mit-license.php)
+* Copyright (c) 2011 German M. Bravo (Kronuz), All rights reserved.
+*/
+#include <Python.h>
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include "processor.h"
+
+/* Every pass does exactly what the regular expression it replaces in
+ * scss/__init__.py does (\w, \d and \s being ASCII only) */
+
+#define IS_WORD(c) (((c) >= 'a' && (c) <= 'z') || ((c) >= 'A' && (c) <= 'Z') || ((c) >= '0' && (c) <= '9') || (c) == '_')
+#define IS_IDENT(c) (IS_WORD(c) || (c) == '-')
+#define IS_DIGIT(c) ((c) >= '0' && (c) <= '9')
+#define IS_HEX(c) (IS_DIGIT(c) || ((c) >= 'a' && (c) <= 'f') || ((c) >= 'A' && (c) <= 'F'))
+#define IS_BLANK(c) ((c) == ' ' || (c) == '\t' || (c) == '\r' || (c) == '\f' || (c) == '\v')
+#define IS_SPACE(c) (IS_BLANK(c) || (c) == '\n')
+#define TO_LOWER(c) (((c) >= 'A' && (c) <= 'Z') ? (c) + ('a' - 'A') : (c))
+
+/* Safe strings (the same as scss._safe_strings) */
+static const char *safe_strings[][2] = {
+	{"^doubleslash^", "//"},
+	{"^bigcopen^", "/*"},
+	{"^bigcclose^", "*/"},
+	{"^doubledot^", ":"},
+	{"^semicolon^", ";"},
+	{"^curlybracketopen^", "{"},
+	{"^curlybracketclosed^", "}"},
+	{NULL, NULL}
+};
+
+/* Units that can be zeroed (the same as scss._zero_units) */
+static const char *zero_units[] = {
+	"em", "ex", "px", "cm", "mm", "in", "pt", "pc",
+	NULL
+};
+
+
+/* Text buffers (allocated with the C library, they're filled without the GIL) */
+
+int
+TextBuffer_init(TextBuffer *self, Py_ssize_t sz)
+{
+	self->len = 0;
+	self->sz = sz > 0 ? sz : 1;
+	self->str = malloc(self->sz);
+	if (self->str == NULL) {
+		return -1;
+	}
+	return 0;
+}
+
+void
+TextBuffer_del(TextBuffer *self)
+{
+	free(self->str);
+	self->str = NULL;
+	self->len = self->sz = 0;
+}
+
+static int
+_TextBuffer_append(TextBuffer *self, const char *str, Py_ssize_t len)
+{
+	char *str_;
+	if (self->len + len > self->sz) {
+		self->sz = (self->len + len) * 2;
+		str_ = realloc(self->str, self->sz);
+		if (str_ == NULL) {
+			return -1;
+		}
+		self->str = str_;
+	}
+	memcpy(self->str + self->len, str, len);
+	self->len += len;
+	return 0;
+}
+
+#define APPEND(out, str, len) if (_TextBuffer_append(out, str, len) < 0) return -1;
+
+
+/* load_string passes */
+
+/* _nl_re: numbers the lines as "\nN\x00", removing the blanks around them */
+int
+Processor_number_lines(char *str, Py_ssize_t len, TextBuffer *out, long next_id)
+{
+	char id[32];
+	char *end = str + len, *nl;
+
+	out->len = 0;
+	APPEND(out, id, sprintf(id, "%ld%c", next_id++, SEPARATOR));
+	while ((nl = memchr(str, '\n', end - str)) != NULL) {
+		APPEND(out, str, nl - str);
+		while (out->len && IS_BLANK(out->str[out->len - 1])) {
+			out->len--;
+		}
+		APPEND(out, id, sprintf(id, "\n%ld%c", next_id++, SEPARATOR));
+		str = nl + 1;
+		while (str < end && IS_BLANK(*str)) {
+			str++;
+		}
+	}
+	APPEND(out, str, end - str);
+	return 0;
+}
+
+/* _nl_num_nl_re: removes lines having just the line number */
+int
+Processor_remove_empty_lines(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *end = str + len, *copied = str, *nl, *next, *eol;
+
+	out->len = 0;
+	nl = memchr(str, '\n', len);
+	while (nl != NULL) {
+		next = memchr(nl + 1, '\n', end - nl - 1);
+		if (next == NULL) {
+			break;
+		}
+		eol = next;
+		while (eol > nl + 1 && IS_BLANK(eol[-1])) {
+			eol--;
+		}
+		if (eol - nl - 1 >= 2 && eol[-1] == SEPARATOR) {
+			APPEND(out, copied, nl + 1 - copied);
+			copied = next + 1;
+			nl = memchr(copied, '\n', end - copied);
+		} else {
+			nl = next;
+		}
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _strings_re: protects the special characters inside strings */
+int
+Processor_protect_strings(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *end = str + len, *copied = str, *close, *safe;
+	char quote;
+	int i;
+
+	out->len = 0;
+	while (str < end) {
+		quote = *str;
+		if (quote != '"' && quote != '\'') {
+			str++;
+			continue;
+		}
+		close = str + 1;
+		while (close < end && *close != quote && *close != '\n') {
+			close++;
+		}
+		if (close >= end || *close != quote) {
+			str++;
+			continue;
+		}
+		APPEND(out, copied, str + 1 - copied);
+		copied = ++str;
+		while (str < close) {
+			safe = NULL;
+			for (i = 0; safe_strings[i][0] != NULL; i++) {
+				if (safe_strings[i][1][0] == *str && (safe_strings[i][1][1] == '\0' || (str + 1 < close && safe_strings[i][1][1] == str[1]))) {
+					safe = (char *)safe_strings[i][0];
+					break;
+				}
+			}
+			if (safe == NULL) {
+				str++;
+				continue;
+			}
+			APPEND(out, copied, str - copied);
+			APPEND(out, safe, strlen(safe));
+			str += strlen(safe_strings[i][1]);
+			copied = str;
+		}
+		str = close + 1;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _ml_comment_re: removes multiple line comments */
+int
+Processor_remove_comments(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *end = str + len, *copied = str, *close;
+
+	out->len = 0;
+	while ((str = memchr(str, '/', end - str)) != NULL) {
+		if (str + 1 >= end || str[1] != '*') {
+			str++;
+			continue;
+		}
+		close = str + 2;
+		while (close + 1 < end && (close[0] != '*' || close[1] != '/')) {
+			close++;
+		}
+		if (close + 1 >= end) {
+			break;
+		}
+		APPEND(out, copied, str - copied);
+		copied = str = close + 2;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _sl_comment_re: removes inline comments, but not :// (protocol) */
+int
+Processor_remove_line_comments(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *begin = str, *end = str + len, *copied = str;
+
+	out->len = 0;
+	while ((str = memchr(str, '/', end - str)) != NULL) {
+		if (str + 1 >= end || str[1] != '/' ||
+			(str - begin >= 4 && memcmp(str - 4, "url(", 4) == 0 && (str - begin == 4 || !IS_WORD(str[-5]))) ||
+			(str - begin >= 3 && IS_WORD(str[-3]) && IS_WORD(str[-2]) && str[-1] == ':')) {
+			str++;
+			continue;
+		}
+		APPEND(out, copied, str - copied);
+		str = memchr(str, '\n', end - str);
+		if (str == NULL) {
+			str = end;
+		}
+		copied = str;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _safe_strings_re: restores the protected characters */
+int
+Processor_restore_strings(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *end = str + len, *copied = str;
+	size_t safe_len;
+	int i;
+
+	out->len = 0;
+	while ((str = memchr(str, '^', end - str)) != NULL) {
+		for (i = 0; safe_strings[i][0] != NULL; i++) {
+			safe_len = strlen(safe_strings[i][0]);
+			if ((size_t)(end - str) >= safe_len && memcmp(str, safe_strings[i][0], safe_len) == 0) {
+				break;
+			}
+		}
+		if (safe_strings[i][0] == NULL) {
+			str++;
+			continue;
+		}
+		APPEND(out, copied, str - copied);
+		APPEND(out, safe_strings[i][1], strlen(safe_strings[i][1]));
+		copied = str = str + safe_len;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _expand_rules_space_re and _collapse_properties_space_re: leaves a space
+ * before the braces, but none after ':' or '#' */
+int
+Processor_fix_braces_space(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *end = str + len, *copied = str;
+
+	out->len = 0;
+	while ((str = memchr(str, '{', end - str)) != NULL) {
+		APPEND(out, copied, str - copied);
+		while (out->len && IS_SPACE(out->str[out->len - 1])) {
+			out->len--;
+		}
+		if (!out->len || (out->str[out->len - 1] != ':' && out->str[out->len - 1] != '#')) {
+			APPEND(out, " ", 1);
+		}
+		copied = str++;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* Takes the numbers of the lines out, appending them to the lines list (lines
+ * not starting with a number get the number of the previous one) */
+int
+Processor_extract_lines(char *str, Py_ssize_t len, TextBuffer *out, PyObject *lines)
+{
+	PyObject *item;
+	char *end = str + len, *eol, *sep, *digit;
+	long lineno = 1;
+
+	out->len = 0;
+	while (1) {
+		eol = memchr(str, '\n', end - str);
+		if (eol == NULL) {
+			eol = end;
+		}
+		sep = memchr(str, SEPARATOR, eol - str);
+		if (sep != NULL && sep > str) {
+			for (digit = str; digit < sep && IS_DIGIT(*digit); digit++);
+			if (digit == sep) {
+				lineno = strtol(str, NULL, 10);
+				str = sep + 1;
+			}
+		}
+		item = PyInt_FromLong(lineno);
+		if (item == NULL || PyList_Append(lines, item) < 0) {
+			Py_XDECREF(item);
+			return -1;
+		}
+		Py_DECREF(item);
+		APPEND(out, str, eol - str);
+		if (eol == end) {
+			break;
+		}
+		APPEND(out, "\n", 1);
+		str = eol + 1;
+	}
+	return 0;
+}
+
+/* Returns the end of the "rgb(...)" or "rgba(...)" literal at `str` (or NULL) */
+static char *
+_rgb_literal(char *str, char *end)
+{
+	if (end - str < 5 || TO_LOWER(str[0]) != 'r' || TO_LOWER(str[1]) != 'g' || TO_LOWER(str[2]) != 'b') {
+		return NULL;
+	}
+	str += 3;
+	if (TO_LOWER(*str) == 'a') {
+		str++;
+	}
+	if (str >= end || *str++ != '(') {
+		return NULL;
+	}
+	while (str < end && (IS_DIGIT(*str) || *str == ',' || *str == ' ')) {
+		str++;
+	}
+	if (str >= end || *str++ != ')') {
+		return NULL;
+	}
+	if (str < end && IS_IDENT(*str)) {
+		return NULL;
+	}
+	return str;
+}
+
+/* _colors_token_re: replaces the colors (names, hex and rgb literals) found
+ * in the table (looked up in lower case if lower is set) */
+int
+Processor_replace_colors(char *str, Py_ssize_t len, TextBuffer *out, PyObject *table, int lower)
+{
+	PyObject *key, *value;
+	char *begin = str, *end = str + len, *copied = str, *token, *token_end;
+	char first[256], lowered[64];
+	Py_ssize_t pos = 0, size, max_len = 0;
+	int i;
+
+	/* Only tokens that could be in the table are looked up */
+	memset(first, 0, sizeof(first));
+	while (PyDict_Next(table, &pos, &key, &value)) {
+		if (!PyString_Check(key) || !PyString_Check(value)) {
+			PyErr_SetString(PyExc_TypeError, "expected a table of strings");
+			return -1;
+		}
+		size = PyString_GET_SIZE(key);
+		if (size) {
+			first[(unsigned char)TO_LOWER(PyString_AS_STRING(key)[0])] = 1;
+			if (size > max_len) {
+				max_len = size;
+			}
+		}
+	}
+	if (max_len > (Py_ssize_t)sizeof(lowered)) {
+		max_len = sizeof(lowered);
+	}
+
+	out->len = 0;
+	while (str < end) {
+		/* Colors are never preceded by any of these: */
+		if (str > begin && (IS_IDENT(str[-1]) || str[-1] == '.' || str[-1] == '#' || str[-1] == '$')) {
+			str++;
+			continue;
+		}
+		token = str;
+		token_end = _rgb_literal(str, end);
+		if (token_end == NULL) {
+			if (*str == '#' && str + 1 < end && IS_IDENT(str[1])) {
+				str++;
+			}
+			if (!IS_IDENT(*str)) {
+				str++;
+				continue;
+			}
+			while (str < end && IS_IDENT(*str)) {
+				str++;
+			}
+			token_end = str;
+		}
+		str = token_end;
+
+		size = token_end - token;
+		if (size > max_len || !first[(unsigned char)TO_LOWER(*token)]) {
+			continue;
+		}
+		if (lower) {
+			for (i = 0; i < size; i++) {
+				lowered[i] = TO_LOWER(token[i]);
+			}
+			key = PyString_FromStringAndSize(lowered, size);
+		} else {
+			key = PyString_FromStringAndSize(token, size);
+		}
+		if (key == NULL) {
+			return -1;
+		}
+		value = PyDict_GetItem(table, key);
+		Py_DECREF(key);
+		if (value == NULL) {
+			continue;
+		}
+		APPEND(out, copied, token - copied);
+		APPEND(out, PyString_AS_STRING(value), PyString_GET_SIZE(value));
+		copied = str;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+
+/* post_process passes */
+
+/* _short_color_re: converts #RRGGBB to #RGB */
+int
+Processor_short_colors(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *begin = str, *end = str + len, *copied = str;
+	char color[4];
+
+	out->len = 0;
+	while ((str = memchr(str, '#', end - str)) != NULL) {
+		if ((str > begin && IS_WORD(str[-1])) || end - str < 7 ||
+			!IS_HEX(str[1]) || !IS_HEX(str[3]) || !IS_HEX(str[5]) ||
+			TO_LOWER(str[1]) != TO_LOWER(str[2]) || TO_LOWER(str[3]) != TO_LOWER(str[4]) || TO_LOWER(str[5]) != TO_LOWER(str[6]) ||
+			(end - str > 7 && IS_WORD(str[7]))) {
+			str++;
+			continue;
+		}
+		color[0] = '#';
+		color[1] = str[1];
+		color[2] = str[3];
+		color[3] = str[5];
+		APPEND(out, copied, str - copied);
+		APPEND(out, color, 4);
+		copied = str = str + 7;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _zero_units_re: zero units out (i.e. 0px or 0em -> 0) */
+int
+Processor_zero_units(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *begin = str, *end = str + len, *copied = str, *unit;
+	size_t unit_len;
+	int i;
+
+	out->len = 0;
+	while ((str = memchr(str, '0', end - str)) != NULL) {
+		str++;
+		if (str - 1 > begin && IS_WORD(str[-2])) {
+			continue;
+		}
+		for (unit = str; unit < end && IS_WORD(*unit); unit++);
+		unit_len = unit - str;
+		for (i = 0; zero_units[i] != NULL; i++) {
+			if (strlen(zero_units[i]) == unit_len) {
+				for (unit = str; unit < str + unit_len && TO_LOWER(*unit) == zero_units[i][unit - str]; unit++);
+				if (unit == str + unit_len) {
+					break;
+				}
+			}
+		}
+		if (zero_units[i] == NULL) {
+			continue;
+		}
+		APPEND(out, copied, str - copied);
+		copied = str = str + unit_len;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
+
+/* _zero_re: removes zeros before decimal point (i.e. 0.3 -> .3) */
+int
+Processor_zero_decimals(char *str, Py_ssize_t len, TextBuffer *out)
+{
+	char *begin = str, *end = str + len, *copied = str;
+
+	out->len = 0;
+	while ((str = memchr(str, '0', end - str)) != NULL) {
+		if ((str > begin && IS_WORD(str[-1])) || end - str < 3 || str[1] != '.' || !IS_DIGIT(str[2])) {
+			str++;
+			continue;
+		}
+		APPEND(out, copied, str - copied);
+		copied = str + 1;
+		str += 2;
+	}
+	APPEND(out, copied, end - copied);
+	return 0;
+}
@@ -0,0 +1,42 @@
+/*
+* pyScss, a Scss compiler for Python
+* SCSS text processor (load_string and post_process passes).
+*
+* German M. Bravo (Kronuz) <german.mb@gmail.com>
+* https://github.com/Kronuz/pyScss
+*
+* MIT license (http://www.opensource.org/licenses/mit-license.php)
+* Copyright (c) 2011 German M. Bravo (Kronuz), All rights reserved.
+*/
+#ifndef PROCESSOR_H
+#define PROCESSOR_H
+
+/* Separator between the line number and the code (the same as scss.SEPARATOR) */
+#define SEPARATOR '\x00'
+
+typedef struct {
+    char *str;
+    Py_ssize_t len;
+    Py_ssize_t sz;
+} TextBuffer;
+
+int TextBuffer_init(TextBuffer *self, Py_ssize_t sz);
+void TextBuffer_del(TextBuffer *self);
+
+/* Every pass reads str and writes the result to out (returns -1 on errors).
+ * Running out of memory doesn't set the exception, so the passes that don't
+ * take Python objects can run without the GIL */
+int Processor_number_lines(char *str, Py_ssize_t len, TextBuffer *out, long next_id);
+int Processor_remove_empty_lines(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_protect_strings(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_remove_comments(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_remove_line_comments(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_restore_strings(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_fix_braces_space(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_extract_lines(char *str, Py_ssize_t len, TextBuffer *out, PyObject *lines);
+int Processor_replace_colors(char *str, Py_ssize_t len, TextBuffer *out, PyObject *table, int lower);
+int Processor_short_colors(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_zero_units(char *str, Py_ssize_t len, TextBuffer *out);
+int Processor_zero_decimals(char *str, Py_ssize_t len, TextBuffer *out);
+
+#endif
@@ -8,10 +8,11 @@
 * MIT license (http://www.opensource.org/licenses/mit-license.php)
 * Copyright (c) 2011 German M. Bravo (Kronuz), All rights reserved.
 */
-#include <Python.h>
+#include "memory.h"
 
 #include <stdio.h>
 #include <string.h>
+#include <ctype.h>
 #include "scanner.h"
 
 #include "utils.h"
@@ -21,6 +22,77 @@ int Pattern_patterns_bsz = 0;
 Pattern *Pattern_patterns = NULL;
 int Pattern_patterns_initialized = 0;
 
+/* The patterns that can match at a position, by the character there */
+unsigned long Pattern_first[256][PATTERN_SET_SZ];
+
+/* Patterns are studied and JIT compiled, where libpcre supports it. The JIT
+ * can be turned off (or on) with Scanner_jit(), define SCANNER_NO_JIT to have
+ * it off by default */
+#ifdef PCRE_STUDY_JIT_COMPILE
+	#define SCANNER_JIT_OPTIONS PCRE_STUDY_JIT_COMPILE
+	#define pcre_free_extra pcre_free_study
+#else
+	#define SCANNER_JIT_OPTIONS 0
+	#define pcre_free_extra pcre_free
+#endif
+#ifdef SCANNER_NO_JIT
+int Pattern_jit = 0;
+#else
+int Pattern_jit = SCANNER_JIT_OPTIONS != 0;
+#endif
+
+static void
+Pattern_study(Pattern *regex) {
+	const char *errptr;
+
+	if (regex->extra != NULL) {
+		pcre_free_extra(regex->extra);
+	}
+	regex->extra = pcre_study(regex->pattern, Pattern_jit ? SCANNER_JIT_OPTIONS : 0, &errptr);
+}
+
+static void
+Pattern_compile(Pattern *regex) {
+	const char *errptr;
+	const unsigned char *table = NULL;
+	int erroffset, first = -2, c;
+	pcre *p_pattern;
+	pcre_extra *p_extra;
+
+	#ifdef DEBUG
+		fprintf(stderr, "\tpcre_compile %s\n", repr(regex->expr));
+	#endif
+
+	regex->pattern = pcre_compile(regex->expr, PCRE_ANCHORED, &errptr, &erroffset, NULL);
+	if (regex->pattern == NULL) {
+		/* (the pattern never matches) */
+		return;
+	}
+	Pattern_study(regex);
+
+	/* Get the characters a match can start with, libpcre only finds them
+	   out for patterns that are not anchored */
+	p_pattern = pcre_compile(regex->expr, 0, &errptr, &erroffset, NULL);
+	if (p_pattern != NULL) {
+		p_extra = pcre_study(p_pattern, 0, &errptr);
+		pcre_fullinfo(p_pattern, p_extra, PCRE_INFO_FIRSTBYTE, &first);
+		if (first < 0) {
+			pcre_fullinfo(p_pattern, p_extra, PCRE_INFO_FIRSTTABLE, &table);
+		}
+	}
+	for (c = 0; c < 256; c++) {
+		if (table != NULL ? (table[c / 8] & (1 << (c % 8))) :
+			first < 0 || c == first || c == tolower(first) || c == toupper(first)
+		) {
+			PATTERN_SET_ADD(Pattern_first[c], regex->id);
+		}
+	}
+	if (p_pattern != NULL) {
+		if (p_extra != NULL) pcre_free_extra(p_extra);
+		pcre_free(p_pattern);
+	}
+}
+
 Pattern*
 Pattern_regex(char *tok, char *expr) {
 	int j;
@@ -34,16 +106,19 @@ Pattern_regex(char *tok, char *expr) {
 			return &Pattern_patterns[j];
 		}
 	}
-	if (expr) {
+	if (expr && j < MAX_PATTERNS) {
 		if (j >= Pattern_patterns_bsz) {
 			/* Needs to expand block */
 			Pattern_patterns_bsz = Pattern_patterns_bsz + BLOCK_SIZE_PATTERNS;
-			PyMem_Resize(Pattern_patterns, Pattern, Pattern_patterns_bsz);
+			MEM_RESIZE(Pattern_patterns, Pattern, Pattern_patterns_bsz);
 		}
-		Pattern_patterns[j].tok = PyMem_Strdup(tok);
-		Pattern_patterns[j].expr = PyMem_Strdup(expr);
+		Pattern_patterns[j].tok = Mem_Strdup(tok);
+		Pattern_patterns[j].expr = Mem_Strdup(expr);
 		Pattern_patterns[j].pattern = NULL;
+		Pattern_patterns[j].extra = NULL;
+		Pattern_patterns[j].id = j;
 		Pattern_patterns_sz = j + 1;
+		Pattern_compile(&Pattern_patterns[j]);
 		return &Pattern_patterns[j];
 	}
 	return NULL;
@@ -51,28 +126,22 @@ Pattern_regex(char *tok, char *expr) {
 
 static int
 Pattern_match(Pattern *regex, char *string, int string_sz, int start_at, Token *p_token) {
-	int options = PCRE_ANCHORED;
-	const char *errptr;
-	int ret, erroffset, ovector[3];
-	pcre *p_pattern = regex->pattern;
+	int ret, ovector[3];
 
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	if (p_pattern == NULL) {
-		#ifdef DEBUG
-			fprintf(stderr, "\tpcre_compile %s\n", repr(regex->expr));
-		#endif
-		p_pattern = regex->pattern = pcre_compile(regex->expr, options, &errptr, &erroffset, NULL);
+	if (regex->pattern == NULL) {
+		return 0;
 	}
 	ret = pcre_exec(
-		p_pattern,
-		NULL,                  /* no extra data */
+		regex->pattern,
+		regex->extra,          /* studied (or JIT compiled) data */
 		string,
 		string_sz,
 		start_at,
-		PCRE_ANCHORED,         /* default options */
+		0,                     /* (anchored when compiled, the JIT needs it so) */
 		ovector,               /* output vector for substring information */
 		3                      /* number of elements in the output vector */
 	);
@@ -109,7 +178,9 @@ Pattern_initialize(Pattern *patterns, int patterns_sz) {
 static void
 Pattern_setup(Pattern *patterns, int patterns_sz) {
 	int i;
+	#ifdef DEBUG
 	Pattern *regex;
+	#endif
 
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
@@ -119,11 +190,13 @@ Pattern_setup(Pattern *patterns, int patterns_sz) {
 		Pattern_initialize(patterns, patterns_sz);
 	} else {
 		for (i = 0; i < patterns_sz; i++) {
-			regex = Pattern_regex(patterns[i].tok, patterns[i].expr);
 			#ifdef DEBUG
+			regex = Pattern_regex(patterns[i].tok, patterns[i].expr);
 			if (regex) {
 				fprintf(stderr, "\tAdded regex pattern %s: %s\n", repr(regex->tok), repr(regex->expr));
 			}
+			#else
+			Pattern_regex(patterns[i].tok, patterns[i].expr);
 			#endif
 		}
 	}
@@ -139,15 +212,19 @@ Pattern_finalize(void) {
 
 	if (Pattern_patterns_initialized) {
 		for (j = 0; j < Pattern_patterns_sz; j++) {
-			PyMem_Del(Pattern_patterns[j].tok);
-			PyMem_Del(Pattern_patterns[j].expr);
+			MEM_DEL(Pattern_patterns[j].tok);
+			MEM_DEL(Pattern_patterns[j].expr);
+			if (Pattern_patterns[j].extra != NULL) {
+				pcre_free_extra(Pattern_patterns[j].extra);
+			}
 			if (Pattern_patterns[j].pattern != NULL) {
 				pcre_free(Pattern_patterns[j].pattern);
 			}
 		}
-		PyMem_Del(Pattern_patterns);
+		MEM_DEL(Pattern_patterns);
 		Pattern_patterns = NULL;
 		Pattern_patterns_sz = 0;
+		memset(Pattern_first, 0, sizeof(Pattern_first));
 		Pattern_patterns_bsz = 0;
 		Pattern_patterns_initialized = 0;
 	}
@@ -156,20 +233,45 @@ Pattern_finalize(void) {
 /* Scanner */
 
 
+void
+Restriction_init(Restriction *self)
+{
+	memset(self, 0, sizeof(Restriction));
+}
+
+void
+Restriction_add(Restriction *self, Pattern *regex)
+{
+	/* (unknown tokens still restrict the scanning) */
+	self->restricted = 1;
+	if (regex != NULL) {
+		PATTERN_SET_ADD(self->patterns, regex->id);
+	}
+}
+
 static long
-_Scanner_scan(Scanner *self, Pattern *restrictions, int restrictions_sz)
+_Scanner_scan(Scanner *self, Restriction *restriction)
 {
 	Token best_token, *p_token;
-	Restriction *p_restriction;
-	Pattern *regex;
-	int j, k, max, skip;
+	unsigned long allowed[PATTERN_SET_SZ], candidates[PATTERN_SET_SZ];
+	int j;
 
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
+	/* The tokens restricted to, plus the ones ignored */
+	for (j = 0; j < PATTERN_SET_SZ; j++) {
+		allowed[j] = restriction->restricted ? restriction->patterns[j] | self->ignore[j] : ~0UL;
+	}
+
 	while (1) {
 		best_token.regex = NULL;
+		/* Only the patterns that can start with the character at the
+		   position are tried (at the end, all of them) */
+		for (j = 0; j < PATTERN_SET_SZ; j++) {
+			candidates[j] = self->pos < self->input_sz ? allowed[j] & Pattern_first[(unsigned char)self->input[self->pos]][j] : allowed[j];
+		}
 		/* Search the patterns for a match, with earlier
 		   tokens in the list having preference */
 		for (j = 0; j < Pattern_patterns_sz; j++) {
@@ -178,26 +280,13 @@ _Scanner_scan(Scanner *self, Pattern *restrictions, int restrictions_sz)
 				fprintf(stderr, "\tTrying %s: %s at pos %d -> %s\n", repr(regex->tok), repr(regex->expr), self->pos, repr(self->input));
 			#endif
 			/* First check to see if we're restricting to this token */
-			skip = restrictions_sz;
-			if (skip) {
-				max = (restrictions_sz > self->ignore_sz) ? restrictions_sz : self->ignore_sz;
-				for (k = 0; k < max; k++) {
-					if (k < restrictions_sz && regex == Pattern_regex(restrictions[k].tok, restrictions[k].expr)) {
-						skip = 0;
-						break;
-					}
-					if (k < self->ignore_sz && regex == self->ignore[k]) {
-						skip = 0;
-						break;
-					}
-				}
-				if (skip) {
-					continue;
-					#ifdef DEBUG
-						fprintf(stderr, "\tSkipping!\n");
-					#endif
-				}
+			if (!PATTERN_SET_HAS(candidates, j)) {
+				#ifdef DEBUG
+					fprintf(stderr, "\tSkipping!\n");
+				#endif
+				continue;
 			}
+			self->stats.matches++;
 			if (Pattern_match(
 				regex,
 				self->input,
@@ -213,60 +302,39 @@ _Scanner_scan(Scanner *self, Pattern *restrictions, int restrictions_sz)
 		}
 		/* If we didn't find anything, raise an error */
 		if (best_token.regex == NULL) {
-			if (restrictions_sz) {
-				sprintf(self->exc, "SyntaxError[@ char %d: Trying to find one of the %d restricted tokens!]", self->pos, restrictions_sz);
+			if (restriction->restricted) {
+				sprintf(self->exc, "SyntaxError[@ char %d: Trying to find one of the restricted tokens!]", self->pos);
 				return SCANNER_EXC_RESTRICTED;
 			}
 			sprintf(self->exc, "SyntaxError[@ char %d: Bad Token!]", self->pos);
 			return SCANNER_EXC_BAD_TOKEN;
 		}
 		/* If we found something that isn't to be ignored, return it */
-		skip = 0;
-		for (k = 0; k < self->ignore_sz; k++) {
-			if (best_token.regex == self->ignore[k]) {
-				/* This token should be ignored... */
-				self->pos += best_token.string_sz;
-				skip = 1;
-				break;
-			}
-		}
-		if (!skip) {
+		if (!PATTERN_SET_HAS(self->ignore, best_token.regex->id)) {
 			break;
 		}
+		/* This token should be ignored... */
+		self->pos += best_token.string_sz;
 	}
-	if (best_token.regex) {
-		self->pos = (int)(best_token.string - self->input + best_token.string_sz);
-		/* Only add this token if it's not in the list (to prevent looping) */
-		p_token = &self->tokens[self->tokens_sz - 1];
-		if (self->tokens_sz == 0 ||
-			p_token->regex != best_token.regex ||
-			p_token->string != best_token.string ||
-			p_token->string_sz != best_token.string_sz
-		) {
-			if (self->tokens_sz >= self->tokens_bsz) {
-				/* Needs to expand block */
-				self->tokens_bsz = self->tokens_bsz + BLOCK_SIZE_PATTERNS;
-				PyMem_Resize(self->tokens, Token, self->tokens_bsz);
-				PyMem_Resize(self->restrictions, Restriction, self->tokens_bsz);
-			}
-			memcpy(&self->tokens[self->tokens_sz], &best_token, sizeof(Token));
-			p_restriction = &self->restrictions[self->tokens_sz];
-			if (restrictions_sz) {
-				p_restriction->patterns = PyMem_New(Pattern *, restrictions_sz);
-				p_restriction->patterns_sz = 0;
-				for (j = 0; j < restrictions_sz; j++) {
-					regex = Pattern_regex(restrictions[k].tok, restrictions[k].expr);
-					if (regex) {
-						p_restriction->patterns[p_restriction->patterns_sz++] = regex;
-					}
-				}
-			} else {
-				p_restriction->patterns = NULL;
-				p_restriction->patterns_sz = 0;
-			}
-			self->tokens_sz++;
-			return 1;
+	self->pos = (int)(best_token.string - self->input + best_token.string_sz);
+	/* Only add this token if it's not in the list (to prevent looping) */
+	p_token = &self->tokens[self->tokens_sz - 1];
+	if (self->tokens_sz == 0 ||
+		p_token->regex != best_token.regex ||
+		p_token->string != best_token.string ||
+		p_token->string_sz != best_token.string_sz
+	) {
+		if (self->tokens_sz >= self->tokens_bsz) {
+			/* Needs to expand block */
+			self->tokens_bsz = self->tokens_bsz + BLOCK_SIZE_TOKENS;
+			MEM_RESIZE(self->tokens, Token, self->tokens_bsz);
+			MEM_RESIZE(self->restrictions, Restriction, self->tokens_bsz);
 		}
+		memcpy(&self->tokens[self->tokens_sz], &best_token, sizeof(Token));
+		memcpy(&self->restrictions[self->tokens_sz], restriction, sizeof(Restriction));
+		self->tokens_sz++;
+		self->stats.tokens++;
+		return 1;
 	}
 	return 0;
 }
@@ -276,55 +344,48 @@ _Scanner_scan(Scanner *self, Pattern *restrictions, int restrictions_sz)
 
 void
 Scanner_reset(Scanner *self, char *input, int input_sz) {
-	int i;
-
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	for (i = 0; i < self->tokens_sz; i++) {
-		PyMem_Del(self->tokens[i].string);
-		PyMem_Del(self->restrictions[i].patterns);
-	}
 	self->tokens_sz = 0;
 
-	if (input_sz) {
-		if (self->input) PyMem_Del(self->input);
-		self->input = PyMem_Strndup(input, input_sz);
-		self->input_sz = input_sz;
-		#ifdef DEBUG
-			fprintf(stderr, "Scanning in %s\n", repr(self->input));
-		#endif
-	}
+	// The input is scanned in place (tokens point into it), it's not copied:
+	self->input = input;
+	self->input_sz = input_sz;
+	#ifdef DEBUG
+		fprintf(stderr, "Scanning in %s\n", repr(self->input));
+	#endif
 
 	self->pos = 0;
+	if (input != NULL) {
+		self->stats.resets++;
+		self->stats.bytes += input_sz;
+	}
 }
 
 void
 Scanner_del(Scanner *self) {
-	int i;
-
 	#ifdef DEBUG
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	if (self->ignore != NULL) {
-		PyMem_Del(self->ignore);
-	}
-
 	if (self->tokens != NULL) {
-		for (i = 0; i < self->tokens_sz; i++) {
-			PyMem_Del(self->restrictions[i].patterns);
-		}
-		PyMem_Del(self->tokens);
-		PyMem_Del(self->restrictions);
+		MEM_DEL(self->tokens);
+		MEM_DEL(self->restrictions);
 	}
 
-	if (self->input != NULL) {
-		PyMem_Del(self->input);
-	}
+	MEM_DEL(self);
+}
 
-	PyMem_Del(self);
+void
+Scanner_collect_stats(Scanner *self, ScannerStats *total)
+{
+	total->resets += self->stats.resets;
+	total->bytes += self->stats.bytes;
+	total->tokens += self->stats.tokens;
+	total->matches += self->stats.matches;
+	memset(&self->stats, 0, sizeof(ScannerStats));
 }
 
 Scanner*
@@ -338,9 +399,9 @@ Scanner_new(Pattern patterns[], int patterns_sz, Pattern ignore[], int ignore_sz
 		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
 	#endif
 
-	self = PyMem_New(Scanner, 1);
-	memset(self, 0, sizeof(Scanner));
+	self = MEM_NEW(Scanner, 1);
 	if (self) {
+		memset(self, 0, sizeof(Scanner));
 		for (i = 0; i < patterns_sz; i++) {
 			regex = Pattern_regex(patterns[i].tok, patterns[i].expr);
 			#ifdef DEBUG
@@ -349,19 +410,14 @@ Scanner_new(Pattern patterns[], int patterns_sz, Pattern ignore[], int ignore_sz
 			}
 			#endif
 		}
-		if (ignore_sz) {
-			self->ignore = PyMem_New(Pattern *, ignore_sz);
-			for (i = 0; i < ignore_sz; i++) {
-				regex = Pattern_regex(ignore[i].tok, ignore[i].expr);
-				if (regex) {
-					self->ignore[self->ignore_sz++] = regex;
-					#ifdef DEBUG
-						fprintf(stderr, "\tIgnoring token %s\n", repr(regex->tok));
-					#endif
-				}
+		for (i = 0; i < ignore_sz; i++) {
+			regex = Pattern_regex(ignore[i].tok, ignore[i].expr);
+			if (regex) {
+				PATTERN_SET_ADD(self->ignore, regex->id);
+				#ifdef DEBUG
+					fprintf(stderr, "\tIgnoring token %s\n", repr(regex->tok));
+				#endif
 			}
-		} else {
-			self->ignore = NULL;
 		}
 		Scanner_reset(self, input, input_sz);
 	}
@@ -394,11 +450,38 @@ Scanner_finalize(void)
 	Pattern_finalize();
 }
 
+int
+Scanner_jit(int jit)
+{
+	int j, available = SCANNER_JIT_OPTIONS != 0;
+
+	#ifdef DEBUG
+		fprintf(stderr, "%s\n", __PRETTY_FUNCTION__);
+	#endif
+
+	#ifdef PCRE_CONFIG_JIT
+		if (pcre_config(PCRE_CONFIG_JIT, &j) != 0 || !j) {
+			/* (libpcre was built without the JIT) */
+			available = 0;
+		}
+	#endif
+	if (jit >= 0 && available && (jit != 0) != Pattern_jit) {
+		Pattern_jit = jit != 0;
+		/* Studies the patterns again, with (or without) the JIT */
+		for (j = 0; j < Pattern_patterns_sz; j++) {
+			if (Pattern_patterns[j].pattern != NULL) {
+				Pattern_study(&Pattern_patterns[j]);
+			}
+		}
+	}
+	return available && Pattern_jit;
+}
+
 Token*
-Scanner_token(Scanner *self, int i, Pattern restrictions[], int restrictions_sz)
+Scanner_token(Scanner *self, int i, Restriction *restriction)
 {
-	int j, k, found;
-	Pattern *regex;
+	int j, wider = 0;
+	unsigned long *patterns, *scanned;
 	long result;
 
 	#ifdef DEBUG
@@ -406,26 +489,29 @@ Scanner_token(Scanner *self, int i, Pattern restrictions[], int restrictions_sz)
 	#endif
 
 	if (i == self->tokens_sz) {
-		result = _Scanner_scan(self, restrictions, restrictions_sz);
+		result = _Scanner_scan(self, restriction);
 		if (result < 0) {
 			return (Token *)result;
 		}
 	} else if (i >= 0 && i < self->tokens_sz) {
-		if (self->restrictions[i].patterns_sz) {
-			for (j = 0; j < restrictions_sz; j++) {
-				found = 0;
-				for (k = 0; k < self->restrictions[i].patterns_sz; k++) {
-					regex = Pattern_regex(restrictions[j].tok, restrictions[j].expr);
-					if (regex == self->restrictions[i].patterns[k]) {
-						found = 1;
-						break;
-					}
+		if (restriction->restricted && self->restrictions[i].restricted) {
+			/* The token can't be reused if it was scanned with fewer
+			   tokens allowed than the ones asked for now */
+			patterns = restriction->patterns;
+			scanned = self->restrictions[i].patterns;
+			for (j = 0; j < PATTERN_SET_SZ; j++) {
+				if (scanned[j] & ~patterns[j]) {
+					wider = 0;
+					break;
 				}
-				if (!found) {
-					sprintf(self->exc, "Unimplemented: restriction set changed");
-					return (Token *)SCANNER_EXC_UNIMPLEMENTED;
+				if (patterns[j] & ~scanned[j]) {
+					wider = 1;
 				}
 			}
+			if (wider) {
+				sprintf(self->exc, "Unimplemented: restriction set changed");
+				return (Token *)SCANNER_EXC_UNIMPLEMENTED;
+			}
 		}
 	}
 	if (i >= 0 && i < self->tokens_sz) {
@@ -19,6 +19,13 @@
 
 #define MAX_EXC_STRING 200
 
+/* Sets of patterns are bitmasks of their ids */
+#define MAX_PATTERNS 256
+#define PATTERN_SET_BITS (8 * sizeof(unsigned long))
+#define PATTERN_SET_SZ (MAX_PATTERNS / PATTERN_SET_BITS)
+#define PATTERN_SET_ADD(set, id) ((set)[(id) / PATTERN_SET_BITS] |= 1UL << ((id) % PATTERN_SET_BITS))
+#define PATTERN_SET_HAS(set, id) ((set)[(id) / PATTERN_SET_BITS] & (1UL << ((id) % PATTERN_SET_BITS)))
+
 #define SCANNER_EXC_BAD_TOKEN (long)-1
 #define SCANNER_EXC_RESTRICTED (long)-2
 #define SCANNER_EXC_UNIMPLEMENTED (long)-3
@@ -28,6 +35,8 @@ typedef struct {
 	char *tok;
 	char *expr;
 	pcre *pattern;
+	pcre_extra *extra;
+	int id;
 } Pattern;
 
 typedef struct {
@@ -36,15 +45,23 @@ typedef struct {
 	int string_sz;
 } Token;
 
+/* The tokens allowed (restricted is zero if any token is) */
 typedef struct {
-	int patterns_sz;
-	Pattern **patterns;
+	int restricted;
+	unsigned long patterns[PATTERN_SET_SZ];
 } Restriction;
 
+/* Counters of the work done (see Scanner_collect_stats) */
+typedef struct {
+	long resets;
+	long bytes;
+	long tokens;
+	long matches;
+} ScannerStats;
+
 typedef struct {
 	char exc[MAX_EXC_STRING];
-    int ignore_sz;
-    Pattern **ignore;
+    unsigned long ignore[PATTERN_SET_SZ];
     int tokens_sz;
     int tokens_bsz;
     Token *tokens;
@@ -52,17 +69,30 @@ typedef struct {
     int input_sz;
     char *input;
 	int pos;
+	ScannerStats stats;
 } Scanner;
 
+extern Pattern *Pattern_patterns;
+
 int Scanner_initialized(void);
 void Scanner_initialize(Pattern *, int);
 void Scanner_finalize(void);
+/* Turns the JIT compilation of the patterns on (1) or off (0), where libpcre
+ * supports it. Returns whether it's on (jit is -1 to only ask) */
+int Scanner_jit(int jit);
 
+/* The input is used in place (not copied), it must outlive its scanning */
 void Scanner_reset(Scanner *self, char *input, int input_sz);
 Scanner *Scanner_new(Pattern *, int, Pattern *, int, char *, int);
 void Scanner_del(Scanner *);
+/* Adds the counters of the scanner to total (and zeroes them) */
+void Scanner_collect_stats(Scanner *, ScannerStats *);
+
+Pattern* Pattern_regex(char *tok, char *expr);
+void Restriction_init(Restriction *);
+void Restriction_add(Restriction *, Pattern *);
 
-Token* Scanner_token(Scanner *, int, Pattern *, int);
+Token* Scanner_token(Scanner *, int, Restriction *);
 void Scanner_rewind(Scanner *, int);
 
 #endif
@@ -1,24 +1,26 @@
-#include <Python.h>
-
+#include <stdio.h>
 #include <string.h>
 
+#include "memory.h"
+
 char *
-PyMem_Strndup(const char *str, size_t len)
+Mem_Strndup(const char *str, size_t len)
 {
+	char *copy = NULL;
 	if (str != NULL) {
-		char *copy = PyMem_New(char, len + 1);
-		if (copy != NULL)
+		copy = MEM_NEW(char, len + 1);
+		if (copy != NULL) {
 			memcpy(copy, str, len);
 			copy[len] = '\0';
-			return copy;
+		}
 	}
-	return NULL;
+	return copy;
 }
 
 char *
-PyMem_Strdup(const char *str)
+Mem_Strdup(const char *str)
 {
-	return PyMem_Strndup(str, strlen(str));
+	return Mem_Strndup(str, strlen(str));
 }
 
 char *
@@ -8,8 +8,8 @@ import sys
 from collections import deque
 
 from scss import config
-from scss import Scss, log, spawn_rule, to_str, profiling
-from scss import _prop_split_re
+from scss import Scss, Frame, force, log, spawn_rule, to_str, profiling, stats
+from scss import _prop_split_re, _block_codestr
 from scss.scss_meta import BUILD_INFO
 
 log.setLevel(logging.INFO)
@@ -44,6 +44,9 @@ def main():
     parser.add_option("-C", "--no-compress", action="store_false",
                       dest="compress", default=True,
                       help="Don't minify outputted CSS")
+    parser.add_option("--fold-constants", action="store_true",
+                      dest="fold_constants", default=False,
+                      help="Calculate constant expressions once, when loading files")
     parser.add_option("-?", action="help", help=SUPPRESS_HELP)
     parser.add_option("-h", "--help", action="help",
                       help="Show this message and exit")
@@ -117,7 +120,7 @@ def main():
         css = Scss()
         context = css.scss_vars
         options = css.scss_opts
-        rule = spawn_rule(context=context, options=options)
+        rule = spawn_rule(context=context, options=options, namespace=css.namespace)
         print "Welcome to %s interactive shell" % BUILD_INFO
         while True:
             try:
@@ -137,24 +140,27 @@ def main():
                 elif s.startswith('@'):
                     properties = []
                     children = deque()
-                    spawn_rule(fileid='<string>', context=context, options=options, properties=properties)
+                    _rule = spawn_rule(rule, fileid='<string>', properties=properties)
+                    frame = Frame(_rule, None, [''], set(), children, None, None)
                     code, name = (s.split(None, 1) + [''])[:2]
                     if code == '@option':
-                        css._settle_options(rule, [''], set(), children, None, None, s, None, code, name)
+                        css._settle_options(frame, None, s, None, code, name)
                         continue
                     elif code == '@import':
-                        css._do_import(rule, [''], set(), children, None, None, s, None, code, name)
+                        css.evaluate(css._do_import(frame, None, s, None, code, name))
                         continue
                     elif code == '@include':
                         final_cont = ''
-                        css._do_include(rule, [''], set(), children, None, None, s, None, code, name)
+                        frame = css._do_include(frame, None, s, None, code, name)
+                        if frame is not None:
+                            css.evaluate(frame)
                         code = css._print_properties(properties).rstrip('\n')
                         if code:
                             final_cont += code
                         if children:
                             css.children.extendleft(children)
                             css.parse_children()
-                            code = css._create_css(css.rules).rstrip('\n')
+                            code = css._create_css(css.rules)[0].rstrip('\n')
                             if code:
                                 final_cont += code
                         final_cont = css.post_process(final_cont)
@@ -171,13 +177,13 @@ def main():
                             pprint(sorted(['vars', 'options', 'mixins', 'functions']))
                         elif name in ('v', 'var', 'variable'):
                             if code == '*':
-                                d = dict((k, v) for k, v in context.items())
+                                d = dict((k, force(v)) for k, v in context.items())
                                 pprint(d)
                             elif code:
-                                d = dict((k, v) for k, v in context.items() if code in k)
+                                d = dict((k, force(v)) for k, v in context.items() if code in k)
                                 pprint(d)
                             else:
-                                d = dict((k, v) for k, v in context.items() if k.startswith('$') and not k.startswith('$__'))
+                                d = dict((k, force(v)) for k, v in context.items() if k.startswith('$') and not k.startswith('$__'))
                                 pprint(d)
                         elif name in ('o', 'opt', 'option'):
                             if code == '*':
@@ -194,23 +200,21 @@ def main():
                                 name = 'mixin'
                             elif name.startswith('f'):
                                 name = 'function'
+                            d = css.namespace.defined('@' + name)
                             if code == '*':
-                                d = dict((k[len(name) + 2:], v) for k, v in options.items() if k.startswith('@' + name + ' '))
                                 pprint(sorted(d))
                             elif code:
-                                d = dict((k, v) for k, v in options.items() if k.startswith('@' + name + ' ') and code in k)
                                 seen = set()
-                                for k, mixin in d.items():
-                                    mixin = getattr(mixin, 'mixin', mixin)
-                                    fn_name, _, _ = k.partition(':')
-                                    if fn_name not in seen:
-                                        seen.add(fn_name)
-                                        print fn_name + '(' + ', '.join(p + (': ' + mixin[1].get(p) if p in mixin[1] else '') for p in mixin[0]) + ') {'
-                                        print '  ' + '\n  '.join(l for l in mixin[2].split('\n'))
+                                for k, mixin in sorted(d.items()):
+                                    if code in k and id(mixin) not in seen:
+                                        seen.add(id(mixin))
+                                        fn_name, _, _ = k.partition(':')
+                                        mixin = getattr(mixin, 'mixin', mixin)
+                                        print '@' + name + ' ' + fn_name + '(' + ', '.join(p + (': ' + mixin[1].get(p) if p in mixin[1] else '') for p in mixin[0]) + ') {'
+                                        print '  ' + '\n  '.join(l for l in _block_codestr(css._mixin_block(mixin)).split('\n'))
                                         print '}'
                             else:
-                                d = dict((k[len(name) + 2:].split(':')[0], v) for k, v in options.items() if k.startswith('@' + name + ' '))
-                                pprint(sorted(d))
+                                pprint(sorted(set(k.partition(':')[0] for k in d)))
                         continue
                 elif s.startswith('$') and (':' in s or '=' in s):
                     prop, value = [a.strip() for a in _prop_split_re.split(s, 1)]
@@ -240,6 +244,7 @@ def main():
                 self.css = Scss(scss_opts={
                     'compress': options.compress,
                     'debug_info': options.debug_info,
+                    'fold_constants': options.fold_constants,
                 })
                 self.output = options.output
                 self.suffix = options.suffix
@@ -275,7 +280,7 @@ def main():
                 print "Compiling %s => %s" % (src_path, dest_path)
                 src_file = open(src_path)
                 dest_file = open(dest_path, 'w')
-                dest_file.write(self.css.compile(src_file.read()))
+                self.css.compile(src_file.read(), output=dest_file)
 
             def on_moved(self, event):
                 super(ScssEventHandler, self).on_moved(event)
@@ -309,16 +314,20 @@ def main():
         css = Scss(scss_opts={
             'compress': options.compress,
             'debug_info': options.debug_info,
+            'fold_constants': options.fold_constants,
         })
         if args:
             for path in args:
                 finput = open(path, 'rt')
-                output.write(css.compile(finput.read()))
+                css.compile(finput.read(), output=output)
         else:
-            output.write(css.compile(sys.stdin.read()))
+            css.compile(sys.stdin.read(), output=output)
 
         for f, t in profiling.items():
             print >>sys.stderr, "%s took %03fs" % (f, t)
+        if options.time:
+            for name, count in sorted(stats().items()):
+                print >>sys.stderr, "%s: %d" % (name, count)
 
 if __name__ == "__main__":
     main()
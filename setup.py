@@ -20,7 +20,7 @@ speedups = Feature(
     ext_modules=[
         Extension(
             'scss._speedups',
-            sources=['scss/src/_speedups.c', 'scss/src/block_locator.c', 'scss/src/scanner.c'],
+            sources=['scss/src/_speedups.c', 'scss/src/block_locator.c', 'scss/src/scanner.c', 'scss/src/processor.c'],
             libraries=['pcre']
         ),
     ],
@@ -74,10 +74,15 @@ def read(fname):
         return ''
 
 
-def run_setup(with_binary):
+def run_setup(with_binary, with_cffi=False):
     features = {}
     if with_binary:
         features['speedups'] = speedups
+    cffi = {}
+    if with_cffi:
+        # The cffi binding of the C core (for PyPy)
+        cffi['setup_requires'] = ['cffi>=1.0.0']
+        cffi['cffi_modules'] = ['scss/src/build_cffi.py:ffibuilder']
     setup(
         name=PROJECT,
         version=VERSION,
@@ -108,13 +113,13 @@ def run_setup(with_binary):
         [console_scripts]
         pyscss = scss.tool:main
         """,
-        **extra
+        **dict(extra, **cffi)
     )
 
 
-def try_building_extension():
+def try_building_extension(with_cffi=False):
     try:
-        run_setup(True)
+        run_setup(not with_cffi, with_cffi)
     except BuildFailed:
         LINE = '=' * 74
         BUILD_EXT_WARNING = 'WARNING: The C extension could not be ' \
@@ -134,7 +139,9 @@ def try_building_extension():
         echo(LINE)
 
 
-if not (is_pypy or is_jython):
+if is_pypy:
+    try_building_extension(with_cffi=True)
+elif not is_jython:
     try_building_extension()
 else:
     run_setup(False)